@@ -0,0 +1,107 @@
+# encoding: utf-8
+"""
+比较DataView两种保存格式(hdf5, memmap)的保存/读取耗时及读取后的内存占用(RSS).
+
+    python benchmarks/benchmark_dataview_io.py [输出目录] [日期数] [symbol数] [字段数]
+
+每种格式的读取在单独的子进程中进行: 读取后取两个字段计算, 记录耗时及进程的峰值RSS.
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+
+def _max_rss_mb():
+    # ru_maxrss在fork/exec后会继承父进程的值, linux上优先读取本进程的VmHWM
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    # resource模块仅在类unix系统可用, windows上不记录RSS
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux为KB, mac为字节
+    return rss / 1024.0 ** 2 if sys.platform == 'darwin' else rss / 1024.0
+
+
+def make_dataview(n_dates, n_symbols, n_fields):
+    from jaqs_fxdayu.data import DataView
+
+    rng = np.random.RandomState(0)
+    dates = pd.bdate_range('2008-01-01', periods=n_dates).strftime('%Y%m%d').astype(int)
+    symbols = ['%06d.SZ' % i for i in range(n_symbols)]
+    fields = ['close', 'volume'] + ['f%d' % i for i in range(n_fields - 2)]
+
+    dv = DataView()
+    dv.set_backend('field_store')
+    dv.symbol = symbols
+    dv.start_date = int(dates[0])
+    dv.extended_start_date_d = int(dates[0])
+    dv.end_date = int(dates[-1])
+    cols = pd.MultiIndex.from_product([symbols, fields[:1]], names=['symbol', 'field'])
+    dv.data_d = pd.DataFrame(rng.rand(n_dates, n_symbols), index=pd.Index(dates, name='trade_date'), columns=cols)
+    dv.fields = fields[:1]
+    for field in fields[1:]:
+        dv.append_df(pd.DataFrame(rng.rand(n_dates, n_symbols), index=dates, columns=symbols), field)
+    return dv
+
+
+def load(folder):
+    from jaqs_fxdayu.data import DataView
+    # 不计入pytables的导入时间
+    import tables
+
+    t = time.time()
+    dv = DataView()
+    dv.load_dataview(folder)
+    t_load = time.time() - t
+    value = float(np.nansum((dv.get_ts('close') * dv.get_ts('volume')).values))
+    t_total = time.time() - t
+    return {'load': t_load, 'load_and_use': t_total, 'max_rss_mb': _max_rss_mb(), 'value': value}
+
+
+def main(folder='./output/benchmark_dataview_io', n_dates=2500, n_symbols=3000, n_fields=20):
+    dv = make_dataview(n_dates, n_symbols, n_fields)
+    print("data: %d dates x %d symbols x %d fields, %.1f MB"
+          % (n_dates, n_symbols, n_fields, n_dates * n_symbols * n_fields * 8 / 1024.0 ** 2))
+
+    results = {}
+    for data_format in ('hdf5', 'memmap'):
+        path = os.path.join(folder, data_format)
+        t = time.time()
+        dv.save_dataview(path, data_format=data_format)
+        t_save = time.time() - t
+        out = subprocess.check_output([sys.executable, __file__, '--load', path])
+        res = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        res['save'] = t_save
+        results[data_format] = res
+
+    print("\n%-8s %10s %10s %16s %14s" % ('format', 'save(s)', 'load(s)', 'load+use(s)', 'max RSS(MB)'))
+    for data_format, res in results.items():
+        print("%-8s %10.2f %10.2f %16.2f %14.1f" % (data_format, res['save'], res['load'],
+                                                    res['load_and_use'], res['max_rss_mb']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--load':
+        print(json.dumps(load(sys.argv[2])))
+    else:
+        args = sys.argv[1:]
+        kwargs = {}
+        if args:
+            kwargs['folder'] = args[0]
+        for name, value in zip(['n_dates', 'n_symbols', 'n_fields'], args[1:]):
+            kwargs[name] = int(value)
+        main(**kwargs)
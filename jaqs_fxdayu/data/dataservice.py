@@ -13,8 +13,12 @@ import numpy as np
 import pandas as pd
 import jaqs.util as jutil
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from jaqs.data.align import align
 from jaqs_fxdayu.patch_util import auto_register_patch
+from jaqs_fxdayu.data.hdf5_pool import H5Pool, H5IndexError, default_pool
+from jaqs_fxdayu.data.resample import resample_bars, ChunkedResampler
+from jaqs_fxdayu.util.dp import interval_mask
 
 
 class DataNotFoundError(Exception):
@@ -192,23 +196,121 @@ class RemoteDataService(OriginRemoteDataService):
         # df_io.set_index('symbol', inplace=True)
         dates = self.query_trade_dates(start_date=start_date, end_date=end_date)
 
-        dic = dict()
-        gp = df_io.groupby(by='symbol')
-        for sec, df in gp:
-            mask = np.zeros_like(dates, dtype=np.integer)
-            for idx, row in df.iterrows():
-                bool_index = np.logical_and(dates >= row['in_date'], dates <= row['out_date'])
-                mask[bool_index] = 1
-            dic[sec] = mask
-
-        res = pd.DataFrame(index=dates, data=dic)
+        res = interval_mask(dates, df_io['symbol'].values,
+                            df_io['in_date'].values, df_io['out_date'].values)
         res.index.name = 'trade_date'
 
         return res
 
 
+# datetime.hd5中秒级时间戳数据集的名称, 缺失值为int64最小值
+BAR_EPOCH_DATASET = 'epoch'
+BAR_EPOCH_NAT = np.iinfo(np.int64).min
+
+
+def _parse_bar_datetime(values):
+    """把'%Y-%m-%d %H:%M:%S...'格式的字符串解析为datetime64, 'None'解析为NaT."""
+    s = pd.Series(np.asarray(values))
+    missing = s.isnull()
+    s = s.astype(str)
+    s = s.where(~missing & (s != 'None'))
+    return pd.to_datetime(s.str[:19], format='%Y-%m-%d %H:%M:%S')
+
+
+def _epoch_to_datetime(values):
+    """秒级时间戳转换为datetime64, BAR_EPOCH_NAT及NaN转换为NaT."""
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        values = np.where(values == BAR_EPOCH_NAT, np.nan, values)
+    return pd.Series(pd.to_datetime(values, unit='s'))
+
+
+def _datetime_to_int(dt):
+    """datetime64序列转换为yyyymmddHHMMSS格式的整数."""
+    dt = pd.Series(dt).dt
+    return (dt.year * 10000000000 + dt.month * 100000000 + dt.day * 1000000 +
+            dt.hour * 10000 + dt.minute * 100 + dt.second).values
+
+
+DEFAULT_BAR_RESAMPLE_RULES = {'high': 'max', 'open': 'first', 'close': 'last',
+                              'low': 'min', 'volume': 'sum', 'symbol': 'last',
+                              'Ignore': 'last', 'buy_base_volume': 'sum',
+                              'buy_quote_volume': 'sum', 'closetime': 'last',
+                              'date': 'last', 'datetime': 'first', 'exchange': 'last',
+                              'gatewayName': 'last', 'number_of_trades': 'sum',
+                              'openInterest': 'last', 'quote_volume': 'sum',
+                              'rawData': 'last', 'time': 'first', 'vtSymbol': 'last',
+                              'trade_date': 'first'}
+
+
+# 单条SQL语句中绑定参数的个数上限(旧版sqlite为999), symbol较多时分批查询
+SQL_MAX_PARAMS = 500
+
+
+def _sql_column_to_array(values, decl_type=None, as_float=False):
+    """
+    把sqlite返回的一列值(object数组)转换为有类型的np.ndarray.
+
+    as_float为True或声明为浮点类型时直接转换为float64(NULL为NaN); 其余数值类型全为整数且无NULL时为int64;
+    文本类型保持object; 其余列或转换失败时按pandas的方式推断类型.
+
+    """
+    decl_type = (decl_type or '').upper()
+    is_float = any(t in decl_type for t in ('REAL', 'FLOA', 'DOUB'))
+    numeric = is_float or any(t in decl_type for t in ('INT', 'NUM', 'DEC'))
+    try:
+        if as_float or numeric:
+            if as_float:
+                values = values.copy()
+                values[values == ''] = np.nan
+            # None转换为NaN, 数字字符串直接解析
+            arr = values.astype(np.float64)
+            if as_float or is_float or len(arr) == 0 or np.isnan(arr).any():
+                return arr
+            ints = values.astype(np.int64)
+            if (ints == arr).all():
+                return ints
+            return arr
+        elif 'CHAR' in decl_type or 'TEXT' in decl_type or 'CLOB' in decl_type:
+            return values
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return pd.Series(values.tolist()).values
+
+
+def _call_field_reader(name, field, kwargs):
+    # 进程池只能传递模块级函数, 由此转发到LocalDataService的静态读取方法
+    return getattr(LocalDataService, name)(field, **kwargs)
+
+
 class LocalDataService(object):
-    def __init__(self, fp=None):
+    """
+    读取本地hdf5+sqlite数据.
+
+    Parameters
+    ----------
+    fp : str
+        数据根目录
+    max_open_files : int
+        句柄池最多同时打开的hdf5文件数
+    max_workers : int
+        daily/bar_reader并行读取字段文件的worker数, 1表示逐个读取
+    executor : {'thread', 'process'}
+        并行方式. h5py读取时持有全局锁, 线程池主要重叠解码与DataFrame构造;
+        需要并行读取磁盘时使用进程池.
+
+    """
+    def __init__(self, fp=None, max_open_files=64, max_workers=1, executor='thread'):
+        if executor not in ('thread', 'process'):
+            raise ValueError("executor只支持'thread'或'process'")
+        self.max_workers = max_workers
+        self.executor = executor
+        # 复用已打开的hdf5句柄及解码后的symbol/date索引
+        self._h5_pool = H5Pool(max_size=max_open_files)
+        # sqlite表名 -> (列名, 查询使用的日期列)
+        self._sql_schema = None
+        # sqlite表名 -> {列名: 声明的类型}
+        self._sql_types = {}
         if fp:
             import sqlite3 as sql
             self.fp = os.path.abspath(fp)
@@ -221,6 +323,168 @@ class LocalDataService(object):
             self.conn = conn
             self.c = conn.cursor()
 
+    def close(self):
+        """关闭缓存的hdf5句柄."""
+        self._h5_pool.clear()
+
+    def _get_sql_schema(self):
+        """
+        读取并缓存sqlite中各表的列名及按日期过滤时使用的日期列.
+
+        Returns
+        -------
+        dict
+            表名 -> (列名list, 日期列名或None)
+
+        """
+        if self._sql_schema is None:
+            self.c.execute('''select name from sqlite_master where type="table";''')
+            schema = {}
+            for view in [i[0] for i in self.c.fetchall()]:
+                self.c.execute('''PRAGMA table_info([%s])''' % (view, ))
+                info = self.c.fetchall()
+                cols = [i[1] for i in info]
+                self._sql_types[view] = {i[1]: i[2] for i in info}
+                date_names = [i for i in cols if 'date' in i]
+                if 'ann_date' in date_names:
+                    date_name = 'ann_date'
+                elif 'report_date' in date_names:
+                    date_name = 'report_date'
+                elif len(date_names) == 0:
+                    date_name = None
+                else:
+                    date_name = date_names[0]
+                schema[view] = (cols, date_name)
+            self._sql_schema = schema
+        return self._sql_schema
+
+    def _fetch_frame(self, sql, params, view=None, float_cols=()):
+        """
+        执行查询并构造DataFrame, 数值列根据表中声明的类型直接生成float64/int64数组, 不经过pandas逐行的类型推断.
+
+        结果仍由fetchall逐行生成python对象, 这部分耗时与pd.read_sql相同且占大部分时间,
+        这里只省去了类型推断, 大表查询只比pd.read_sql略快.
+
+        Parameters
+        ----------
+        sql : str
+        params : list
+        view : str, optional
+            查询的表, 用于获取列的声明类型
+        float_cols : list of str
+            直接转换为float64的列, ''与NULL转换为NaN
+
+        Returns
+        -------
+        pd.DataFrame
+
+        """
+        self.c.execute(sql, params)
+        names = [i[0] for i in self.c.description]
+        rows = self.c.fetchall()
+        types = self._sql_types.get(view, {})
+        # 一次转换为二维object数组后按列切片, 比zip(*rows)逐元素拆分快
+        table = np.array(rows, dtype=object).reshape(len(rows), len(names))
+        arrays = [_sql_column_to_array(table[:, k], types.get(name), name in float_cols)
+                  for k, name in enumerate(names)]
+        df = pd.DataFrame(dict(enumerate(arrays)), columns=list(range(len(names))))
+        df.columns = names
+        return df
+
+    def _read_sql(self, sql, params=(), symbols=None, data_format='pandas', view=None, float_cols=()):
+        """
+        执行带绑定参数的查询.
+
+        sql中的 {symbols} 占位符会被替换为 (?,?,...), symbols较多时按SQL_MAX_PARAMS分批查询后合并.
+        view及float_cols见_fetch_frame.
+
+        """
+        if symbols is None:
+            batches = [None]
+        else:
+            batches = [symbols[i:i + SQL_MAX_PARAMS] for i in range(0, len(symbols), SQL_MAX_PARAMS)] or [[]]
+
+        results = []
+        for batch in batches:
+            _sql, _params = sql, list(params)
+            if batch is not None:
+                _sql = sql.replace('{symbols}', '(' + ','.join(['?'] * len(batch)) + ')')
+                _params = _params + list(batch)
+            if data_format == 'list':
+                self.c.execute(_sql, _params)
+                results.extend([i[0] for i in self.c.fetchall()])
+            else:
+                results.append(self._fetch_frame(_sql, _params, view=view, float_cols=float_cols))
+
+        if data_format == 'list':
+            return results
+        if len(results) == 1:
+            return results[0]
+        return pd.concat(results, ignore_index=True)
+
+    def build_indexes(self):
+        """
+        为lb.*表在(symbol, 日期列)及日期列上建立索引, 使按symbol和日期过滤的查询走索引范围扫描. 只需执行一次.
+
+        查询使用只读连接, 这里单独以读写方式打开data.sqlite.
+
+        Returns
+        -------
+        list of str
+            涉及的索引名
+
+        """
+        import sqlite3 as sql
+        names = []
+        conn = sql.connect(os.path.join(self.fp, 'data.sqlite'))
+        try:
+            for view, (cols, date_name) in sorted(self._get_sql_schema().items()):
+                if not view.startswith('lb.'):
+                    continue
+                index_cols = []
+                if 'symbol' in cols:
+                    index_cols.append(['symbol'] + ([date_name] if date_name else []))
+                if date_name:
+                    index_cols.append([date_name])
+                if 'index_code' in cols:
+                    index_cols.append(['index_code'])
+                for columns in index_cols:
+                    name = 'idx_%s_%s' % (view.replace('.', '_'), '_'.join(columns))
+                    conn.execute('''CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)'''
+                                 % (name, view, ','.join(['"%s"' % c for c in columns])))
+                    names.append(name)
+            conn.execute('ANALYZE')
+            conn.commit()
+        finally:
+            conn.close()
+        return names
+
+    def _map_fields(self, name, fields, **kwargs):
+        """
+        对每个field调用静态读取方法name, 按max_workers/executor的配置并行执行.
+
+        Returns
+        -------
+        list
+            与fields顺序一致的结果
+
+        """
+        workers = min(self.max_workers or 1, len(fields))
+        if workers <= 1:
+            func = getattr(self, name)
+            return [func(f, pool=self._h5_pool, **kwargs) for f in fields]
+
+        if self.executor == 'process':
+            # 句柄池不能跨进程共享, 子进程使用各自的默认句柄池
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                futures = [ex.submit(_call_field_reader, name, f, kwargs) for f in fields]
+                return [future.result() for future in futures]
+
+        func = getattr(self, name)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(func, f, pool=self._h5_pool, **kwargs) for f in fields]
+            return [future.result() for future in futures]
+
     def _get_attrs(self):
         dic = {}
         for root, dirs, files in os.walk(self.fp):
@@ -278,48 +542,56 @@ class LocalDataService(object):
         return mapper
 
     @staticmethod
-    def query_one(field, path, symbol=None, start_date=None, end_date=None):
+    def query_one(field, path, symbol=None, start_date=None, end_date=None, pool=None, epoch=False):
+        """
+        读取path下单个字段的数据.
+
+        epoch为True且field为datetime时, 若文件中已写入秒级时间戳(见build_bar_epoch), 则读取时间戳代替时间字符串.
+
+        """
         _dir = os.path.join(path, field + '.hd5')
-        with h5py.File(_dir, 'r') as file:
-            # noinspection PyBroadException
-            try:
-                dset = file['data']
-                exist_symbol = file['symbol_flag'][:, 0].astype(str)
-                exist_dates = file['date_flag'][:, 0].astype(np.int64)
-
-            except Exception:
-                raise ValueError('error hdf5 file')
-
-            if not start_date:
-                start_date = min(exist_dates)
-            if not end_date:
-                end_date = max(exist_dates)
-
-            if not symbol:
-                symbol = exist_symbol
-
-            symbol_index = [i for i in range(len(exist_symbol)) if exist_symbol[i] in symbol]
-            sorted_symbol = [exist_symbol[i] for i in symbol_index]
-            start_index = bisect.bisect_left(exist_dates, start_date)
-            end_index = bisect.bisect_left(exist_dates, end_date)
-
-            try:
-                data = dset[start_index:end_index, symbol_index]
-            except Exception:
-                raise NameError('不支持的symbol或date,请检查输入是否正确')
-                
-            _index = exist_dates[start_index:end_index]
-
-            # try:
-            #    data = data.astype(float)
-            # except Exception:
-            #    pass
-
-            if data.dtype not in ['float', 'float32', 'float16', 'int']:
-                data = data.astype(str)
-
-            cols_multi = pd.MultiIndex.from_product([[field], sorted_symbol], names=['fields', 'symbol'])
-            return pd.DataFrame(columns=cols_multi, index=_index, data=data)
+        if pool is None:
+            pool = default_pool()
+        try:
+            with pool.open(_dir) as h5:
+                exist_symbol = h5.symbols
+                exist_dates = h5.dates
+
+                if not start_date:
+                    start_date = min(exist_dates)
+                if not end_date:
+                    end_date = max(exist_dates)
+
+                if not symbol:
+                    symbol_index = np.arange(len(exist_symbol))
+                else:
+                    symbol_index = h5.locate_symbols(symbol)
+                sorted_symbol = exist_symbol[symbol_index]
+                start_index = bisect.bisect_left(exist_dates, start_date)
+                end_index = bisect.bisect_left(exist_dates, end_date)
+
+                name = 'data'
+                if epoch and field == 'datetime' and BAR_EPOCH_DATASET in h5.file:
+                    name = BAR_EPOCH_DATASET
+                try:
+                    data = h5.read(start_index, end_index, symbol_index, name=name)
+                except Exception:
+                    raise NameError('不支持的symbol或date,请检查输入是否正确')
+        except H5IndexError:
+            raise ValueError('error hdf5 file')
+
+        _index = exist_dates[start_index:end_index]
+
+        # try:
+        #    data = data.astype(float)
+        # except Exception:
+        #    pass
+
+        if data.dtype not in ['float', 'float32', 'float16', 'int']:
+            data = data.astype(str)
+
+        cols_multi = pd.MultiIndex.from_product([[field], sorted_symbol], names=['fields', 'symbol'])
+        return pd.DataFrame(columns=cols_multi, index=_index, data=data)
 
     def bar_reader(self, path, props, resample_rules=None):
         '''
@@ -349,6 +621,35 @@ class LocalDataService(object):
         if isinstance(freq, str):
             freq = freq.split(',')
 
+        fld = self._bar_fields(path, fields)
+        df = pd.concat(self._map_fields('query_one', fld, path=path, start_date=start_date,
+                                        end_date=end_date, symbol=symbol, epoch=True),
+                       axis=1)
+        df = self._bar_frame(df)
+        res = df
+
+        if freq:
+            df = df.set_index('datetime')
+            new_rules = self._bar_resample_rules(df, resample_rules)
+
+            # df = df.set_index('datetime')
+            # 多个周期由细到粗逐级合成
+            resampled = resample_bars(df, [f for f in freq if f != '1Min'], new_rules)
+            res = {}
+            for f in freq:
+                if f == '1Min':
+                    res[f] = df
+                else:
+                    df1 = resampled[f]
+                    df1['trade_date'] = _datetime_to_int(df1['datetime'])
+                    res[f] = df1
+
+            if len(res.keys()) == 1:
+                k, res = list(res.items())[0]
+        return res
+
+    @staticmethod
+    def _bar_fields(path, fields):
         try:
             exist_field = [i.split('.')[0] for i in os.listdir(path) if i.endswith('hd5')]
         except Exception:
@@ -360,57 +661,144 @@ class LocalDataService(object):
         else:
             fields.extend(basic_field)
             fld = list(set(exist_field) & set(fields))
-        df = pd.concat([self.query_one(f, path, start_date=start_date, end_date=end_date, symbol=symbol) for f in fld],
-                       axis=1)
+        return fld
 
+    @staticmethod
+    def _bar_frame(df):
+        # 宽表转换为按symbol, trade_date排序的长表
         df.index.name = 'trade_date'
         df = df.stack(-1, dropna=False).reset_index()
 
-        def trans_time(d, _type):
-            if d == 'None':
-                return np.NaN
-            else:
-                if _type == 'datetime':
-                    datetime(int(d[:4]), int(d[5:7]), int(d[8:10]), int(d[11:13]), int(d[14:16]), int(d[17:19]))
-                    return datetime.strptime(d[:19], '%Y-%m-%d %H:%M:%S')
-                elif _type == 'int':
-                    return int(str(d)[:19].replace('-', '').replace(' ', '').replace(':', ''))
-                elif _type == 'int_to_datetime':
-                    return datetime.strptime(str(d), '%Y%m%d%H%M%S')
-
-        df['datetime'] = [trans_time(i, 'datetime') for i in df['datetime']]
+        if df['datetime'].dtype.kind in 'iuf':
+            df['datetime'] = _epoch_to_datetime(df['datetime'].values).values
+        else:
+            df['datetime'] = _parse_bar_datetime(df['datetime'].values).values
         df = df.set_index(['symbol', 'trade_date']).dropna(how='all').reset_index()
         df = df.sort_values(by=['symbol', 'trade_date'])
         # df['trade_date'] = df['trade_date'].astype(ctypes.c_int64)
-        res = df
+        return df
 
-        if freq:
-            df = df.set_index('datetime')
-            if not resample_rules:
-                resample_rules = {'high': 'max', 'open': 'first', 'close': 'last',
-                                  'low': 'min', 'volume': 'sum', 'symbol': 'last',
-                                  'Ignore': 'last', 'buy_base_volume': 'sum',
-                                  'buy_quote_volume': 'sum', 'closetime': 'last',
-                                  'date': 'last', 'datetime': 'first', 'exchange': 'last',
-                                  'gatewayName': 'last', 'number_of_trades': 'sum',
-                                  'openInterest': 'last', 'quote_volume': 'sum',
-                                  'rawData': 'last', 'time': 'first', 'vtSymbol': 'last',
-                                  'trade_date': 'first'}
-            new_rules = {i: resample_rules[i] for i in df.columns.values}
+    @staticmethod
+    def _bar_resample_rules(df, resample_rules=None):
+        if not resample_rules:
+            resample_rules = DEFAULT_BAR_RESAMPLE_RULES
+        return {i: resample_rules[i] for i in df.columns.values}
 
-            # df = df.set_index('datetime')
+    def iter_bars(self, path, props, chunk_rows=None, resample_rules=None):
+        """
+        按时间顺序分块读取分钟线, 每块的边界与data数据集的hdf5 chunk对齐, 内存占用与读取的总时长无关.
+
+        Parameters
+        ----------
+        path : str
+            hdf5文件上一级目录
+        props : dict
+            同bar_reader. 指定freq时只支持能整除一天的固定周期, 跨块的周期会在完整后才输出.
+        chunk_rows : int, optional
+            每块读取的行数, 向上取整为hdf5 chunk行数的整数倍, 默认为一个hdf5 chunk.
+        resample_rules : dict, optional
+            同bar_reader
+
+        Yields
+        ------
+        pd.DataFrame or dict
+            与bar_reader的返回格式相同
+
+        """
+        symbol = props.get('symbol')
+        fields = props.get('fields')
+        start_date = props.get('start_date')
+        end_date = props.get('end_date')
+        freq = props.get('freq')
+
+        if isinstance(fields, str):
+            fields = fields.split(',')
+        if isinstance(symbol, str):
+            symbol = symbol.split(',')
+        if isinstance(freq, str):
+            freq = freq.split(',')
+
+        fld = self._bar_fields(path, fields)
+        with self._h5_pool.open(os.path.join(path, 'datetime.hd5')) as h5:
+            exist_dates = h5.dates
+            layout = h5.dset.chunks[0] if h5.dset.chunks else 10000
+
+        if not start_date:
+            start_date = min(exist_dates)
+        if not end_date:
+            end_date = max(exist_dates)
+        start_index = bisect.bisect_left(exist_dates, start_date)
+        end_index = bisect.bisect_left(exist_dates, end_date)
+
+        step = layout if not chunk_rows else int(np.ceil(float(chunk_rows) / layout)) * layout
+        bounds = list(range((start_index // step + 1) * step, end_index, step))
+        bounds = [start_index] + bounds + [end_index]
+
+        resampler = None
+        for i, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if lo >= hi:
+                continue
+            last = hi >= end_index
+            chunk_end = end_date if last else exist_dates[hi]
+            df = pd.concat(self._map_fields('query_one', fld, path=path, start_date=exist_dates[lo],
+                                            end_date=chunk_end, symbol=symbol, epoch=True),
+                           axis=1)
+            df = self._bar_frame(df)
+            if not freq:
+                yield df
+                continue
+
+            df = df.set_index('datetime')
+            if resampler is None:
+                new_rules = self._bar_resample_rules(df, resample_rules)
+                resampler = ChunkedResampler([f for f in freq if f != '1Min'], new_rules)
+            cut = None if last else pd.to_datetime(str(exist_dates[hi]), format='%Y%m%d%H%M%S')
+            resampled = resampler.push(df, cut=cut)
             res = {}
             for f in freq:
                 if f == '1Min':
                     res[f] = df
                 else:
-                    df1 = df.groupby('symbol').resample(f).agg(new_rules).drop('symbol', axis=1).reset_index()
-                    df1['trade_date'] = [trans_time(i, 'int') for i in df1['datetime']]
+                    df1 = resampled[f]
+                    df1['trade_date'] = _datetime_to_int(df1['datetime'])
                     res[f] = df1
 
             if len(res.keys()) == 1:
                 k, res = list(res.items())[0]
-        return res
+            yield res
+
+    def build_bar_epoch(self, path):
+        """
+        解析path下datetime.hd5中的时间字符串, 以int64秒级时间戳写入同一文件的epoch数据集.
+        之后bar_reader直接读取时间戳, 不再逐行解析字符串.
+
+        Parameters
+        ----------
+        path : str
+            hdf5文件上一级目录
+
+        """
+        _dir = os.path.join(path, 'datetime.hd5')
+        if not os.path.exists(_dir):
+            raise FileNotFoundError('指定路径下未找到datetime数据文件，请检查输入路径是否正确')
+
+        # 以写模式打开前先关闭句柄池中的只读句柄
+        self._h5_pool.clear()
+        default_pool().clear()
+
+        with h5py.File(_dir, 'a') as file:
+            dset = file['data']
+            if BAR_EPOCH_DATASET in file:
+                del file[BAR_EPOCH_DATASET]
+            epoch = file.create_dataset(BAR_EPOCH_DATASET, shape=dset.shape, dtype=np.int64,
+                                        chunks=dset.chunks, compression=dset.compression)
+            step = dset.chunks[0] if dset.chunks else 10000
+            for i in range(0, dset.shape[0], step):
+                block = dset[i:i + step].astype(str)
+                dt = _parse_bar_datetime(block.ravel()).values.astype('datetime64[s]')
+                values = dt.astype(np.int64)
+                values[np.isnat(dt)] = BAR_EPOCH_NAT
+                epoch[i:i + step] = values.reshape(block.shape)
 
     def query(self, view, filter, fields, **kwargs):
         if view == 'attrs':
@@ -419,63 +807,50 @@ class LocalDataService(object):
         if view == 'updated_date':
             return self._get_last_updated_date()
 
-        self.c.execute('''select * from sqlite_master where type="table";''')
-        sql_tables = [i[1] for i in self.c.fetchall()]
-        
+        sql_schema = self._get_sql_schema()
+
         if fields == '':
-            fields = '*' 
-        
-        if view in sql_tables:
-            self.c.execute('''PRAGMA table_info([%s])''' % (view, ))
-            cols = [i[1] for i in self.c.fetchall()]
-            date_names = [i for i in cols if 'date' in i]
-            if 'ann_date' in date_names:
-                date_name = 'ann_date'
-            elif 'report_date' in date_names:
-                date_name = 'report_date'
-            elif len(date_names) == 0:
-                date_name = None
-            else:
-                date_name = date_names[0]
+            fields = '*'
+
+        if view in sql_schema:
+            cols, date_name = sql_schema[view]
 
+            # 参数与原先的字符串常量一样以文本绑定, 比较方式由列的亲和类型决定
+            conditions = []
+            params = []
+            symbols = None
             flt = filter.split('&')
             flt.sort()
             if flt[0] != '':
-                k, v = flt[0].split('=')
-                if 'start_date' in flt[0]:
-                    condition = '''SELECT %s FROM "%s" WHERE %s >= "%s"''' % (fields, view, date_name, v)
-                elif 'end_date' in flt[0]:
-                    condition = '''SELECT %s FROM "%s" WHERE %s <= "%s"''' % (fields, view, date_name, v)
-                else:
-                    condition = '''SELECT %s FROM "%s" WHERE %s = "%s"''' % (fields, view, k, v)
-
-                for i in flt[1:]:
+                for i in flt:
                     k, v = i.split('=')
                     if k == 'start_date':
-                        condition += ''' AND %s >= "%s"''' % (date_name, v)
+                        conditions.append('%s >= ?' % (date_name, ))
+                        params.append(v)
                     elif k == 'end_date':
-                        condition += ''' AND %s <= "%s"''' % (date_name, v)
+                        conditions.append('%s <= ?' % (date_name, ))
+                        params.append(v)
                     elif k == 'symbol':
-                        symbols = '("' + '","'.join(v.split(',')) + '")'
-                        condition += ''' AND %s IN %s''' % (k, symbols)
+                        conditions.append('%s IN {symbols}' % (k, ))
+                        symbols = v.split(',')
                     else:
-                        condition += ''' AND %s = "%s"''' % (k, v)
-                condition = condition + ';'
+                        conditions.append('%s = ?' % (k, ))
+                        params.append(v)
 
-            else:
-                condition = '''SELECT %s FROM "%s";''' % (fields, view)
+            condition = '''SELECT %s FROM "%s"''' % (fields, view)
+            if conditions:
+                condition += ' WHERE ' + ' AND '.join(conditions)
+            condition = condition + ';'
 
             data_format = kwargs.get('data_format')
             if not data_format:
                 data_format = 'pandas'
 
             if data_format == 'list':
-                data = [i[0] for i in self.c.fetchall()]
+                data = self._read_sql(condition, params, symbols=symbols, data_format='list')
                 return data, '0, '
             elif data_format == 'pandas':
-                data = pd.read_sql(condition, self.conn)
-                if 'ann_date' in data.columns:
-                    data['ann_date'] = data['ann_date'].astype(float)
+                data = self._read_sql(condition, params, symbols=symbols, view=view, float_cols=['ann_date'])
                 return data, "0,"
 
         elif '.' not in view:
@@ -486,11 +861,11 @@ class LocalDataService(object):
             return self.daily(dic['symbol'], dic['start_date'], dic['end_date'], fields, adjust_mode=None, view=view)
 
     def query_trade_dates(self, start_date, end_date):
-        sql = '''SELECT * FROM "jz.secTradeCal" 
-                 WHERE trade_date>=%s 
-                 AND trade_date<=%s ''' % (start_date, end_date)
+        sql = '''SELECT * FROM "jz.secTradeCal"
+                 WHERE trade_date>=?
+                 AND trade_date<=? '''
 
-        data = pd.read_sql(sql, self.conn)
+        data = self._read_sql(sql, [int(start_date), int(end_date)])
         return data['trade_date'].values
 
     def query_index_member(self, universe, start_date, end_date,data_format='list'):
@@ -546,16 +921,8 @@ class LocalDataService(object):
         # df_io.set_index('symbol', inplace=True)
         dates = self.query_trade_dates(start_date=start_date, end_date=end_date)
 
-        dic = dict()
-        gp = df_io.groupby(by='symbol')
-        for sec, df in gp:
-            mask = np.zeros_like(dates, dtype=np.integer)
-            for idx, row in df.iterrows():
-                bool_index = np.logical_and(dates >= row['in_date'], dates <= row['out_date'])
-                mask[bool_index] = 1
-            dic[sec] = mask
-
-        res = pd.DataFrame(index=dates, data=dic)
+        res = interval_mask(dates, df_io['symbol'].values,
+                            df_io['in_date'].values, df_io['out_date'].values)
         res.index.name = 'trade_date'
 
         return res
@@ -567,7 +934,7 @@ class LocalDataService(object):
         if view_name is None:
             raise NotImplementedError("type_ = {:s}".format(type_))
 
-        symbols = '("' + '","'.join(symbol.split(',')) + '")'
+        symbols = symbol.split(',')
 
         if fields == "":
             fld = '*'
@@ -578,44 +945,48 @@ class LocalDataService(object):
                     fld += ',%s' % (i, )
 
         if view_name == 'lb.finIndicator':
-            sql = '''SELECT %s FROM "%s" 
-              WHERE ann_date>=%s 
-              AND ann_date<=%s 
-              AND symbol IN %s ''' % (fld, view_name, start_date, end_date, symbols)
+            sql = '''SELECT %s FROM "%s"
+              WHERE ann_date>=?
+              AND ann_date<=?
+              AND symbol IN {symbols} ''' % (fld, view_name)
+            params = [int(start_date), int(end_date)]
 
         else:
-            sql = '''SELECT %s FROM "%s" 
-              WHERE ann_date>=%s 
-              AND ann_date<=%s 
-              AND symbol IN %s 
-              AND report_type = "%s"''' % (fld, view_name, start_date, end_date, symbols, report_type)
+            sql = '''SELECT %s FROM "%s"
+              WHERE ann_date>=?
+              AND ann_date<=?
+              AND report_type = ?
+              AND symbol IN {symbols}''' % (fld, view_name)
+            params = [int(start_date), int(end_date), str(report_type)]
 
         try:
-            data = pd.read_sql(sql, self.conn)
+            data = self._read_sql(sql, params, symbols=symbols, view=view_name, float_cols=['ann_date'])
         except Exception as e:
             raise SqlError('%s data not found' % (view_name,), e)
 
         if drop_dup_cols:
             data = data.drop_duplicates()
-        data['ann_date'] = data['ann_date'].replace('', np.NaN).astype(float)
         return data, "0,"
 
     def query_inst_info(self, symbol, fields, inst_type=""):
         symbol = symbol.split(',')
-        symbols = '("' + '","'.join(symbol) + '")'
-        
-        self.c.execute('PRAGMA table_info([jz.instrumentInfo])')
-        cols = [i[1] for i in self.c.fetchall()]
+
+        cols = self._get_sql_schema().get('jz.instrumentInfo', ([], None))[0]
         if 'setlot' not in cols:
             fields = fields.replace('setlot', 'selllot')
         
         if inst_type == "":
             inst_type = "1"
         
-        self.c.execute('''SELECT %s FROM "jz.instrumentInfo"
-                      WHERE symbol IN %s 
-                     AND inst_type = "%s"''' % (fields, symbols, inst_type))
-        data = pd.DataFrame([list(i) for i in self.c.fetchall()], columns=fields.split(','))
+        rows = []
+        for i in range(0, len(symbol), SQL_MAX_PARAMS):
+            batch = symbol[i:i + SQL_MAX_PARAMS]
+            self.c.execute('''SELECT %s FROM "jz.instrumentInfo"
+                          WHERE symbol IN (%s)
+                         AND inst_type = ?''' % (fields, ','.join(['?'] * len(batch))),
+                           batch + [str(inst_type)])
+            rows.extend(self.c.fetchall())
+        data = pd.DataFrame([list(i) for i in rows], columns=fields.split(','))
         return data.set_index('symbol')   
     
     def query_lb_dailyindicator(self, symbol, start_date, end_date, fields=""):
@@ -782,9 +1153,59 @@ class LocalDataService(object):
             res[dr] = lst
         return res
 
-    def daily(self, symbol, start_date, end_date,
-              fields="", adjust_mode=None, view='Stock_D'):
+    @staticmethod
+    def read_daily_block(field, path, symbol, start, end, pool=None):
+        """
+        读取单个字段在[start, end]区间内的宽表数据.
+
+        Returns
+        -------
+        tuple or None
+            (data, dates, symbols), data为 dates × symbols 的np.ndarray; 文件中没有所需symbol时返回None
+
+        """
+        _dir = os.path.join(path, field + '.hd5')
+        if pool is None:
+            pool = default_pool()
+        try:
+            with pool.open(_dir) as h5:
+                exist_symbol = h5.symbols
+                exist_dates = h5.dates
 
+                if start not in h5.date_pos or end not in h5.date_pos:
+                    raise ValueError('起止日期超限')
+
+                symbol_index = h5.locate_symbols(symbol)
+                sorted_symbol = exist_symbol[symbol_index]
+
+                start_index = h5.date_pos[start]
+                end_index = h5.date_pos[end] + 1
+
+                if len(symbol_index) == 0:
+                    return None
+
+                data = h5.read(start_index, end_index, symbol_index)
+        except H5IndexError:
+            raise DataNotFoundError('empty hdf5 file')
+
+        _index = exist_dates[start_index:end_index]
+
+        if data.dtype not in ['float', 'float32', 'float16', 'int']:
+            data = data.astype(str)
+        if field == 'trade_date' and data.dtype in ['float', 'float32', 'float16']:
+            data = data.astype(float).astype(int)
+        return data, _index, sorted_symbol
+
+    @staticmethod
+    def query_daily_field(field, path, symbol, start, end, pool=None):
+        block = LocalDataService.read_daily_block(field, path, symbol, start, end, pool=pool)
+        if block is None:
+            return None
+        data, _index, sorted_symbol = block
+        cols_multi = pd.MultiIndex.from_product([[field], sorted_symbol], names=['fields', 'symbol'])
+        return pd.DataFrame(columns=cols_multi, index=_index, data=data)
+
+    def _resolve_daily_query(self, symbol, start_date, end_date, fields, adjust_mode, view):
         if isinstance(fields, str):
             fields = fields.split(',')
         if isinstance(symbol, str):
@@ -818,47 +1239,90 @@ class LocalDataService(object):
         fld = list(set(exist_field) & set(fields))
         
         need_dates = self.query_trade_dates(start_date, end_date)
-        start = need_dates[0]
-        end = need_dates[-1]
 
         if adjust_mode:
             fld = list(set(fld + ['adjust_factor']))
+        return symbol, fields, fld, need_dates, adjust_mode, view
 
-        def query_by_field(field):
-            _dir = os.path.join(self.fp, view, field + '.hd5')
-            with h5py.File(_dir, 'r') as file:
-                # noinspection PyBroadException
-                try:
-                    dset = file['data']
-                    exist_symbol = file['symbol_flag'][:, 0].astype(str)
-                    exist_dates = file['date_flag'][:, 0].astype(int)
-                except Exception:
-                    raise DataNotFoundError('empty hdf5 file')
+    def daily_blocks(self, symbol, start_date, end_date,
+                     fields="", adjust_mode=None, view='Stock_D'):
+        """
+        与daily相同的查询, 但不转换为长表, 直接返回每个字段的宽表数据块, 供DataView直接合并.
 
-                if start not in exist_dates or end not in exist_dates:
-                    raise ValueError('起止日期超限')
+        Parameters
+        ----------
+        symbol : str or list
+        start_date : int
+        end_date : int
+        fields : str or list
+        adjust_mode : {None, 'post', 'pre'}
+        view : str
+
+        Returns
+        -------
+        list of tuple
+            (field, data, dates, symbols), 所有数据块对齐到相同的dates和symbols,
+            data为 dates × symbols 的np.ndarray, 复权处理与daily一致.
 
-                _symbol = [x for x in symbol if x in exist_symbol]
-                symbol_index = [np.where(exist_symbol == i)[0][0] for i in _symbol]
-                symbol_index.sort()
-                sorted_symbol = [exist_symbol[i] for i in symbol_index]
+        """
+        symbol, fields, fld, need_dates, adjust_mode, view = self._resolve_daily_query(
+            symbol, start_date, end_date, fields, adjust_mode, view)
+
+        blocks = self._map_fields('read_daily_block', fld, path=os.path.join(self.fp, view),
+                                  symbol=symbol, start=need_dates[0], end=need_dates[-1])
+        blocks = [(f, b) for f, b in zip(fld, blocks) if b is not None]
+        if not blocks:
+            return []
+
+        # 各字段文件的symbol/date不一定一致, 对齐到并集
+        dates = np.unique(np.concatenate([b[1] for f, b in blocks]))
+        symbols = np.unique(np.concatenate([b[2] for f, b in blocks]))
+        data = {}
+        for f, (values, _dates, _symbols) in blocks:
+            if len(_dates) == len(dates) and len(_symbols) == len(symbols):
+                data[f] = values
+                continue
+            dtype = values.dtype if values.dtype.kind == 'f' else object
+            aligned = np.full((len(dates), len(symbols)), np.nan, dtype=dtype)
+            aligned[np.ix_(np.searchsorted(dates, _dates), np.searchsorted(symbols, _symbols))] = values
+            data[f] = aligned
 
-                start_index = np.where(exist_dates == start)[0][0]
-                end_index = np.where(exist_dates == end)[0][0] + 1
+        if adjust_mode:
+            adj = data.get('adjust_factor', 1)
+            for f in list(set(data) & set(['open', 'high', 'low', 'close', 'vwap'])):
+                if adjust_mode == 'post':
+                    data[f] = data[f] * adj
+                elif adjust_mode == 'pre':
+                    data[f] = data[f] / adj
+            if adjust_mode in ('post', 'pre'):
+                # 与daily中的dropna一致: 任一字段缺失的(date, symbol)整体置为缺失
+                invalid = np.zeros((len(dates), len(symbols)), dtype=bool)
+                for values in data.values():
+                    invalid |= pd.isnull(values)
+                if invalid.any():
+                    for f, values in data.items():
+                        if values.dtype.kind != 'f':
+                            values = values.astype(object)
+                        else:
+                            values = values.copy()
+                        values[invalid] = np.nan
+                        data[f] = values
+            if 'adjust_factor' not in fields:
+                data.pop('adjust_factor', None)
 
-                if len(symbol_index) == 0:
-                    return None
+        return [(f, data[f], dates, symbols) for f in fld if f in data]
 
-                data = dset[start_index:end_index, symbol_index]
-                _index = exist_dates[start_index:end_index]
+    def daily(self, symbol, start_date, end_date,
+              fields="", adjust_mode=None, view='Stock_D'):
+
+        symbol, fields, fld, need_dates, adjust_mode, view = self._resolve_daily_query(
+            symbol, start_date, end_date, fields, adjust_mode, view)
+        start = need_dates[0]
+        end = need_dates[-1]
 
-                if data.dtype not in ['float', 'float32', 'float16', 'int']:
-                    data = data.astype(str)
-                if field == 'trade_date' and data.dtype in ['float', 'float32', 'float16']:
-                    data = data.astype(float).astype(int)
-                cols_multi = pd.MultiIndex.from_product([[field], sorted_symbol], names=['fields', 'symbol'])
-                return pd.DataFrame(columns=cols_multi, index=_index, data=data)
-        df = pd.concat([query_by_field(f) for f in fld], axis=1)
+        df = pd.concat(self._map_fields('query_daily_field', fld, path=os.path.join(self.fp, view),
+                                        symbol=symbol, start=start, end=end),
+                       axis=1)
         df.index.name = 'trade_date'
         df = df.stack(dropna=False).reset_index()
         if adjust_mode == 'post':
@@ -1,14 +1,22 @@
 import os
 import copy
+import json
+import numbers
+import shutil
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 from jaqs import util as jutil
 from jaqs.data.align import align
 from jaqs.data.dataview import DataView as OriginDataView, EventDataView
 
+from jaqs_fxdayu.data.dataservice import LocalDataService
+from jaqs_fxdayu.data.field_store import FieldStore, load_h5_lazy
 from jaqs_fxdayu.data.search_doc import FuncDoc
 from jaqs_fxdayu.patch_util import auto_register_patch
-from jaqs_fxdayu.data.py_expression_eval import Parser
+from jaqs_fxdayu.data.py_expression_eval import Parser, infer_lookback, infer_skipna
+from jaqs_fxdayu.data.expr_compiler import CompileError, IntermediateCache
 
 try:
     basestring
@@ -18,6 +26,13 @@ except NameError:
 
 PF = "prepare_fields"
 
+# data_d/data_q的存储方式: 单个(symbol, field)宽表, 或按字段分别存储的FieldStore
+FRAME_BACKEND = "frame"
+FIELD_STORE_BACKEND = "field_store"
+
+# add_formulas中公式共用的中间结果最多占用的内存(字节)
+FORMULA_CACHE_LIMIT = 1024 ** 3
+
 
 # def quick_concat(dfs, level, index_name="trade_date"): joined_index = pd.Index(np.concatenate([df.index.values for
 # df in dfs]), name=index_name).sort_values().drop_duplicates() joined_columns = pd.MultiIndex.from_tuples(
@@ -29,6 +44,11 @@ from jaqs_fxdayu.util.concat import quick_concat
 @auto_register_patch(parent_level=1)
 class DataView(OriginDataView):
     def __init__(self):
+        self.backend = FRAME_BACKEND
+        self._data_d = None
+        self._data_q = None
+        self._store_d = None
+        self._store_q = None
         super(DataView, self).__init__()
         self.fields_mapper = {
             "lb.secDailyIndicator": self.reference_daily_fields,
@@ -42,7 +62,11 @@ class DataView(OriginDataView):
         self.external_fields = {}
         self.external_quarterly_fields = {}
         self.factor_fields = set()
-        self.meta_data_list = self.meta_data_list + ['_prepare_fields','report_type']
+        self.meta_data_list = self.meta_data_list + ['_prepare_fields','report_type', 'formulas']
+        # add_formula(add_data=True)添加的字段 -> 公式及参数, 用于refresh_data时重新计算
+        self.formulas = OrderedDict()
+        # 公式使用的自定义函数, 不保存
+        self._formula_funcs = {}
         self._prepare_fields = False
         self._has_prepared_fields = False
         self.report_type = None
@@ -50,12 +74,97 @@ class DataView(OriginDataView):
     def init_from_config(self, props, data_api):
         self.adjust_mode = props.get("adjust_mode", "post")
         self.report_type = props.get("report_type", "408001000") # 默认报表类型为合并报表
+        self.set_backend(props.get("backend", self.backend))
         _props = props.copy()
+        _props.pop("backend", None)
         self._prepare_fields = _props.pop(PF, False)
         if self._prepare_fields:
             self.prepare_fields(data_api)
         super(DataView, self).init_from_config(_props, data_api)
 
+    # --------------------------------------------------------------------------------------------------------
+    # Storage backend
+    def set_backend(self, backend):
+        """
+        设置data_d/data_q的存储方式, 已有数据会转换到新的存储方式.
+
+        Parameters
+        ----------
+        backend : {'frame', 'field_store'}
+            frame: 单个columns为(symbol, field)的宽表;
+            field_store: 每个字段单独存储为 date x symbol 的数组, append_df/remove_field不需要重建已有数据,
+            get_ts直接返回数组上的DataFrame视图. 此时data_d/data_q在访问时才由各字段拼接生成, 仅用于兼容.
+
+        """
+        if backend not in (FRAME_BACKEND, FIELD_STORE_BACKEND):
+            raise ValueError("不支持的backend: %s, 可选 %s, %s" % (backend, FRAME_BACKEND, FIELD_STORE_BACKEND))
+        if backend == self.backend:
+            return
+        data_d, data_q = self.data_d, self.data_q
+        self.backend = backend
+        self.data_d, self.data_q = data_d, data_q
+
+    @property
+    def data_d(self):
+        if self._store_d is not None and self._data_d is None:
+            self._data_d = self._store_d.to_frame()
+        return self._data_d
+
+    @data_d.setter
+    def data_d(self, df):
+        if self.backend == FIELD_STORE_BACKEND and df is not None:
+            self._store_d = FieldStore.from_frame(df)
+            self._data_d = None
+        else:
+            self._store_d = None
+            self._data_d = df
+
+    @property
+    def data_q(self):
+        if self._store_q is not None and self._data_q is None:
+            self._data_q = self._store_q.to_frame()
+        return self._data_q
+
+    @data_q.setter
+    def data_q(self, df):
+        if self.backend == FIELD_STORE_BACKEND and df is not None:
+            self._store_q = FieldStore.from_frame(df)
+            self._data_q = None
+        else:
+            self._store_q = None
+            self._data_q = df
+
+    def _has_data(self, is_quarterly=False):
+        # 不触发FieldStore拼接宽表
+        if is_quarterly:
+            return self._store_q is not None or self._data_q is not None
+        return self._store_d is not None or self._data_d is not None
+
+    def _data_fields(self, is_quarterly=False):
+        store = self._store_q if is_quarterly else self._store_d
+        if store is not None:
+            return store.fields
+        data = self._data_q if is_quarterly else self._data_d
+        if data is None or data.size == 0:
+            return []
+        return list(data.columns.remove_unused_levels().levels[1])
+
+    @property
+    def dates(self):
+        if self._store_d is not None:
+            return self._store_d.dates.values
+        return super(DataView, self).dates
+
+    @property
+    def data_benchmark(self):
+        return self._data_benchmark
+
+    @data_benchmark.setter
+    def data_benchmark(self, df_new):
+        if self._has_data() and df_new.shape[0] != len(self.dates):
+            raise ValueError("You must provide a DataFrame with the same shape of data_benchmark.")
+        self._data_benchmark = df_new
+
     def _is_predefined_field(self, field_name):
         if self._prepare_fields and not self._has_prepared_fields:
             if self.data_api is None:
@@ -300,12 +409,7 @@ class DataView(OriginDataView):
             print("Query groups (industry)...")
             self._prepare_group(group_fields)
 
-        self.fields = []
-        if (self.data_d is not None) and self.data_d.size != 0:
-            self.fields += list(self.data_d.columns.levels[1])
-        if (self.data_q is not None) and self.data_q.size != 0:
-            self.fields += list(self.data_q.columns.levels[1])
-        self.fields = list(set(self.fields))
+        self.fields = list(set(self._data_fields() + self._data_fields(is_quarterly=True)))
 
         trade_status = self.get_ts("trade_status")
         if trade_status.size>0:
@@ -354,7 +458,7 @@ class DataView(OriginDataView):
             self.data_api = data_api
 
         if field_name in self.fields:
-            if self.data_d is None:
+            if not self._has_data():
                 self.fields = []
             else:
                 print("Field name [{:s}] already exists.".format(field_name))
@@ -364,7 +468,7 @@ class DataView(OriginDataView):
             print("Field name [{}] not valid, ignore.".format(field_name))
             return False
 
-        if self.data_d is None:
+        if not self._has_data():
             self.data_d, _ = self._prepare_daily_quarterly(["trade_status"])
             self._add_field("trade_status")
             trade_status = self.get_ts("trade_status")
@@ -391,7 +495,7 @@ class DataView(OriginDataView):
             merge, _ = self._prepare_daily_quarterly([field_name])
             is_quarterly = False
         else:
-            if self.data_q is None:
+            if not self._has_data(is_quarterly=True):
                 _, self.data_q = self._prepare_daily_quarterly(["ann_date"])
                 self._add_field("ann_date")
                 self._prepare_report_date()
@@ -431,13 +535,12 @@ class DataView(OriginDataView):
 
         """
         if is_quarterly:
-            if self.data_q is None:
+            if not self._has_data(is_quarterly=True):
                 raise ValueError("append_df前需要先确保季度数据集data_q不为空！")
-            exist_fields = self.data_q.columns.remove_unused_levels().levels[1]
         else:
-            if self.data_d is None:
+            if not self._has_data():
                 raise ValueError("append_df前需要先确保日度数据集data_d不为空！")
-            exist_fields = self.data_d.columns.remove_unused_levels().levels[1]
+        exist_fields = self._data_fields(is_quarterly)
         if field_name in exist_fields:
             if overwrite:
                 self.remove_field(field_name)
@@ -455,25 +558,53 @@ class DataView(OriginDataView):
         else:
             raise ValueError("Data to be appended must be pandas format. But we have {}".format(type(df)))
 
+        self._append_dfs(OrderedDict([(field_name, df)]), is_quarterly)
+
+    def _append_dfs(self, dfs, is_quarterly=False):
+        """
+        一次加入多个新字段, 宽表只重建一次.
+
+        Parameters
+        ----------
+        dfs : OrderedDict
+            {field_name: pd.DataFrame}, 字段名不能已经存在, DataFrame可能被修改.
+        is_quarterly : bool
+
+        """
+        store = self._store_q if is_quarterly else self._store_d
+        if store is not None:
+            # 只写入该字段的数组, 不重建已有数据
+            for field_name, df in dfs.items():
+                store.set(field_name, df)
+                self._add_field(field_name, is_quarterly)
+            if is_quarterly:
+                self._data_q = None
+            else:
+                self._data_d = None
+            return
+
         if is_quarterly:
             the_data = self.data_q
         else:
             the_data = self.data_d
 
         exist_symbols = the_data.columns.levels[0]
-        if len(df.columns) < len(exist_symbols):
-            df2 = pd.DataFrame(index=df.index, columns=exist_symbols, data=np.nan)
-            df2.update(df)
-            df = df2
-        elif len(df.columns) > len(exist_symbols):
-            df = df.loc[:, exist_symbols]
-        multi_idx = pd.MultiIndex.from_product([exist_symbols, [field_name]])
-        df.columns = multi_idx
+        new_data = []
+        for field_name, df in dfs.items():
+            if len(df.columns) < len(exist_symbols):
+                df2 = pd.DataFrame(index=df.index, columns=exist_symbols, data=np.nan)
+                df2.update(df)
+                df = df2
+            elif len(df.columns) > len(exist_symbols):
+                df = df.loc[:, exist_symbols]
+            multi_idx = pd.MultiIndex.from_product([exist_symbols, [field_name]])
+            df.columns = multi_idx
+            new_data.append(df.reindex(the_data.index))
 
         # the_data = apply_in_subprocess(pd.merge, args=(the_data, df),
         #                            kwargs={'left_index': True, 'right_index': True, 'how': 'left'})  # runs in *only* one process
         # the_data = pd.merge(the_data, df, left_index=True, right_index=True, how='left')
-        the_data = quick_concat([the_data, df.reindex(the_data.index)], ["symbol", "field"], index_name=the_data.index.name, how="inner")
+        the_data = quick_concat([the_data] + new_data, ["symbol", "field"], index_name=the_data.index.name, how="inner")
         the_data = the_data.sort_index(axis=1)
         # merge = the_data.join(df, how='left')  # left: keep index of existing data unchanged
         # sort_columns(the_data)
@@ -482,7 +613,69 @@ class DataView(OriginDataView):
             self.data_q = the_data
         else:
             self.data_d = the_data
-        self._add_field(field_name, is_quarterly)
+        for field_name in dfs:
+            self._add_field(field_name, is_quarterly)
+
+    def remove_field(self, field_names):
+        """
+        Remove custom fields from DataView.
+
+        Parameters
+        ----------
+        field_names : str
+            Separated by comma.
+
+        """
+        if not isinstance(field_names, basestring):
+            raise ValueError("field_names must be str separated by comma.")
+        for field_name in field_names.split(','):
+            self.formulas.pop(field_name, None)
+
+        if self._store_d is None:
+            return super(DataView, self).remove_field(field_names)
+
+        field_names = field_names.split(',')
+
+        for field_name in field_names:
+            if field_name not in self.fields:
+                print("Field name [{:s}] does not exist. Stop remove_field.".format(field_name))
+                return
+
+            if self._is_daily_field(field_name):
+                is_quarterly = False
+            elif self._is_quarter_field(field_name):
+                is_quarterly = True
+            else:
+                print("Field name [{}] is a pre-defined field, ignore.".format(field_name))
+                return
+
+            # 只删除该字段的数组
+            if field_name in self._store_d:
+                self._store_d.remove(field_name)
+                self._data_d = None
+            if is_quarterly and self._store_q is not None and field_name in self._store_q:
+                self._store_q.remove(field_name)
+                self._data_q = None
+
+            self.fields.remove(field_name)
+            if is_quarterly:
+                if field_name in self.custom_quarterly_fields:
+                    self.custom_quarterly_fields.remove(field_name)
+            else:
+                if field_name in self.custom_daily_fields:
+                    self.custom_daily_fields.remove(field_name)
+
+    def get_ts_quarter(self, field, symbol="", start_date=0, end_date=0):
+        if self._store_q is None:
+            return super(DataView, self).get_ts_quarter(field, symbol=symbol, start_date=start_date,
+                                                        end_date=end_date)
+        symbols = symbol.split(',') if symbol else self.symbol
+        return self._store_q.get(field, symbols=symbols)
+
+    def _get_ann_df(self):
+        if self._store_q is None:
+            return super(DataView, self)._get_ann_df()
+        return self._store_q.get(self.ANN_DATE_FIELD_NAME)
 
     def append_df_quarter(self, df, field_name, overwrite=True):
         if field_name in self.fields:
@@ -502,7 +695,8 @@ class DataView(OriginDataView):
                     overwrite=True,
                     formula_func_name_style='camel', data_api=None,
                     register_funcs=None,
-                    within_index=True):
+                    within_index=True,
+                    params=None):
         """
         Add a new field, which is calculated using existing fields.
 
@@ -524,6 +718,9 @@ class DataView(OriginDataView):
                         optional
         within_index : bool
             When do cross-section operatioins, whether just do within index components.
+        params : dict, optional
+            Numeric parameters used in the formula, like {'LEN': 5} for 'Ts_Mean(close, LEN)'.
+            Parsing of a formula is cached, so evaluating it with many parameters parses it only once.
 
         Notes
         -----
@@ -544,6 +741,143 @@ class DataView(OriginDataView):
             elif self._is_predefined_field(field_name):
                 raise ValueError("[{:s}] is alread a pre-defined field. Please use another name.".format(field_name))
 
+        params = self._formula_params(params)
+        parser = self._formula_parser(formula_func_name_style, register_funcs)
+        expr = parser.parse(formula)
+        var_list = [var for var in expr.variables() if var not in params]
+        if not self._prepare_formula_vars(var_list):
+            return
+
+        var_df_dic, all_quarterly = self._formula_values(var_list, is_quarterly)
+        df_eval = parser.evaluate(var_df_dic, params=params, **self._formula_eval_kwargs(within_index))
+
+        if add_data:
+            if all_quarterly:
+                self.append_df_quarter(df_eval, field_name)
+            else:
+                self.append_df(df_eval, field_name, is_quarterly=False)
+            self._register_formula(field_name, formula, is_quarterly, formula_func_name_style,
+                                   register_funcs, within_index, var_list,
+                                   1 if all_quarterly else infer_lookback(expr, params), params)
+
+        if all_quarterly:
+            df_ann = self._get_ann_df()
+            df_expanded = align(df_eval.reindex(df_ann.index), df_ann, self.dates)
+            df_expanded.index.name = self.TRADE_DATE_FIELD_NAME
+            return df_expanded.loc[self.start_date:self.end_date]
+        else:
+            df_eval.index.name = self.TRADE_DATE_FIELD_NAME
+            return df_eval.loc[self.start_date:self.end_date]
+
+    def add_formulas(self, formulas, is_quarterly=False, overwrite=True,
+                     formula_func_name_style='camel', data_api=None,
+                     register_funcs=None, within_index=True,
+                     cache_limit=FORMULA_CACHE_LIMIT):
+        """
+        Add many fields calculated by formulas, same as calling add_formula(add_data=True) for each of them.
+        Subexpressions shared by several formulas are calculated only once, results are appended together.
+
+        Parameters
+        ----------
+        formulas : dict
+            {field_name: formula}. A formula can use fields defined by other formulas in it.
+        is_quarterly : bool
+            Whether the formulas use quarterly data (like quarterly financial statement) or daily data.
+        overwrite : bool, optional
+            Whether overwrite existing field. True by default.
+        formula_func_name_style : {'upper', 'lower'}, optional
+        data_api : RemoteDataService, optional
+        register_funcs : dict, optional
+            Custom functions used by formulas, like {"name1": func1}.
+        within_index : bool
+            When do cross-section operatioins, whether just do within index components.
+        cache_limit : int, optional
+            Max bytes of shared intermediate results kept in memory, 1GB by default. None means no limit.
+
+        Returns
+        -------
+        list of str
+            Added fields, in calculation order.
+
+        """
+        if data_api is not None:
+            self.data_api = data_api
+        formulas = OrderedDict(formulas)
+
+        for field_name in formulas:
+            if field_name in self.fields:
+                if overwrite:
+                    self.remove_field(field_name)
+                    print("Field [{:s}] is overwritten.".format(field_name))
+                else:
+                    raise ValueError("Add formula failed: name [{:s}] exist. Try another name.".format(field_name))
+            elif self._is_predefined_field(field_name):
+                raise ValueError("[{:s}] is alread a pre-defined field. Please use another name.".format(field_name))
+
+        parser = self._formula_parser(formula_func_name_style, register_funcs)
+        inputs = OrderedDict()
+        lookbacks = {}
+        compiled = []
+        for field_name, formula in formulas.items():
+            expr = parser.parse(formula)
+            inputs[field_name] = expr.variables()
+            lookbacks[field_name] = infer_lookback(expr)
+            try:
+                compiled.append(parser.compile())
+            except CompileError:
+                pass
+
+        # 按依赖关系分批计算, 每批的结果一起加入
+        levels = []
+        pending = list(formulas)
+        while pending:
+            blocked = set(pending)
+            ready = [name for name in pending if not blocked.intersection(inputs[name])]
+            if not ready:
+                raise ValueError("公式之间存在循环依赖: %s" % pending)
+            levels.append(ready)
+            pending = [name for name in pending if name not in ready]
+
+        var_list = []
+        for field_name in formulas:
+            var_list.extend(var for var in inputs[field_name] if var not in formulas and var not in var_list)
+        if not self._prepare_formula_vars(var_list):
+            return []
+
+        cache = IntermediateCache.from_expressions(compiled, memory_limit=cache_limit)
+        eval_kwargs = self._formula_eval_kwargs(within_index)
+        loaded = {}
+        for level in levels:
+            daily, quarterly = OrderedDict(), OrderedDict()
+            for field_name in level:
+                parser.parse(formulas[field_name])
+                var_df_dic, all_quarterly = self._formula_values(inputs[field_name], is_quarterly, loaded=loaded)
+                df_eval = parser.evaluate(var_df_dic, cache=cache, **eval_kwargs)
+                if all_quarterly:
+                    quarterly[field_name] = df_eval
+                    lookbacks[field_name] = 1
+                else:
+                    daily[field_name] = df_eval
+
+            if quarterly:
+                if not self._has_data(is_quarterly=True):
+                    raise ValueError("append_df前需要先确保季度数据集data_q不为空！")
+                self._append_dfs(OrderedDict((name, df.copy()) for name, df in quarterly.items()),
+                                 is_quarterly=True)
+                df_ann = self._get_ann_df()
+                for field_name, df in quarterly.items():
+                    daily[field_name] = align(df.reindex_like(df_ann), df_ann, self.dates)
+            if daily:
+                if not self._has_data():
+                    raise ValueError("append_df前需要先确保日度数据集data_d不为空！")
+                self._append_dfs(OrderedDict((name, daily[name]) for name in level), is_quarterly=False)
+            for field_name in level:
+                self._register_formula(field_name, formulas[field_name], is_quarterly, formula_func_name_style,
+                                       register_funcs, within_index, inputs[field_name], lookbacks[field_name])
+        return [name for level in levels for name in level]
+
+    @staticmethod
+    def _formula_parser(formula_func_name_style='camel', register_funcs=None):
         parser = Parser()
         parser.set_capital(formula_func_name_style)
 
@@ -554,12 +888,22 @@ class DataView(OriginDataView):
                                 func in parser.consts or func in parser.values:
                     raise ValueError("注册的自定义函数名%s与内置的函数名称重复,请更换register_funcs中定义的相关函数名称." % (func,))
                 parser.functions[func] = register_funcs[func]
+        return parser
 
-        expr = parser.parse(formula)
-
-        var_df_dic = dict()
-        var_list = expr.variables()
-
+    @staticmethod
+    def _formula_params(params):
+        """公式参数转为python数值(numpy标量用item()转换), 以便保存至json; 非数值参数报错."""
+        result = {}
+        for name, value in (params or {}).items():
+            if isinstance(value, np.generic):
+                value = value.item()
+            if not isinstance(value, numbers.Real):
+                raise ValueError("公式参数{}须为数值, 实际为{!r}".format(name, value))
+            result[name] = value
+        return result
+
+    def _prepare_formula_vars(self, var_list):
+        """确保公式使用的字段已在DataView中, 未能取得数据时返回False."""
         # TODO: users do not need to prepare data before add_formula
         if not self.fields:
             self.fields.extend(var_list)
@@ -571,48 +915,402 @@ class DataView(OriginDataView):
                           "try to fetch from the server...".format(var))
                     success = self.add_field(var)
                     if not success:
-                        return
+                        return False
+        return True
+
+    def _formula_values(self, var_list, is_quarterly, loaded=None):
+        """
+        公式计算使用的数据.
+
+        Parameters
+        ----------
+        var_list : list of str
+        is_quarterly : bool
+        loaded : dict, optional
+            已取得的数据, 多个公式共用
+
+        Returns
+        -------
+        var_df_dic : dict
+        all_quarterly : bool
+            公式只使用季度数据
 
-        all_quarterly=True
+        """
+        var_df_dic = dict()
+        all_quarterly = True
         for var in var_list:
-            if self._is_quarter_field(var) and is_quarterly:
+            quarterly = self._is_quarter_field(var) and is_quarterly
+            if loaded is not None and var in loaded:
+                df_var = loaded[var]
+            elif quarterly:
                 df_var = self.get_ts_quarter(var, start_date=self.extended_start_date_q)
             else:
                 # must use extended date. Default is start_date
                 df_var = self.get_ts(var, start_date=self.extended_start_date_d, end_date=self.end_date)
-                all_quarterly=False
+            if loaded is not None:
+                loaded[var] = df_var
+            if not quarterly:
+                all_quarterly = False
             var_df_dic[var] = df_var
+        return var_df_dic, all_quarterly
 
+    def _formula_eval_kwargs(self, within_index):
         # TODO: send ann_date into expr.evaluate. We assume that ann_date of all fields of a symbol is the same
-        df_ann = self._get_ann_df()
+        kwargs = {'ann_dts': self._get_ann_df(), 'trade_dts': self.dates}
         if within_index:
             df_index_member = self.get_ts('index_member', start_date=self.extended_start_date_d, end_date=self.end_date)
-            if df_index_member.size == 0:
-                df_index_member = None
-            df_eval = parser.evaluate(var_df_dic, ann_dts=df_ann, trade_dts=self.dates, index_member=df_index_member)
-        else:
-            df_eval = parser.evaluate(var_df_dic, ann_dts=df_ann, trade_dts=self.dates)
+            if df_index_member.size > 0:
+                kwargs['index_member'] = df_index_member
+        return kwargs
+
+    def _register_formula(self, field_name, formula, is_quarterly, formula_func_name_style,
+                          register_funcs, within_index, inputs, lookback, params=None):
+        register_funcs = register_funcs or {}
+        self._formula_funcs.update(register_funcs)
+        self.formulas[field_name] = {
+            'formula': formula,
+            'is_quarterly': is_quarterly,
+            'formula_func_name_style': formula_func_name_style,
+            'register_funcs': sorted(register_funcs.keys()),
+            'within_index': within_index,
+            'inputs': sorted(inputs),
+            'lookback': lookback,
+        }
+        if params:
+            self.formulas[field_name]['params'] = dict(params)
 
-        if add_data:
-            if all_quarterly:
-                self.append_df_quarter(df_eval, field_name)
+    @property
+    def formula_graph(self):
+        """
+        Dependency graph of fields added by add_formula(add_data=True).
+
+        Returns
+        -------
+        OrderedDict
+            {field: [input fields of its formula]}, in the order fields are added.
+
+        """
+        return OrderedDict((name, self._formula_inputs(name)) for name in self.formulas)
+
+    def _parse_formula(self, name):
+        spec = self.formulas[name]
+        parser = Parser()
+        parser.set_capital(spec['formula_func_name_style'])
+        for func in spec['register_funcs']:
+            parser.functions[func] = None
+        return parser.parse(spec['formula'])
+
+    def _parse_registered(self, name):
+        spec = self.formulas[name]
+        params = spec.get('params') or {}
+        expr = self._parse_formula(name)
+        spec['inputs'] = sorted(var for var in expr.variables() if var not in params)
+        spec['lookback'] = infer_lookback(expr, params)
+        return spec
+
+    def _formula_inputs(self, name):
+        spec = self.formulas[name]
+        if 'inputs' not in spec:
+            spec = self._parse_registered(name)
+        return spec['inputs']
+
+    def _formula_lookback(self, name):
+        spec = self.formulas[name]
+        if 'lookback' not in spec:
+            spec = self._parse_registered(name)
+        return spec['lookback']
+
+    def _formula_window(self, names):
+        """
+        重新计算names(已按依赖关系排序)中的公式字段时, 第一个计算日期之前需要的历史数据行数.
+
+        names中的字段依赖的其他names字段也在窗口内重新计算, 需要的行数沿依赖链累加.
+        行数假定窗口内没有NaN, 截取的窗口须再用_window_exact检查.
+
+        Returns
+        -------
+        int or None
+            None表示需要全部历史数据
+
+        """
+        need = {}
+        for name in names:
+            lookback = self._formula_lookback(name)
+            upstream = [need[f] for f in self._formula_inputs(name) if f in need]
+            if lookback is None or None in upstream:
+                need[name] = None
             else:
-                self.append_df(df_eval, field_name, is_quarterly=False)
+                need[name] = lookback - 1 + max(upstream + [0])
+        if None in need.values():
+            return None
+        return max(need.values()) if need else 0
 
-        if all_quarterly:
-            df_ann = self._get_ann_df()
-            df_expanded = align(df_eval.reindex(df_ann.index), df_ann, self.dates)
-            df_expanded.index.name = self.TRADE_DATE_FIELD_NAME
-            return df_expanded.loc[self.start_date:self.end_date]
+    def _window_exact(self, names, window, begin):
+        """
+        在window(第begin行及之后的日度数据)上重新计算names中的公式字段时, 结果是否与使用全部历史数据相同.
+
+        _formula_window按日期行数计算窗口, Ts_Mean等函数跳过NaN(停牌), 窗口内输入有NaN的symbol可能需要更早的数据.
+        输入字段在窗口内没有NaN, 或在窗口之前全为NaN(如尚未上市)的symbol不受影响.
+
+        Parameters
+        ----------
+        names : list of str
+            已按依赖关系排序
+        window : FieldStore
+        begin : int
+            window的第一行在self.dates中的位置
+
+        Returns
+        -------
+        bool
+
+        """
+        if begin <= 0:
+            return True
+        skips = False
+        keeps = {}
+        for name in names:
+            spec = self.formulas[name]
+            opaque = [f for f in self._formula_inputs(name) if not keeps.get(f, True)]
+            skip, keep = infer_skipna(self._parse_formula(name), spec.get('params'), opaque)
+            if skip is None:
+                return False
+            skips = skips or skip
+            # 季度字段展开, within_index屏蔽非成分股, 都会在输入不为NaN处产生NaN
+            keeps[name] = keep and not spec['is_quarterly'] and not spec['within_index']
+        if not skips:
+            return True
+
+        inputs = sorted(set(f for name in names for f in self._formula_inputs(name) if f not in keeps))
+        has_nan = np.zeros(len(window.symbols), dtype=bool)
+        for field in inputs:
+            if field not in window:
+                return False
+            has_nan |= pd.isnull(window.values(field)).any(axis=0)
+        if not has_nan.any():
+            return True
+        symbols = list(window.symbols[has_nan])
+        end_date = self.dates[begin - 1]
+        for field in inputs:
+            history = self.get_ts(field, symbol=','.join(symbols), end_date=end_date)
+            if not history.reindex(columns=symbols).isnull().values.all():
+                return False
+        return True
+
+    def _formula_order(self, fields=None):
+        """
+        需要重新计算的公式字段, 按依赖关系排序(输入字段在前).
+
+        Parameters
+        ----------
+        fields : list of str, optional
+            发生变化的字段, 其中的公式字段及直接或间接依赖这些字段的公式字段需要重新计算. 默认为全部公式字段.
+
+        Returns
+        -------
+        list of str
+
+        """
+        graph = self.formula_graph
+        if fields is None:
+            dirty = set(graph)
         else:
-            df_eval.index.name = self.TRADE_DATE_FIELD_NAME
-            return df_eval.loc[self.start_date:self.end_date]
+            dirty = set(f for f in fields if f in graph)
+            changed = set(fields)
+            while True:
+                new = set(name for name, inputs in graph.items()
+                          if name not in dirty and changed.intersection(inputs))
+                if not new:
+                    break
+                dirty |= new
+                changed |= new
+
+        order = []
+        pending = [name for name in graph if name in dirty]
+        while pending:
+            blocked = set(pending)
+            ready = [name for name in pending if not blocked.intersection(graph[name])]
+            if not ready:
+                raise ValueError("公式字段之间存在循环依赖: %s" % pending)
+            order.extend(ready)
+            pending = [name for name in pending if name not in ready]
+        return order
+
+    def _check_formula_funcs(self, names, register_funcs=None):
+        funcs = dict(self._formula_funcs)
+        funcs.update(register_funcs or {})
+        for name in names:
+            missing = [func for func in self.formulas[name]['register_funcs'] if func not in funcs]
+            if missing:
+                raise ValueError("公式字段%s使用了自定义函数%s, 请通过register_funcs传入." % (name, missing))
+        return funcs
+
+    def _compute_formulas(self, window, hist_len, data_q, names, funcs):
+        """
+        在window(日度字段)及data_q(季度字段)上按顺序计算names中的公式字段.
+
+        Parameters
+        ----------
+        window : FieldStore
+            前hist_len行为公式需要的历史数据
+        hist_len : int
+        data_q : pd.DataFrame or None
+        names : list of str
+            已按依赖关系排序
+        funcs : dict
+            自定义函数
+
+        Returns
+        -------
+        DataView
+            计算使用的DataView, 结果保存在其_store_d, _store_q中
+
+        """
+        tail = copy.copy(self)
+        tail.backend = FIELD_STORE_BACKEND
+        tail._data_d = tail._data_q = None
+        tail._store_d = window
+        tail._store_q = FieldStore.from_frame(data_q) if data_q is not None else None
+        for store in (tail._store_d, tail._store_q):
+            for name in names:
+                if store is not None and name in store:
+                    store.remove(name)
+        tail.fields = [f for f in self.fields if f not in names]
+        tail.custom_daily_fields = [f for f in self.custom_daily_fields if f not in names]
+        tail.custom_quarterly_fields = [f for f in self.custom_quarterly_fields if f not in names]
+        tail.formulas = OrderedDict()
+        tail._formula_funcs = {}
+        tail._data_benchmark = None
+        tail.extended_start_date_d = int(window.dates[0])
+        tail.start_date = int(window.dates[min(hist_len, len(window.dates) - 1)])
+        tail.end_date = int(window.dates[-1])
+        for name in names:
+            spec = self.formulas[name]
+            tail.add_formula(name, spec['formula'], spec['is_quarterly'], add_data=True,
+                             formula_func_name_style=spec['formula_func_name_style'],
+                             register_funcs={func: funcs[func] for func in spec['register_funcs']},
+                             within_index=spec['within_index'], params=spec.get('params'))
+        return tail
+
+    def recompute(self, fields=None, since=None, register_funcs=None):
+        """
+        Re-calculate fields added by add_formula(add_data=True) in dependency order.
+
+        Parameters
+        ----------
+        fields : str or list of str, optional
+            Changed fields, str separated by comma. Formula fields in it and formula fields depending on them
+            (directly or indirectly) are re-calculated. All formula fields by default.
+        since : int, optional
+            Only values on dates >= since are re-calculated, earlier dates are used as history needed by formulas.
+            Re-calculated values equal those of a full re-calculation: history rows are limited to the lookback of
+            formulas only when NaN-skipping ts_* functions (Ts_Mean, StdDev...) have no NaN (suspension) to skip in
+            the rows used, otherwise the whole history is used. All dates by default.
+        register_funcs : dict, optional
+            Custom functions used by formulas, see refresh_data.
+
+        Returns
+        -------
+        list of str
+            Re-calculated fields, in calculation order.
+
+        """
+        if isinstance(fields, basestring):
+            fields = fields.split(',')
+        names = self._formula_order(fields)
+        if not names or not self._has_data():
+            return []
+        funcs = self._check_formula_funcs(names, register_funcs)
+
+        dates = self.dates
+        start = 0 if since is None else int(np.searchsorted(dates, since))
+        if start >= len(dates):
+            return []
+        lookback = self._formula_window(names)
+        begin = 0 if lookback is None else max(start - lookback, 0)
+        if self._store_d is not None:
+            window = self._store_d.slice(start_date=dates[begin])
+        else:
+            window = FieldStore.from_frame(self.data_d.iloc[begin:])
+        if not self._window_exact(names, window, begin):
+            begin = 0
+            window = self._store_d.slice() if self._store_d is not None else FieldStore.from_frame(self.data_d)
+        data_q = self.data_q if self._has_data(is_quarterly=True) else None
+        tail = self._compute_formulas(window, start - begin, data_q, names, funcs)
+
+        for name in names:
+            self._write_field(name, tail._store_d.get(name, start_date=dates[start]))
+            if tail._store_q is not None and name in tail._store_q:
+                self._write_field(name, tail._store_q.get(name), is_quarterly=True)
+        return names
+
+    def _write_field(self, field_name, df, is_quarterly=False):
+        """把df中的值写入已有字段的对应日期及symbol, 其余位置不变."""
+        store = self._store_q if is_quarterly else self._store_d
+        if store is not None:
+            store.update(field_name, df)
+            if is_quarterly:
+                self._data_q = None
+            else:
+                self._data_d = None
+            return
+        data = self._data_q if is_quarterly else self._data_d
+        pos = np.flatnonzero(data.columns.get_level_values(1) == field_name)
+        symbols = data.columns.get_level_values(0)[pos]
+        rows = data.index.get_indexer(df.index)
+        data.iloc[rows, pos] = df.reindex(columns=symbols).values
 
     @property
     def func_doc(self):
         search = FuncDoc()
         return search
 
+    def save_dataview(self, folder_path, data_format='hdf5'):
+        """
+        Save data and meta_data_to_store to folder_path.
+
+        Parameters
+        ----------
+        folder_path : str or unicode
+            Path to store your data.
+        data_format : {'hdf5', 'memmap'}, optional
+            hdf5: all data in a single blosc compressed data.hd5 (default).
+            memmap: each field of data_d/data_q is stored as an uncompressed .npy file under
+            folder_path/data_d and folder_path/data_q, which load_dataview maps into memory without copying,
+            so processes loading the same dataview share the page cache. Other tables are still stored in data.hd5.
+
+        """
+        if data_format not in ('hdf5', 'memmap'):
+            raise ValueError("不支持的data_format: %s, 可选 hdf5, memmap" % data_format)
+        # 清除之前以memmap格式保存的字段, 避免load_dataview读到旧数据
+        for name in ('data_d', 'data_q'):
+            if FieldStore.exists(os.path.join(folder_path, name)):
+                shutil.rmtree(os.path.join(folder_path, name))
+        if data_format == 'hdf5':
+            return super(DataView, self).save_dataview(folder_path)
+
+        abs_folder = os.path.abspath(folder_path)
+        meta_path = os.path.join(folder_path, 'meta_data.json')
+        data_path = os.path.join(folder_path, 'data.hd5')
+
+        data_to_store = {'data_benchmark': self.data_benchmark, 'data_inst': self.data_inst}
+        data_to_store = {k: v for k, v in data_to_store.items() if v is not None}
+        meta_data_to_store = {key: self.__dict__[key] for key in self.meta_data_list}
+
+        print("\nStore data...")
+        jutil.save_json(meta_data_to_store, meta_path)
+        self._save_h5(data_path, data_to_store)
+        for name, store, data in (('data_d', self._store_d, self._data_d),
+                                  ('data_q', self._store_q, self._data_q)):
+            if store is None and data is not None:
+                store = FieldStore.from_frame(data)
+            if store is not None:
+                store.save(os.path.join(folder_path, name))
+
+        print("Dataview has been successfully saved to:\n"
+              + abs_folder + "\n\n"
+              + "You can load it with load_dataview('{:s}')".format(abs_folder))
+
     def load_dataview(self, folder_path='.', *args, **kwargs):
         """
         Load data from local file.
@@ -620,6 +1318,16 @@ class DataView(OriginDataView):
         ----------
         folder_path : str or unicode, optional
             Folder path to store hd5 file and meta data.
+        backend : {'frame', 'field_store'}, optional
+            Storage backend of loaded data, see set_backend.
+        lazy : bool, optional
+            Only read index and meta data when loading, each field is read from disk when it is first used
+            (get_ts, add_formula, etc.). Implies backend='field_store'. False by default.
+            Dataviews saved with data_format='memmap' are always memory mapped with backend='field_store',
+            lazy and memory_limit are ignored.
+        memory_limit : int, optional
+            With lazy=True, max bytes of loaded fields kept in memory, least recently used fields are released
+            (and read again when needed). No limit by default.
         """
 
         path_meta_data = os.path.join(folder_path, 'meta_data.json')
@@ -627,16 +1335,54 @@ class DataView(OriginDataView):
         if not (os.path.exists(path_meta_data) and os.path.exists(path_data)):
             raise IOError("There is no data file under directory {}".format(folder_path))
 
-        meta_data = jutil.read_json(path_meta_data)
-        dic = self._load_h5(path_data)
-        self.data_d = dic.get('/data_d', None)
-        self.data_q = dic.get('/data_q', None)
+        with open(path_meta_data, 'r') as f:
+            # 保持formulas中公式的添加顺序
+            meta_data = json.load(f, object_pairs_hook=OrderedDict)
+        if FieldStore.exists(os.path.join(folder_path, 'data_d')):
+            # save_dataview(data_format='memmap')保存的数据
+            dic = self._load_h5(path_data)
+            self.set_backend(FIELD_STORE_BACKEND)
+            self.data_d = self.data_q = None
+            self._store_d = FieldStore.load(os.path.join(folder_path, 'data_d'))
+            if FieldStore.exists(os.path.join(folder_path, 'data_q')):
+                self._store_q = FieldStore.load(os.path.join(folder_path, 'data_q'))
+        elif kwargs.get('lazy', False):
+            dic = load_h5_lazy(path_data, ['/data_d', '/data_q'], memory_limit=kwargs.get('memory_limit'))
+            self.set_backend(FIELD_STORE_BACKEND)
+            self.data_d = self.data_q = None
+            self._store_d = dic.get('/data_d', None)
+            self._store_q = dic.get('/data_q', None)
+        else:
+            dic = self._load_h5(path_data)
+            self.set_backend(kwargs.get('backend', self.backend))
+            self.data_d = dic.get('/data_d', None)
+            self.data_q = dic.get('/data_q', None)
         self._data_benchmark = dic.get('/data_benchmark', None)
         self._data_inst = dic.get('/data_inst', None)
         self.__dict__.update(meta_data)
         print("Dataview loaded successfully.")
 
         
+    def _config_props(self, start_date, end_date, fields=None):
+        """用当前数据集的配置构造init_from_config的props."""
+        props = {
+            "start_date": start_date,
+            "end_date": end_date,
+            "fields": ",".join(self.fields if fields is None else fields),
+            "all_price": self.all_price,
+            "report_type": self.report_type,
+            "benchmark": self.benchmark,
+            "adjust_mode": self.adjust_mode,
+            "prepare_fields": self._prepare_fields,
+            "backend": self.backend
+        }
+        if self.universe and len(self.universe) > 0:
+            props["universe"] = ",".join(self.universe)
+        # if you use symbol and in you logic
+        else:
+            props["symbol"] = ",".join(self.symbol)
+        return props
+
     def slice_dv(self, start_date, end_date, data_api=None, inplace=False):
         if start_date < self.start_date:
             raise IndexError("Sliced dataview beyond its start_date %s: %s!" % (self.start_date, start_date))
@@ -644,42 +1390,257 @@ class DataView(OriginDataView):
             dv =  self
         else:
             dv = self.__class__()
-            if self.universe and len(self.universe) > 0:
-                props={
-                    "start_date": start_date,
-                    "end_date": end_date,
-                    "universe": ",".join(self.universe),
-                    'fields': ",".join(self.fields),
-                    "all_price": self.all_price,
-                    "report_type": self.report_type,
-                    "benchmark": self.benchmark,
-                    "adjust_mode":self.adjust_mode,
-                    "prepare_fields":self._prepare_fields
-                }
-            # if you use symbol and in you logic
-            else:
-                props={
-                    "start_date": start_date,
-                    "end_date": end_date,
-                    "symbol": ",".join(self.symbol),
-                    "fields": ",".join(self.fields),
-                    "all_price": self.all_price,
-                    "report_type": self.report_type,
-                    "benchmark": self.benchmark,
-                    "adjust_mode":self.adjust_mode,
-                    "prepare_fields":self._prepare_fields
-                }
+            props = self._config_props(start_date, end_date)
             dv.init_from_config(data_api = data_api or self.data_api, props=props)
             dv.fields = copy.copy(self.fields)
-            dv.data_q = self.data_q.loc[dv.extended_start_date_q:dv.end_date]
-            dv.data_d = self.data_d.loc[dv.extended_start_date_d:dv.end_date]
+            if self._store_d is not None:
+                dv._store_q = self._store_q.slice(dv.extended_start_date_q, dv.end_date) \
+                    if self._store_q is not None else None
+                dv._store_d = self._store_d.slice(dv.extended_start_date_d, dv.end_date)
+            else:
+                dv.data_q = self.data_q.loc[dv.extended_start_date_q:dv.end_date]
+                dv.data_d = self.data_d.loc[dv.extended_start_date_d:dv.end_date]
             dv.data_benchmark = self.data_benchmark.loc[dv.extended_start_date_d:dv.end_date]
         if end_date > dv.end_date:
             print("Sliced dataview's end_date is %s, expected %s, refresh_data is called to extend it." % (dv.end_date, end_date))
             dv.refresh_data(end_date, data_api)
-        dv.end_date = int(dv.data_d.index[-1])
+        dv.end_date = int(dv.dates[-1])
         return dv
 
+    # --------------------------------------------------------------------------------------------------------
+    # Incremental update
+    def refresh_data(self, end_date, data_api=None, register_funcs=None):
+        """
+        Update data to end_date, only dates after current end_date are queried.
+
+        Pre-defined fields of new dates are queried from data_api, fields added by add_formula(add_data=True)
+        are re-calculated on the new dates (with history rows needed by the formula), other custom fields
+        (added by append_df) are NaN on the new dates. Symbols are not changed.
+
+        Parameters
+        ----------
+        end_date : int
+        data_api : BaseDataServer, optional
+        register_funcs : dict, optional
+            Custom functions used by formulas, {"name1": func1}.
+            Functions registered in add_formula of this session are used by default.
+
+        Returns
+        -------
+        bool
+            whether new dates are added.
+
+        """
+        update = self._query_update(end_date, data_api, register_funcs)
+        if update is None:
+            return False
+        new_d = update['data_d']
+        if self._store_d is not None:
+            self._store_d.append_rows(new_d)
+            self._data_d = None
+        else:
+            df_new = new_d.to_frame(fields=self._data_fields()).reindex(columns=self.data_d.columns)
+            self.data_d = pd.concat([self.data_d, df_new], axis=0)
+        self._apply_update(update)
+        return True
+
+    def update_dataview(self, folder_path, end_date, data_api=None, register_funcs=None):
+        """
+        Update dataview saved in folder_path to end_date, and load it.
+
+        For dataviews saved with data_format='memmap', rows of new dates are appended to the end of each field file
+        in place, so time cost depends on the number of new dates, not the length of history.
+        Dataviews saved with data_format='hdf5' are loaded, refreshed and saved again.
+        See refresh_data for parameters.
+
+        Parameters
+        ----------
+        folder_path : str or unicode
+        end_date : int
+        data_api : BaseDataServer, optional
+        register_funcs : dict, optional
+
+        Returns
+        -------
+        bool
+            whether new dates are added.
+
+        """
+        self.load_dataview(folder_path)
+        path_d = os.path.join(folder_path, 'data_d')
+        if not FieldStore.exists(path_d):
+            # hdf5格式无法追加, 整体重写
+            updated = self.refresh_data(end_date, data_api, register_funcs)
+            if updated:
+                self.save_dataview(folder_path)
+            return updated
+
+        update = self._query_update(end_date, data_api, register_funcs)
+        if update is None:
+            return False
+        # 释放对原文件的内存映射后再写入
+        self._store_d = self._store_q = None
+        self._data_d = self._data_q = None
+        FieldStore.append_saved(path_d, update['data_d'])
+        self._store_d = FieldStore.load(path_d)
+        self._apply_update(update)
+
+        # data_q及其余数据较小, 直接重写
+        path_q = os.path.join(folder_path, 'data_q')
+        if FieldStore.exists(path_q):
+            shutil.rmtree(path_q)
+        if self._store_q is not None:
+            self._store_q.save(path_q)
+        data_to_store = {'data_benchmark': self.data_benchmark, 'data_inst': self.data_inst}
+        self._save_h5(os.path.join(folder_path, 'data.hd5'),
+                      {k: v for k, v in data_to_store.items() if v is not None})
+        jutil.save_json({key: self.__dict__[key] for key in self.meta_data_list},
+                        os.path.join(folder_path, 'meta_data.json'))
+        print("Dataview in %s has been updated to %s." % (os.path.abspath(folder_path), self.end_date))
+        return True
+
+    def _apply_update(self, update):
+        if update['data_q'] is not None:
+            self.data_q = update['data_q']
+        if update['data_benchmark'] is not None:
+            self._data_benchmark = update['data_benchmark']
+        self.end_date = update['end_date']
+
+
+    def _query_update(self, end_date, data_api=None, register_funcs=None):
+        """
+        查询end_date之后的新数据, 并在新数据上重新计算公式字段.
+
+        Returns
+        -------
+        dict or None
+            data_d : FieldStore, 新增日期的全部日度字段
+            data_q : pd.DataFrame or None, 合并后的全部季度数据
+            data_benchmark : pd.DataFrame or None, 合并后的基准数据
+            end_date : int
+            没有新的日期时返回None
+
+        """
+        if data_api is not None:
+            self.data_api = data_api
+        if self.data_api is None:
+            raise ValueError("refresh_data需要data_api.")
+        if end_date <= self.end_date:
+            print("Dataview's end_date is already %s." % self.end_date)
+            return None
+        if self.adjust_mode == 'pre':
+            print("NOTE: adjust_mode is [pre adjust], adjusted prices of existing dates are not updated.")
+
+        old_end = self.end_date
+        funcs = self._check_formula_funcs(self.formulas, register_funcs)
+        order = self._formula_order()
+
+        # 1. 用相同的配置查询新日期的预定义字段
+        custom_fields = set(self.custom_daily_fields) | set(self.custom_quarterly_fields) | set(self.formulas)
+        fields = [f for f in self.fields if f not in custom_fields and self._is_predefined_field(f)]
+        new_dates = self.data_api.query_trade_dates(old_end, end_date)
+        new_dates = new_dates[new_dates > old_end]
+        if len(new_dates) == 0:
+            print("No trade dates after %s." % old_end)
+            return None
+        dv = self.__class__()
+        props = self._config_props(int(new_dates[0]), end_date, fields=fields)
+        props['backend'] = FIELD_STORE_BACKEND
+        dv.init_from_config(props, data_api=self.data_api)
+        # 公式需要的历史数据从已有数据中截取, 只查询新的日期
+        dv.extended_start_date_d = dv.start_date
+        dv.prepare_data()
+        if not len(dv.dates) or dv.dates[-1] <= old_end:
+            print("No data after %s." % old_end)
+            return None
+
+        # 2. 截取公式需要的历史数据, 与新数据拼接后重新计算公式字段
+        lookback = self._formula_window(order)
+        begin = 0 if lookback is None else max(len(self.dates) - lookback, 0)
+        if self._store_d is not None:
+            window = self._store_d.slice(start_date=self.dates[begin] if begin < len(self.dates) else old_end + 1)
+        else:
+            window = FieldStore.from_frame(self.data_d.iloc[begin:])
+        window.append_rows(dv._store_d.slice(start_date=old_end + 1))
+        if not self._window_exact(order, window, begin):
+            begin = 0
+            window = self._store_d.slice() if self._store_d is not None else FieldStore.from_frame(self.data_d)
+            window.append_rows(dv._store_d.slice(start_date=old_end + 1))
+        hist_len = len(self.dates) - begin
+
+        data_q = None
+        if self._has_data(is_quarterly=True):
+            data_q = self.data_q
+            if dv._store_q is not None:
+                new_q = dv.data_q.reindex(columns=data_q.columns)
+                index_name = data_q.index.name
+                data_q = new_q.combine_first(data_q)
+                data_q.index.name = index_name
+
+        tail = self._compute_formulas(window, hist_len, data_q, order, funcs)
+
+        data_benchmark = self._data_benchmark
+        if data_benchmark is not None and dv.data_benchmark is not None:
+            data_benchmark = pd.concat([data_benchmark, dv.data_benchmark.loc[old_end + 1:]], axis=0)
+        return {'data_d': window.slice(start_date=old_end + 1),
+                'data_q': tail.data_q,
+                'data_benchmark': data_benchmark,
+                'end_date': int(window.dates[-1])}
+
+    def _query_local_blocks(self, fields):
+        """
+        从LocalDataService按宽表数据块读取行情及日度指标字段.
+
+        Parameters
+        ----------
+        fields : list of str
+
+        Returns
+        -------
+        blocks : list of pd.DataFrame
+            columns为(symbol, field)的宽表, 可直接用于_merge_data
+        rest : list of str
+            需要通过_query_data查询的其余字段
+
+        """
+        def to_frame(field, data, dates, symbols):
+            cols = pd.MultiIndex.from_product([symbols, [field]], names=['symbol', 'field'])
+            index = pd.Index(dates.astype(int), name=self.TRADE_DATE_FIELD_NAME)
+            return pd.DataFrame(data, index=index, columns=cols)
+
+        blocks = []
+        fields_market_daily = self._get_fields('market_daily', fields)
+        fields_ref_daily = self._get_fields('ref_daily', fields)
+
+        if fields_market_daily:
+            print("NOTE: price adjust method is [{:s} adjust]".format(self.adjust_mode))
+            raw_fields = [f for f in fields_market_daily if not f.endswith('_adj')]
+            raw_fields = list(set(raw_fields + [self.TRADE_STATUS_FIELD_NAME]))
+            for field, data, dates, symbols in self.data_api.daily_blocks(
+                    self.symbol, self.extended_start_date_d, self.end_date,
+                    fields=list(raw_fields), adjust_mode=None):
+                if field in raw_fields:
+                    blocks.append(to_frame(field, data, dates, symbols))
+
+            adj_fields = [f for f in fields_market_daily if f.endswith('_adj')]
+            if self.all_price and adj_fields:
+                for field, data, dates, symbols in self.data_api.daily_blocks(
+                        self.symbol, self.extended_start_date_d, self.end_date,
+                        fields=list(raw_fields), adjust_mode=self.adjust_mode):
+                    if field + '_adj' in adj_fields:
+                        blocks.append(to_frame(field + '_adj', data, dates, symbols))
+
+        if fields_ref_daily:
+            for field, data, dates, symbols in self.data_api.daily_blocks(
+                    self.symbol, self.extended_start_date_d, self.end_date,
+                    fields=list(fields_ref_daily), view='SecDailyIndicator'):
+                if field in fields_ref_daily:
+                    blocks.append(to_frame(field, data, dates, symbols))
+
+        done = set(fields_market_daily) | set(fields_ref_daily)
+        rest = [f for f in fields if f not in done]
+        return blocks, rest
+
     # data_q存在NaN时会导致合并数据丢失，这里做用前值填充data_q的处理
     def _prepare_daily_quarterly(self, fields, report_type='408001000'):
         if not fields:
@@ -687,7 +1648,14 @@ class DataView(OriginDataView):
 
         # query data
         print("Query data - query...")
-        daily_list, quarterly_list = self._query_data(self.symbol, fields, report_type)
+        daily_blocks = []
+        if isinstance(self.data_api, LocalDataService) and self.freq == 1:
+            # 本地数据直接以宽表数据块合并, 跳过 宽表->长表->宽表 的转换
+            daily_blocks, fields = self._query_local_blocks(fields)
+        if fields:
+            daily_list, quarterly_list = self._query_data(self.symbol, fields, report_type)
+        else:
+            daily_list, quarterly_list = [], []
 
         def pivot_and_sort(df, index_name):
             df = self._process_index_co(df, index_name)
@@ -701,8 +1669,9 @@ class DataView(OriginDataView):
 
         multi_daily = None
         multi_quarterly = None
-        if daily_list:
+        if daily_list or daily_blocks:
             daily_list_pivot = [pivot_and_sort(df, self.TRADE_DATE_FIELD_NAME) for df in daily_list]
+            daily_list_pivot.extend(daily_blocks)
             multi_daily = self._merge_data(daily_list_pivot, self.TRADE_DATE_FIELD_NAME)
             # use self.dates as index because original data have weekends
             multi_daily = self._fill_missing_idx_col(multi_daily, index=self.dates, symbols=self.symbol)
@@ -758,7 +1727,16 @@ class DataView(OriginDataView):
         if not end_date:
             end_date = self.end_date
 
-        res = self.data_d.loc[pd.IndexSlice[start_date: end_date], pd.IndexSlice[symbol, fields]]
+        if self._store_d is not None:
+            res = self._store_d.to_frame(fields=None if isinstance(fields, slice) else fields,
+                                         symbols=None if isinstance(symbol, slice) else symbol,
+                                         start_date=start_date, end_date=end_date)
+        else:
+            res = self.data_d.loc[pd.IndexSlice[start_date: end_date], pd.IndexSlice[symbol, fields]]
+        return self._convert_date_index(res, date_type)
+
+    @staticmethod
+    def _convert_date_index(res, date_type):
         if date_type!="int":
             format = '%Y%m%d' if len(str(res.index[0])) == 8 else '%Y%m%d%H%M%S'
             res.index = pd.to_datetime(res.index, format=format)
@@ -793,8 +1771,19 @@ class DataView(OriginDataView):
         -------
         res : pd.DataFrame
             Index is int date, column is symbol.
+            When backend is 'field_store' and symbol is not given, it is a read-only view of the stored array,
+            copy it before modifying values in place.
 
         """
+        if self._store_d is not None:
+            if not start_date:
+                start_date = self.start_date
+            if not end_date:
+                end_date = self.end_date
+            res = self._store_d.get(field, symbols=symbol.split(',') if symbol else None,
+                                    start_date=start_date, end_date=end_date)
+            return self._convert_date_index(res, date_type)
+
         res = self.get(symbol, start_date=start_date, end_date=end_date, fields=field, date_type=date_type)
         if res is None:
             print("No data. for start_date={}, end_date={}, field={}, symbol={}".format(start_date,
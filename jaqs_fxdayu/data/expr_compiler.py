@@ -0,0 +1,511 @@
+# encoding: utf-8
+"""
+把Parser.parse得到的逆波兰表达式编译为计算图(DAG)后执行.
+
+- 重复出现的子表达式只计算一次;
+- 四则运算, 比较, 逻辑运算及Sin, Log等逐元素运算直接在np.ndarray上进行, 中间结果只在最后一次使用时原地复用,
+  运算之间不构造DataFrame;
+- 只有调用Ts_Mean, Rank等函数时才构造DataFrame;
+- 多个表达式可以通过IntermediateCache共用相同子表达式的结果.
+
+计算结果与Parser逐个token解释执行的结果完全一致: 每一步之后的inf同样替换为NaN(只对可能产生inf的运算原地处理),
+索引需要对齐(reindex_df, align)或数据类型不是float64时调用原来的运算函数.
+
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from jaqs.data.py_expression_eval import TNUMBER, TOP1, TOP2, TVAR, TFUNCALL
+
+# 可以直接在float64数组上计算的运算, 结果与DataFrame的运算相同.
+# '^'不在其中: 不同版本的pandas中np.power(df, 0.5)可能按df ** 0.5(即sqrt)计算, 结果有细微差别
+_ARITH_OPS = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.true_divide}
+_COMPARE_OPS = {'==': np.equal, '!=': np.not_equal, '>': np.greater, '<': np.less,
+                '>=': np.greater_equal, '<=': np.less_equal, '&&': np.logical_and, '||': np.logical_or}
+_UFUNCS = (np.sin, np.cos, np.tan, np.sqrt, np.log, np.abs, np.ceil, np.floor, np.round, np.sign, np.exp)
+# 输入不含inf时结果也不含inf, 不需要再替换inf
+_FINITE_UFUNCS = (np.sin, np.cos, np.abs, np.ceil, np.floor, np.round, np.sign, np.negative)
+# 输入不含inf时结果也不含inf的函数(排名, 分位数, 取值及移动等), 结果不需要再检查inf.
+# 为默认(camel)风格的函数名, Parser初始化时转换为函数对象(Parser.finite_funcs)
+FINITE_FUNCS = frozenset(['Rank', 'Percentile', 'Quantile', 'GroupRank', 'GroupPercentile', 'GroupQuantile',
+                          'ConditionRank', 'ConditionPercentile', 'ConditionQuantile', 'Delay', 'Mask', 'If',
+                          'IsNan', 'CountNans', 'Min', 'Max', 'Ts_Min', 'Ts_Max', 'Ts_Argmax', 'Ts_Argmin',
+                          'Ts_Rank', 'Ts_Percentile', 'Ts_Quantile'])
+
+
+_OP_KINDS = ('op1', 'op2', 'call')
+
+
+class CompileError(Exception):
+    """表达式无法编译, 使用Parser解释执行."""
+    pass
+
+
+class _Node(object):
+    __slots__ = ('kind', 'name', 'args')
+
+    def __init__(self, kind, name, args=()):
+        self.kind = kind
+        self.name = name
+        self.args = tuple(args)
+
+
+class _Frame(object):
+    """运行时的float64二维数据, 与DataFrame共享index及columns."""
+    __slots__ = ('values', 'index', 'columns', 'owned')
+
+    def __init__(self, values, index, columns, owned):
+        self.values = values
+        self.index = index
+        self.columns = columns
+        # 数组由计算过程创建, 可以原地修改
+        self.owned = owned
+
+    def to_frame(self, copy):
+        values = self.values.copy() if copy else self.values
+        return pd.DataFrame(values, index=self.index, columns=self.columns, copy=False)
+
+
+def _is_float_frame(df):
+    return isinstance(df, pd.DataFrame) and len(df.columns) > 0 and df.columns.is_unique \
+        and (df.dtypes == np.float64).all()
+
+
+def _clean_inplace(arr):
+    inf = np.isinf(arr)
+    if inf.any():
+        arr[inf] = np.nan
+    return arr
+
+
+def fillinf_frame(df, owned):
+    """
+    把inf替换为NaN, 与jaqs.util.fillinf相同.
+    float64的DataFrame没有inf时返回df本身; owned为True(df由计算过程创建)时原地替换, 否则只在有inf时拷贝.
+    """
+    if _is_float_frame(df):
+        values = df.values
+        inf = np.isinf(values)
+        if not inf.any():
+            return df
+        if not (owned and values.flags.writeable):
+            values = values.copy()
+        values[inf] = np.nan
+        return pd.DataFrame(values, index=df.index, columns=df.columns, copy=False)
+    try:
+        return df.replace([np.inf, -np.inf], np.nan)
+    except Exception:
+        return df
+
+
+def _fillinf(res, check=True):
+    """
+    与fillinf_frame(res, owned=True)相同, float64的DataFrame转换为_Frame.
+    check为False时res不含inf, 只做转换.
+    """
+    if _is_float_frame(res):
+        values = res.values
+        if not values.flags.writeable:
+            values = values.copy()
+        if check:
+            _clean_inplace(values)
+        return _Frame(values, res.index, res.columns, owned=True)
+    try:
+        return res.replace([np.inf, -np.inf], np.nan)
+    except Exception:
+        return res
+
+
+class CompiledExpression(object):
+    """
+    编译后的表达式.
+
+    Parameters
+    ----------
+    nodes : list of _Node
+        按计算顺序排列, 每个节点的参数为之前节点的位置
+    output : int
+        结果节点的位置
+
+    """
+
+    def __init__(self, nodes, output):
+        self.nodes = nodes
+        self.output = output
+        # 节点的结构, 不同表达式中结构相同的节点计算结果相同
+        self.keys = []
+        for node in nodes:
+            if node.kind == 'num':
+                key = (node.kind, type(node.name), node.name)
+            else:
+                key = (node.kind, node.name, tuple(self.keys[arg] for arg in node.args))
+            self.keys.append(key)
+
+    @property
+    def shared_keys(self):
+        """可以在表达式之间共用结果的节点(运算及函数调用)的结构."""
+        return set(key for node, key in zip(self.nodes, self.keys) if node.kind in _OP_KINDS)
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        """
+        由Parser.parse生成的tokens构造计算图, 结构相同的子表达式合并为同一个节点.
+
+        Raises
+        ------
+        CompileError
+
+        """
+        nodes = []
+        keys = {}
+
+        def add(kind, name, args=()):
+            key = (kind, name, tuple(args))
+            if kind == 'num':
+                key = (kind, type(name), name)
+            if key not in keys:
+                keys[key] = len(nodes)
+                nodes.append(_Node(kind, name, args))
+            return keys[key]
+
+        # 栈中的元素: ('node', 位置), ('name', 变量或函数名), ('args', [位置])
+        stack = []
+        try:
+            for item in tokens:
+                type_ = item.type_
+                if type_ == TNUMBER:
+                    if isinstance(item.number_, list):
+                        raise CompileError("不支持无参数的函数调用")
+                    stack.append(('node', add('num', item.number_)))
+                elif type_ == TVAR:
+                    stack.append(('name', item.index_))
+                elif type_ == TOP1:
+                    stack.append(('node', add('op1', item.index_, [_as_node(stack.pop(), add)])))
+                elif type_ == TOP2:
+                    right = stack.pop()
+                    left = stack.pop()
+                    if item.index_ == ',':
+                        args = left[1] if left[0] == 'args' else [_as_node(left, add)]
+                        stack.append(('args', args + [_as_node(right, add)]))
+                    else:
+                        stack.append(('node', add('op2', item.index_, [_as_node(left, add), _as_node(right, add)])))
+                elif type_ == TFUNCALL:
+                    args = stack.pop()
+                    func = stack.pop()
+                    if func[0] != 'name':
+                        raise CompileError("调用的对象不是函数名")
+                    args = args[1] if args[0] == 'args' else [_as_node(args, add)]
+                    stack.append(('node', add('call', func[1], args)))
+                else:
+                    raise CompileError("invalid Expression")
+        except IndexError:
+            raise CompileError("invalid Expression")
+        if len(stack) != 1:
+            raise CompileError("invalid Expression (parity)")
+        return cls(nodes, _as_node(stack[0], add))
+
+    def run(self, parser, values, cache=None):
+        """
+        计算表达式, parser的ann_dts, trade_dts, index_member须已设置.
+
+        Parameters
+        ----------
+        parser : Parser
+            提供运算及函数的实现
+        values : dict
+            变量名 -> pd.DataFrame
+        cache : IntermediateCache, optional
+            使用相同values计算的表达式之间共用的中间结果
+
+        Returns
+        -------
+        pd.DataFrame or scalar
+
+        """
+        needed, hits = self._plan(cache)
+        uses = [0] * len(self.nodes)
+        for i, node in enumerate(self.nodes):
+            if needed[i] and i not in hits and node.kind in _OP_KINDS:
+                for arg in node.args:
+                    uses[arg] += 1
+        uses[self.output] += 1
+
+        executor = _Executor(parser, values)
+        results = [None] * len(self.nodes)
+        for i, node in enumerate(self.nodes):
+            if not needed[i]:
+                continue
+            if i in hits:
+                res = hits[i]
+            elif node.kind == 'num':
+                res = node.name
+            elif node.kind == 'var':
+                res = executor.load_var(node.name)
+            else:
+                args = []
+                for arg in node.args:
+                    uses[arg] -= 1
+                    # 最后一次使用时可以原地修改
+                    args.append((results[arg], uses[arg] == 0))
+                if node.kind == 'op1':
+                    res = executor.op1(node.name, args[0])
+                elif node.kind == 'op2':
+                    res = executor.op2(node.name, args[0], args[1])
+                else:
+                    res = executor.call(node.name, args)
+                for arg in node.args:
+                    if uses[arg] == 0:
+                        results[arg] = None
+                if cache is not None and isinstance(res, _Frame) and cache.wants(self.keys[i]):
+                    # 缓存中的结果不能再原地修改
+                    res = _Frame(res.values, res.index, res.columns, owned=False)
+                    cache.store(self.keys[i], res)
+            results[i] = res
+        out = results[self.output]
+        if cache is not None:
+            cache.release(self.shared_keys)
+        if isinstance(out, _Frame):
+            # 与Parser.evaluate一样总是返回新的DataFrame
+            return out.to_frame(copy=not out.owned)
+        return out
+
+    def _plan(self, cache):
+        """需要计算的节点, 及可以从cache中取得结果的节点."""
+        needed = [False] * len(self.nodes)
+        needed[self.output] = True
+        hits = {}
+        for i in range(len(self.nodes) - 1, -1, -1):
+            if not needed[i]:
+                continue
+            node = self.nodes[i]
+            if cache is not None and node.kind in _OP_KINDS:
+                value = cache.lookup(self.keys[i])
+                if value is not None:
+                    hits[i] = value
+                    continue
+            for arg in node.args:
+                needed[arg] = True
+        return needed, hits
+
+
+class IntermediateCache(object):
+    """
+    多个表达式共用的中间结果.
+
+    Parameters
+    ----------
+    counts : dict
+        节点结构(CompiledExpression.keys中的元素) -> 使用该节点的表达式个数. 只缓存被多个表达式使用的节点,
+        所有使用者计算完成后释放.
+    memory_limit : int, optional
+        缓存结果的总字节数上限, 超过时释放最久未使用的结果. 默认不限制.
+
+    """
+
+    def __init__(self, counts, memory_limit=None):
+        self.counts = dict(counts)
+        self.memory_limit = memory_limit
+        self.nbytes = 0
+        self._items = OrderedDict()
+
+    @classmethod
+    def from_expressions(cls, expressions, memory_limit=None):
+        """
+        Parameters
+        ----------
+        expressions : list of CompiledExpression
+            之后使用该缓存计算的表达式, 每个表达式计算一次.
+        memory_limit : int, optional
+
+        """
+        counts = {}
+        for expr in expressions:
+            for key in expr.shared_keys:
+                counts[key] = counts.get(key, 0) + 1
+        return cls(dict((key, n) for key, n in counts.items() if n > 1), memory_limit=memory_limit)
+
+    def wants(self, key):
+        # 当前表达式之后还有其他表达式使用
+        return self.counts.get(key, 0) > 1 and key not in self._items
+
+    def lookup(self, key):
+        if key not in self._items:
+            return None
+        # 移到最近使用的位置
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def store(self, key, value):
+        nbytes = value.values.nbytes
+        if self.memory_limit is not None:
+            if nbytes > self.memory_limit:
+                return
+            while self._items and self.nbytes + nbytes > self.memory_limit:
+                self._discard(next(iter(self._items)))
+        self._items[key] = value
+        self.nbytes += nbytes
+
+    def release(self, keys):
+        """一个表达式计算完成, 不再被使用的结果从缓存中删除."""
+        for key in keys:
+            if key in self.counts:
+                self.counts[key] -= 1
+                if self.counts[key] <= 0:
+                    del self.counts[key]
+                    self._discard(key)
+
+    def _discard(self, key):
+        value = self._items.pop(key, None)
+        if value is not None:
+            self.nbytes -= value.values.nbytes
+
+    def __len__(self):
+        return len(self._items)
+
+
+class _Executor(object):
+    """一次计算中的运算实现."""
+
+    def __init__(self, parser, values):
+        self.parser = parser
+        self.values = values
+        self._reindex_cache = {}
+
+    def load_var(self, name):
+        if name in self.values:
+            df = self.values[name]
+            if _is_float_frame(df):
+                arr = df.values
+                if np.isinf(arr).any():
+                    return _Frame(_clean_inplace(arr.copy()), df.index, df.columns, owned=True)
+                return _Frame(arr, df.index, df.columns, owned=False)
+            return _fillinf(df)
+        elif name in self.parser.functions:
+            return self.parser.functions[name]
+        raise Exception('undefined variable: ' + name)
+
+    def _unchanged_by_reindex(self, index):
+        """Parser.reindex_df不改变该索引的数据."""
+        key = id(index)
+        if key not in self._reindex_cache:
+            parser = self.parser
+            target = None
+            labels = set(index)
+            if parser.ann_dts is not None and len(labels - set(list(parser.ann_dts))) == 0:
+                target = list(parser.ann_dts)
+            elif parser.trade_dts is not None and len(labels - set(list(parser.trade_dts))) == 0:
+                target = parser.trade_dts
+            self._reindex_cache[key] = (index, target is None or index.equals(pd.Index(target)))
+        return self._reindex_cache[key][1]
+
+    def _fast_operands(self, a, b, scalar_left):
+        """
+        a, b可以直接按数组计算时返回 (数组或标量, 数组或标量, 提供索引的_Frame), 否则返回None.
+        """
+        if isinstance(a, _Frame) and isinstance(b, _Frame):
+            if not (b.index.equals(a.index) and b.columns.equals(a.columns)):
+                return None
+            frame = a
+        elif isinstance(a, _Frame) and _is_number(b):
+            frame = a
+        elif scalar_left and _is_number(a) and isinstance(b, _Frame):
+            frame = b
+        else:
+            return None
+        if not self._unchanged_by_reindex(frame.index):
+            return None
+        return (a.values if isinstance(a, _Frame) else a,
+                b.values if isinstance(b, _Frame) else b, frame)
+
+    def op1(self, name, arg):
+        a, last = arg
+        func = self.parser.ops1[name]
+        if isinstance(a, _Frame):
+            ufunc = np.negative if name == '-' else func
+            if ufunc is np.negative or ufunc in _UFUNCS:
+                out = a.values if a.owned and last else None
+                with np.errstate(all='ignore'):
+                    if ufunc is np.round:
+                        res = np.round(a.values, 0, out=out)
+                    elif out is not None:
+                        res = ufunc(a.values, out=out)
+                    else:
+                        res = ufunc(a.values)
+                if ufunc not in _FINITE_UFUNCS:
+                    _clean_inplace(res)
+                return _Frame(res, a.index, a.columns, owned=True)
+            if name == '!':
+                res = np.logical_not(a.values).astype(float)
+                res[np.isnan(a.values)] = np.nan
+                return _Frame(res, a.index, a.columns, owned=True)
+        return _fillinf(func(_arg(a)))
+
+    def op2(self, name, left, right):
+        a, a_last = left
+        b, b_last = right
+        operands = None
+        if name in _ARITH_OPS:
+            operands = self._fast_operands(a, b, scalar_left=True)
+        elif name in _COMPARE_OPS:
+            # 原函数使用左侧的索引, 左侧为标量时报错
+            operands = self._fast_operands(a, b, scalar_left=False)
+        if operands is None:
+            return _fillinf(self.parser.ops2[name](_arg(a), _arg(b)))
+
+        x, y, frame = operands
+        if name in _COMPARE_OPS:
+            with np.errstate(invalid='ignore'):
+                res = _COMPARE_OPS[name](x, y).astype(float)
+                mask = np.logical_or(np.isnan(x), np.isnan(y))
+            res[mask] = np.nan
+            return _Frame(res, frame.index, frame.columns, owned=True)
+
+        out = None
+        if isinstance(a, _Frame) and a.owned and a_last:
+            out = x
+        elif isinstance(b, _Frame) and b.owned and b_last:
+            out = y
+        with np.errstate(all='ignore'):
+            if out is not None:
+                res = _ARITH_OPS[name](x, y, out=out)
+            else:
+                res = _ARITH_OPS[name](x, y)
+        return _Frame(_clean_inplace(res), frame.index, frame.columns, owned=True)
+
+    def call(self, name, args):
+        if name in self.values or name not in self.parser.functions:
+            raise Exception(name + ' is not a function')
+        func = self.parser.functions[name]
+        call_args = []
+        for value, last in args:
+            if isinstance(value, _Frame):
+                # 函数可能原地修改参数(如Rank, Mask), 共享的中间结果及输入数据需要拷贝
+                value = value.to_frame(copy=not (value.owned and last))
+            elif isinstance(value, pd.DataFrame) and not last:
+                value = value.copy()
+            call_args.append(value)
+        if len(call_args) == 1:
+            res = func(call_args[0])
+        else:
+            res = func(*call_args)
+        return _fillinf(res, check=func not in getattr(self.parser, 'finite_funcs', ()))
+
+
+def _is_number(x):
+    return isinstance(x, (int, float, np.integer, np.floating)) and not isinstance(x, (bool, np.bool_))
+
+
+def _arg(value):
+    return value.to_frame(copy=False) if isinstance(value, _Frame) else value
+
+
+def _as_node(item, add):
+    kind, value = item
+    if kind == 'node':
+        return value
+    if kind == 'name':
+        return add('var', value)
+    raise CompileError("函数参数列表不能用于运算")
@@ -0,0 +1,620 @@
+# encoding: utf-8
+"""
+按字段存储的DataView数据.
+
+每个字段是一个连续的 date x symbol 二维np.ndarray, 所有字段共享同一组日期与symbol索引.
+增删字段不需要重建其他字段的数据, 读取单个字段时直接在数组上构造DataFrame, 不发生拷贝.
+字段也可以延迟加载: 只登记读取函数, 首次访问时才从磁盘读取, 已加载的字段按LRU控制内存占用.
+
+"""
+import os
+import struct
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+COLUMN_LEVELS = ['symbol', 'field']
+
+# FieldStore.save保存的索引文件名
+STORE_INDEX_FILE = 'index.npz'
+
+
+class FieldStore(object):
+    """
+    字段 -> date x symbol 二维数组.
+
+    Parameters
+    ----------
+    dates : array-like
+        有序的日期索引
+    symbols : array-like
+    index_name : str, optional
+    memory_limit : int, optional
+        延迟加载的字段在内存中的总字节数上限, 超出时释放最久未使用的字段(之后访问会重新读取).
+        默认不限制. 通过set添加的字段不受限制, 也不会被释放.
+
+    Attributes
+    ----------
+    dates : pd.Index
+    symbols : pd.Index
+
+    """
+
+    def __init__(self, dates, symbols, index_name='trade_date', memory_limit=None):
+        self.dates = pd.Index(dates, name=index_name)
+        self.symbols = pd.Index(symbols, name=COLUMN_LEVELS[0])
+        self.memory_limit = memory_limit
+        self._data = OrderedDict()
+        # 延迟加载的字段 -> 读取函数
+        self._loaders = OrderedDict()
+        # 已加载的延迟字段 -> 字节数, 按最近访问排序
+        self._loaded = OrderedDict()
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        由columns为(symbol, field)的宽表构造.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+
+        Returns
+        -------
+        FieldStore
+
+        """
+        columns = df.columns.remove_unused_levels()
+        symbols = columns.levels[0]
+        store = cls(df.index, symbols, index_name=df.index.name)
+        # pandas 0.24之前为labels
+        codes = getattr(columns, 'codes', None)
+        if codes is None:
+            codes = columns.labels
+        symbol_codes = np.asarray(codes[0])
+        field_codes = np.asarray(codes[1])
+        for k, field in enumerate(columns.levels[1]):
+            pos = np.flatnonzero(field_codes == k)
+            values = df.iloc[:, pos].values
+            sym = symbol_codes[pos]
+            if len(sym) == len(symbols) and (sym == np.arange(len(symbols))).all():
+                arr = np.ascontiguousarray(values)
+            else:
+                # 字段缺少部分symbol, 或symbol顺序与levels不一致
+                dtype = values.dtype if values.dtype.kind in 'fcO' else np.float64
+                arr = np.full((len(df), len(symbols)), np.nan, dtype=dtype)
+                arr[:, sym] = values
+            store._data[field] = arr
+        return store
+
+    @property
+    def fields(self):
+        return list(self._data.keys()) + [f for f in self._loaders if f not in self._data]
+
+    @property
+    def loaded_fields(self):
+        """已在内存中的字段."""
+        return list(self._data.keys())
+
+    def __contains__(self, field):
+        return field in self._data or field in self._loaders
+
+    def __len__(self):
+        return len(self.fields)
+
+    def add_lazy(self, field, loader):
+        """
+        登记延迟加载的字段.
+
+        Parameters
+        ----------
+        field : str
+        loader : callable
+            无参数, 返回与dates, symbols对齐的二维数组
+
+        """
+        self._forget(field)
+        self._loaders[field] = loader
+
+    def _forget(self, field):
+        self._data.pop(field, None)
+        self._loaders.pop(field, None)
+        self._loaded.pop(field, None)
+
+    def _array(self, field):
+        if field in self._loaded:
+            # python2的OrderedDict没有move_to_end
+            self._loaded[field] = self._loaded.pop(field)
+            return self._data[field]
+        if field in self._data:
+            return self._data[field]
+        arr = np.ascontiguousarray(self._loaders[field]())
+        if arr.shape != (len(self.dates), len(self.symbols)):
+            raise ValueError("字段%s的形状%s与索引(%d, %d)不一致"
+                             % (field, arr.shape, len(self.dates), len(self.symbols)))
+        self._data[field] = arr
+        self._loaded[field] = arr.nbytes
+        self._evict(keep=field)
+        return arr
+
+    def _evict(self, keep):
+        if self.memory_limit is None:
+            return
+        total = sum(self._loaded.values())
+        for field in list(self._loaded.keys()):
+            if total <= self.memory_limit:
+                break
+            if field == keep:
+                continue
+            total -= self._loaded.pop(field)
+            del self._data[field]
+
+    def set(self, field, df):
+        """
+        添加或覆盖字段, df按已有的日期与symbol对齐, 缺失处为NaN.
+
+        Parameters
+        ----------
+        field : str
+        df : pd.DataFrame
+            index为日期, columns为symbol
+
+        """
+        if not (df.index.equals(self.dates) and df.columns.equals(self.symbols)):
+            df = df.reindex(index=self.dates, columns=self.symbols)
+        self._forget(field)
+        self._data[field] = np.ascontiguousarray(df.values)
+
+    def update(self, field, df):
+        """
+        写入df中的值, 其余位置不变.
+
+        Parameters
+        ----------
+        field : str
+            已有的字段
+        df : pd.DataFrame
+            index与columns须为已有的日期与symbol
+
+        """
+        rows = self.dates.get_indexer(df.index)
+        cols = self.symbols.get_indexer(df.columns)
+        if (rows < 0).any() or (cols < 0).any():
+            raise KeyError("写入字段%s的日期或symbol不存在" % field)
+        arr = self._array(field)
+        values = df.values
+        dtype = np.result_type(arr.dtype, values.dtype)
+        if dtype != arr.dtype or not arr.flags.writeable:
+            arr = arr.astype(dtype)
+        arr[np.ix_(rows, cols)] = values
+        # 写入后不再延迟加载, 避免被释放后重新读取丢失修改
+        self._forget(field)
+        self._data[field] = arr
+
+    def remove(self, field):
+        if field not in self:
+            raise KeyError(field)
+        self._forget(field)
+
+    def values(self, field):
+        """字段的二维数组(不拷贝)."""
+        return self._array(field)
+
+    def _locate(self, symbols=None, start_date=None, end_date=None):
+        rows = self.dates.slice_indexer(start_date, end_date)
+        if symbols is None:
+            cols = slice(None)
+            columns = self.symbols
+        else:
+            cols = self.symbols.get_indexer(symbols)
+            if (cols < 0).any():
+                raise KeyError("symbol不存在: %s" % list(np.asarray(symbols)[cols < 0]))
+            columns = self.symbols[cols]
+        return rows, cols, columns
+
+    def get(self, field, symbols=None, start_date=None, end_date=None):
+        """
+        读取单个字段.
+
+        不指定symbols时返回的DataFrame直接引用底层数组(不拷贝), 数组为只读, 原地修改前须先拷贝.
+
+        Parameters
+        ----------
+        field : str
+        symbols : list of str, optional
+        start_date, end_date : int, optional
+            闭区间, 与DataFrame.loc一致
+
+        Returns
+        -------
+        pd.DataFrame
+            index为日期, columns为symbol
+
+        """
+        rows, cols, columns = self._locate(symbols, start_date, end_date)
+        index = self.dates[rows]
+        if field not in self:
+            return pd.DataFrame(index=index, columns=pd.Index([], name=columns.name))
+        arr = self._array(field)[rows]
+        if symbols is not None:
+            arr = arr[:, cols]
+        else:
+            # 只读的视图, 调用方原地赋值时报错, 不会修改store及保存的文件
+            arr.flags.writeable = False
+        return pd.DataFrame(arr, index=index, columns=columns, copy=False)
+
+    def to_frame(self, fields=None, symbols=None, start_date=None, end_date=None):
+        """
+        构造columns为(symbol, field)的宽表, 默认包含全部数据且已排序, 与原data_d/data_q格式一致.
+
+        Parameters
+        ----------
+        fields : list of str, optional
+            默认为全部字段, 不存在的字段被忽略; 指定时按给定的顺序
+        symbols : list of str, optional
+            默认为全部symbol; 指定时按给定的顺序
+        start_date, end_date : int, optional
+
+        Returns
+        -------
+        pd.DataFrame
+
+        """
+        if fields is None:
+            fields = sorted(self.fields)
+        else:
+            fields = [f for f in pd.unique(fields) if f in self]
+        rows, cols, columns = self._locate(symbols, start_date, end_date)
+        index = self.dates[rows]
+        multi_columns = pd.MultiIndex.from_product([columns, fields], names=COLUMN_LEVELS)
+
+        arrays = []
+        for field in fields:
+            arr = self._array(field)[rows]
+            if symbols is not None:
+                arr = arr[:, cols]
+            arrays.append(arr)
+        if not arrays:
+            return pd.DataFrame(index=index, columns=multi_columns)
+        if len(set(arr.dtype for arr in arrays)) == 1:
+            # 同类型字段按 (date, symbol, field) 排列后reshape, 列顺序即为from_product的顺序
+            values = np.stack(arrays, axis=2).reshape(len(index), len(columns) * len(fields))
+            return pd.DataFrame(values, index=index, columns=multi_columns)
+        frames = [pd.DataFrame(arr, index=index,
+                               columns=pd.MultiIndex.from_product([columns, [field]], names=COLUMN_LEVELS))
+                  for field, arr in zip(fields, arrays)]
+        return pd.concat(frames, axis=1).reindex(columns=multi_columns)
+
+    def slice(self, start_date=None, end_date=None):
+        """
+        按日期截取, 各字段为原数组的视图, 未加载的字段仍延迟加载.
+
+        Returns
+        -------
+        FieldStore
+
+        """
+        rows = self.dates.slice_indexer(start_date, end_date)
+        store = FieldStore(self.dates[rows], self.symbols, index_name=self.dates.name,
+                           memory_limit=self.memory_limit)
+        for field in self.fields:
+            if field in self._loaders:
+                store.add_lazy(field, partial(_slice_rows, self._loaders[field], rows))
+            else:
+                store._data[field] = self._data[field][rows]
+        return store
+
+    def save(self, folder):
+        """
+        按字段保存为 folder/<field>.npy, 日期与symbol索引保存在 folder/index.npz.
+
+        数值字段以原始数组保存(不压缩), 可由load以内存映射方式读取.
+
+        Parameters
+        ----------
+        folder : str
+
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        fields = self.fields
+        np.savez(os.path.join(folder, STORE_INDEX_FILE),
+                 dates=self.dates.values, symbols=np.asarray(self.symbols, dtype=str),
+                 fields=np.asarray(fields, dtype=str),
+                 index_name=np.asarray([self.dates.name or ''], dtype=str))
+        for field in fields:
+            arr = self._array(field)
+            np.save(os.path.join(folder, field + '.npy'), arr, allow_pickle=arr.dtype.kind == 'O')
+
+    @classmethod
+    def load(cls, folder, mmap_mode='c'):
+        """
+        读取save保存的数据, 数值字段为np.memmap, 不拷贝到内存, 多个进程读取同一文件时共享系统页缓存.
+
+        Parameters
+        ----------
+        folder : str
+        mmap_mode : {'c', 'r', None}
+            'c' 写入时只修改本进程的副本(默认); 'r' 只读; None 全部读入内存
+
+        Returns
+        -------
+        FieldStore
+
+        """
+        with np.load(os.path.join(folder, STORE_INDEX_FILE)) as index:
+            dates = index['dates']
+            symbols = index['symbols'].astype(object)
+            fields = list(index['fields'])
+            index_name = str(index['index_name'][0]) or None
+        store = cls(dates, symbols, index_name=index_name)
+        for field in fields:
+            path = os.path.join(folder, field + '.npy')
+            try:
+                arr = np.load(path, mmap_mode=mmap_mode)
+            except ValueError:
+                # object数组无法内存映射
+                arr = np.load(path, allow_pickle=True)
+            store._data[field] = arr
+        return store
+
+    @staticmethod
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, STORE_INDEX_FILE))
+
+    def append_rows(self, other):
+        """
+        在末尾追加other中的日期, 各字段按本store的symbol对齐, other中没有的字段或symbol为NaN.
+
+        只拷贝每个字段一次(原数组 + 新增行), other中多出的字段被忽略.
+
+        Parameters
+        ----------
+        other : FieldStore
+            日期均晚于本store的最后一个日期
+
+        """
+        _check_appended_dates(self.dates, other.dates)
+        for field in self.fields:
+            arr = self._array(field)
+            rows = _aligned_rows(other, field, self.symbols, arr.dtype)
+            self._forget(field)
+            self._data[field] = np.concatenate([arr, rows])
+        self.dates = self.dates.append(pd.Index(other.dates, name=self.dates.name))
+
+    @classmethod
+    def append_saved(cls, folder, other):
+        """
+        把other中的日期追加到save保存的数据末尾.
+
+        数值字段直接在.npy文件末尾写入新增行并更新文件头中的形状, 耗时只与新增的行数有关;
+        object字段, 或新增数据的类型无法转换为文件中的类型时, 重写该字段的文件.
+        对齐方式同append_rows.
+
+        Parameters
+        ----------
+        folder : str
+        other : FieldStore
+
+        """
+        with np.load(os.path.join(folder, STORE_INDEX_FILE)) as index:
+            dates = pd.Index(index['dates'])
+            symbols = pd.Index(index['symbols'].astype(object))
+            fields = list(index['fields'])
+            index_name = index['index_name']
+        _check_appended_dates(dates, other.dates)
+        for field in fields:
+            path = os.path.join(folder, field + '.npy')
+            with open(path, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                dtype = _read_npy_header(f, version)[2]
+            rows = _aligned_rows(other, field, symbols, dtype)
+            if not _append_npy(path, rows):
+                arr = np.concatenate([np.load(path, allow_pickle=True), rows])
+                np.save(path, arr, allow_pickle=arr.dtype.kind == 'O')
+        np.savez(os.path.join(folder, STORE_INDEX_FILE),
+                 dates=np.concatenate([dates.values, np.asarray(other.dates)]),
+                 symbols=np.asarray(symbols, dtype=str), fields=np.asarray(fields, dtype=str),
+                 index_name=index_name)
+
+
+def _slice_rows(loader, rows):
+    return loader()[rows]
+
+
+def _check_appended_dates(dates, new_dates):
+    if len(dates) and len(new_dates) and new_dates[0] <= dates[-1]:
+        raise ValueError("追加的日期%s不晚于已有的最后一个日期%s" % (new_dates[0], dates[-1]))
+
+
+def _aligned_rows(other, field, symbols, dtype):
+    """other中field的数组, 列按symbols对齐; 字段不存在时为NaN(object字段为None)."""
+    if field not in other:
+        if np.dtype(dtype).kind == 'O':
+            return np.full((len(other.dates), len(symbols)), None, dtype=object)
+        return np.full((len(other.dates), len(symbols)), np.nan)
+    if other.symbols.equals(symbols):
+        return other.values(field)
+    return other.get(field).reindex(columns=symbols).values
+
+
+def _read_npy_header(f, version):
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def _append_npy(path, rows):
+    """
+    在.npy文件末尾追加行, 原地改写文件头中的形状.
+
+    Returns
+    -------
+    bool
+        False表示无法原地追加(object或fortran数组, 类型不兼容, 或新的文件头超出原长度), 文件未被修改
+
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version not in ((1, 0), (2, 0)):
+            return False
+        shape, fortran_order, dtype = _read_npy_header(f, version)
+        offset = f.tell()
+        if fortran_order or dtype.hasobject or len(shape) != 2 or rows.shape[1:] != shape[1:] \
+                or not np.can_cast(rows.dtype, dtype, casting='same_kind'):
+            return False
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                  'shape': (shape[0] + len(rows), shape[1])}
+        # 与np.save相同的文件头格式, 用空格补齐到原长度, 数据的起始位置不变
+        header = "{%s}" % ''.join("'%s': %r, " % (k, header[k]) for k in sorted(header))
+        prefix = np.lib.format.magic(*version) + (b'\x00\x00' if version == (1, 0) else b'\x00' * 4)
+        pad = offset - len(prefix) - len(header) - 1
+        if pad < 0:
+            return False
+        header = (header + ' ' * pad + '\n').encode('latin1')
+        f.seek(0, 2)
+        f.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+        f.seek(0)
+        f.write(np.lib.format.magic(*version))
+        f.write(struct.pack('<H' if version == (1, 0) else '<I', len(header)))
+        f.write(header)
+    return True
+
+
+class HDFFrameReader(object):
+    """
+    按字段读取HDFStore中以fixed格式保存的(symbol, field)宽表, 只读取该字段所在的列.
+
+    Parameters
+    ----------
+    path : str
+        HDFStore文件路径
+    key : str
+        宽表在文件中的key, 如 'data_d'
+
+    Attributes
+    ----------
+    index : pd.Index
+    columns : pd.MultiIndex
+
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        with pd.HDFStore(path, mode='r') as h5:
+            storer = h5.get_storer(key)
+            if storer.pandas_type != 'frame':
+                raise ValueError("%s中的%s不是fixed格式的DataFrame" % (path, key))
+            self.index = storer.read_index('axis1')
+            self.columns = storer.read_index('axis0')
+            self._blocks = [storer.read_index('block%d_items' % i) for i in range(storer.nblocks)]
+
+    @property
+    def fields(self):
+        return list(self.columns.remove_unused_levels().levels[1])
+
+    def read_field(self, field, symbols):
+        """
+        读取单个字段.
+
+        Parameters
+        ----------
+        field : str
+        symbols : pd.Index
+            输出数组的列, 文件中不存在的symbol为NaN
+
+        Returns
+        -------
+        np.ndarray
+            len(index) x len(symbols)
+
+        """
+        import tables
+
+        parts = []
+        with pd.HDFStore(self.path, mode='r') as h5:
+            storer = h5.get_storer(self.key)
+            for i, items in enumerate(self._blocks):
+                pos = np.flatnonzero(items.get_level_values(1) == field)
+                if len(pos) == 0:
+                    continue
+                name = 'block%d_values' % i
+                node = getattr(storer.group, name)
+                transposed = getattr(node.attrs, 'transposed', False)
+                if isinstance(node, tables.Array) and getattr(node.attrs, 'value_type', None) is None:
+                    # 数值块只读取需要的列, object块(VLArray)只能整体读取
+                    values = node[:, pos.tolist()] if transposed else node[pos.tolist(), :].T
+                else:
+                    values = storer.read_array(name).T[:, pos]
+                parts.append((items.get_level_values(0)[pos], values))
+
+        if len(parts) == 1 and parts[0][0].equals(symbols):
+            return np.ascontiguousarray(parts[0][1])
+        dtypes = set(v.dtype for _, v in parts)
+        dtype = dtypes.pop() if len(dtypes) == 1 else np.dtype(object)
+        if dtype.kind not in 'fcO':
+            dtype = np.float64
+        out = np.full((len(self.index), len(symbols)), np.nan, dtype=dtype)
+        for syms, values in parts:
+            cols = symbols.get_indexer(syms)
+            valid = cols >= 0
+            out[:, cols[valid]] = values[:, valid]
+        return out
+
+    def to_store(self, memory_limit=None):
+        """
+        构造延迟加载所有字段的FieldStore.
+
+        Returns
+        -------
+        FieldStore
+
+        """
+        symbols = self.columns.remove_unused_levels().levels[0]
+        store = FieldStore(self.index, symbols, index_name=self.index.name, memory_limit=memory_limit)
+        for field in sorted(self.fields):
+            store.add_lazy(field, partial(self.read_field, field, store.symbols))
+        return store
+
+
+def load_h5_lazy(path, lazy_keys, memory_limit=None):
+    """
+    读取HDFStore文件, lazy_keys中的(symbol, field)宽表只读取索引, 字段在首次访问时读取.
+
+    Parameters
+    ----------
+    path : str
+    lazy_keys : list of str
+        如 ['/data_d', '/data_q']
+    memory_limit : int, optional
+        见FieldStore
+
+    Returns
+    -------
+    dict
+        key -> FieldStore(lazy_keys中的key) 或 pd.DataFrame(其余key)
+
+    """
+    with pd.HDFStore(path, mode='r') as h5:
+        keys = h5.keys()
+        res = {key: h5.get(key) for key in keys if key not in lazy_keys}
+
+    for key in keys:
+        if key not in lazy_keys:
+            continue
+        try:
+            reader = HDFFrameReader(path, key)
+        except (ValueError, TypeError, AttributeError):
+            reader = None
+        if reader is not None and isinstance(reader.columns, pd.MultiIndex):
+            res[key] = reader.to_store(memory_limit=memory_limit)
+        else:
+            # table格式等无法按列读取, 整体读入
+            with pd.HDFStore(path, mode='r') as h5:
+                store = FieldStore.from_frame(h5.get(key))
+            store.memory_limit = memory_limit
+            res[key] = store
+    return res
@@ -0,0 +1,221 @@
+# encoding: utf-8
+"""
+LocalDataService使用的hdf5文件句柄池.
+
+本地数据按 <view>/<field>.hd5 存放, 每个文件包含 data / symbol_flag / date_flag 三个dataset.
+句柄池负责复用已打开的文件, 并缓存解码后的symbol/date索引, 使重复查询只需要读取数据切片.
+
+"""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+
+
+# 请求的列占外接区间的比例不低于该值时, 读取整个连续区间后再在内存中取列
+DENSE_READ_RATIO = 0.5
+
+
+class H5IndexError(Exception):
+    pass
+
+
+class H5FileIndex(object):
+    """
+    已打开的hdf5数据文件及其解码后的索引.
+
+    Attributes
+    ----------
+    path : str
+    mtime : float
+        打开文件时的修改时间, 文件被更新后句柄会被重新打开.
+    dset : h5py.Dataset
+        data数据集, 行为日期, 列为symbol.
+    symbols : np.ndarray
+        dtype: str
+    dates : np.ndarray
+        dtype: int64
+    symbol_pos : dict
+        symbol -> 列号
+    date_pos : dict
+        date -> 行号
+
+    """
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        self.refs = 0
+        self.stale = False
+        self.file = h5py.File(path, 'r')
+        try:
+            self.dset = self.file['data']
+            self.symbols = self.file['symbol_flag'][:, 0].astype(str)
+            self.dates = self.file['date_flag'][:, 0].astype(np.int64)
+        except Exception as e:
+            self.file.close()
+            raise H5IndexError("error hdf5 file: %s, %s" % (path, e))
+
+        self.symbol_pos = {s: i for i, s in enumerate(self.symbols)}
+        self.date_pos = {d: i for i, d in enumerate(self.dates)}
+        self._symbol_sorter = np.argsort(self.symbols, kind='mergesort')
+        self._sorted_symbols = self.symbols[self._symbol_sorter]
+
+    def locate_symbols(self, symbol):
+        """
+        批量查找symbol所在的列号.
+
+        Parameters
+        ----------
+        symbol : list or np.ndarray
+
+        Returns
+        -------
+        np.ndarray
+            升序排列且去重的列号, 文件中不存在的symbol被忽略.
+
+        """
+        symbol = np.asarray(symbol).astype(str).ravel()
+        if len(symbol) == 0 or len(self.symbols) == 0:
+            return np.array([], dtype=np.int64)
+        pos = np.searchsorted(self._sorted_symbols, symbol)
+        pos[pos >= len(self._sorted_symbols)] = 0
+        found = self._sorted_symbols[pos] == symbol
+        return np.unique(self._symbol_sorter[pos[found]]).astype(np.int64)
+
+    def read(self, start, end, cols, name='data'):
+        """
+        读取name数据集的[start:end, cols]部分, 默认为data.
+
+        cols为连续区间时直接读取hyperslab; 较稠密时读取外接区间后在内存中取列;
+        否则才使用h5py的fancy indexing.
+
+        Parameters
+        ----------
+        start : int
+        end : int
+        cols : np.ndarray
+            升序排列的列号
+        name : str
+            数据集名称, 与data形状相同
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+        dset = self.dset if name == 'data' else self.file[name]
+        cols = np.asarray(cols, dtype=np.int64)
+        if len(cols) > 0:
+            first = int(cols[0])
+            last = int(cols[-1]) + 1
+            width = last - first
+            if width == len(cols):
+                return dset[start:end, first:last]
+            if len(cols) >= width * DENSE_READ_RATIO:
+                block = dset[start:end, first:last]
+                return np.take(block, cols - first, axis=1)
+        return dset[start:end, cols.tolist()]
+
+    def close(self):
+        # noinspection PyBroadException
+        try:
+            self.file.close()
+        except Exception:
+            pass
+
+
+class H5Pool(object):
+    """
+    按文件路径+修改时间缓存的hdf5句柄池, 超出max_size时按LRU顺序关闭空闲句柄.
+
+    Parameters
+    ----------
+    max_size : int
+        最多同时保持打开的文件数.
+
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @contextmanager
+    def open(self, path):
+        """
+        获取path对应的H5FileIndex, 使用期间句柄不会被回收.
+
+        Parameters
+        ----------
+        path : str
+
+        Yields
+        ------
+        H5FileIndex
+
+        """
+        entry = self._acquire(path)
+        try:
+            yield entry
+        finally:
+            self._release(entry)
+
+    def _acquire(self, path):
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.mtime != mtime:
+                self._discard(path)
+                entry = None
+            if entry is None:
+                entry = H5FileIndex(path, mtime)
+                self._entries[path] = entry
+            else:
+                self._entries.move_to_end(path)
+            entry.refs += 1
+            self._evict()
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            if entry.stale and entry.refs <= 0:
+                entry.close()
+            else:
+                self._evict()
+
+    def _discard(self, path):
+        entry = self._entries.pop(path)
+        entry.stale = True
+        if entry.refs <= 0:
+            entry.close()
+
+    def _evict(self):
+        if len(self._entries) <= self.max_size:
+            return
+        for path in list(self._entries.keys()):
+            if len(self._entries) <= self.max_size:
+                break
+            if self._entries[path].refs <= 0:
+                self._discard(path)
+
+    def clear(self):
+        """关闭池中所有句柄."""
+        with self._lock:
+            for path in list(self._entries.keys()):
+                self._discard(path)
+
+
+_default_pool = H5Pool()
+
+
+def default_pool():
+    return _default_pool
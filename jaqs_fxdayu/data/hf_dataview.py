@@ -1,9 +1,11 @@
 import os
+import shutil
 import numpy as np
 import pandas as pd
 from jaqs import util as jutil
 from jaqs_fxdayu.data.search_doc import FuncDoc
 from jaqs_fxdayu.data.py_expression_eval import Parser
+from jaqs_fxdayu.data.field_store import FieldStore, load_h5_lazy
 
 try:
     basestring
@@ -16,6 +18,9 @@ from jaqs_fxdayu.util.concat import quick_concat
 class HFDataView(object):
 
     def __init__(self):
+        # 延迟加载时data由按字段存储的FieldStore提供, 见load_dataview
+        self._store = None
+        self._data = None
         self.data_api = None
 
         self.universe = ""
@@ -45,6 +50,17 @@ class HFDataView(object):
 
     # --------------------------------------------------------------------------------------------------------
     # Properties
+    @property
+    def data(self):
+        if self._store is not None and self._data is None:
+            self._data = self._store.to_frame()
+        return self._data
+
+    @data.setter
+    def data(self, df):
+        self._store = None
+        self._data = df
+
     @property
     def data_benchmark(self):
         return self._data_benchmark
@@ -62,7 +78,7 @@ class HFDataView(object):
 
     @data_benchmark.setter
     def data_benchmark(self, df_new):
-        if self.data is not None and df_new.shape[0] != self.data.shape[0]:
+        if (self._store is not None or self._data is not None) and df_new.shape[0] != len(self.dates):
             raise ValueError("You must provide a DataFrame with the same shape of data_benchmark.")
         self._data_benchmark = df_new
 
@@ -77,7 +93,9 @@ class HFDataView(object):
             dtype: int
 
         """
-        if self.data is not None:
+        if self._store is not None:
+            res = self._store.dates.values
+        elif self.data is not None:
             res = self.data.index.values
         return res
 
@@ -273,7 +291,12 @@ class HFDataView(object):
                 print("Field name [{:s}] does not exist. Stop remove_field.".format(field_name))
                 return
             # remove field data
-            self.data = self.data.drop(field_name, axis=1, level=1)
+            if self._store is not None:
+                if field_name in self._store:
+                    self._store.remove(field_name)
+                    self._data = None
+            else:
+                self.data = self.data.drop(field_name, axis=1, level=1)
             self.fields.remove(field_name)
 
     def _add_field(self, field_name):
@@ -297,7 +320,10 @@ class HFDataView(object):
 
         """
 
-        exist_fields = self.data.columns.remove_unused_levels().levels[1]
+        if self._store is not None:
+            exist_fields = self._store.fields
+        else:
+            exist_fields = self.data.columns.remove_unused_levels().levels[1]
 
         if field_name in exist_fields:
             if overwrite:
@@ -315,6 +341,12 @@ class HFDataView(object):
         else:
             raise ValueError("Data to be appended must be pandas format. But we have {}".format(type(df)))
 
+        if self._store is not None:
+            self._store.set(field_name, df)
+            self._data = None
+            self._add_field(field_name)
+            return
+
         the_data = self.data
         exist_symbols = the_data.columns.levels[0]
 
@@ -430,7 +462,8 @@ class HFDataView(object):
                     overwrite=True,
                     formula_func_name_style='camel', data_api=None,
                     register_funcs=None,
-                    within_index=True):
+                    within_index=True,
+                    params=None):
         """
         Add a new field, which is calculated using existing fields.
 
@@ -450,6 +483,9 @@ class HFDataView(object):
                         optional
         within_index : bool
             When do cross-section operatioins, whether just do within index components.
+        params : dict, optional
+            Numeric parameters used in the formula, like {'LEN': 5} for 'Ts_Mean(close, LEN)'.
+            Parsing of a formula is cached, so evaluating it with many parameters parses it only once.
 
         Notes
         -----
@@ -481,10 +517,11 @@ class HFDataView(object):
                     raise ValueError("注册的自定义函数名%s与内置的函数名称重复,请更换register_funcs中定义的相关函数名称." % (func,))
                 parser.functions[func] = register_funcs[func]
 
+        params = params or {}
         expr = parser.parse(formula)
 
         var_df_dic = dict()
-        var_list = expr.variables()
+        var_list = [var for var in expr.variables() if var not in params]
 
         # TODO: users do not need to prepare data before add_formula
         if not self.fields:
@@ -512,7 +549,7 @@ class HFDataView(object):
         #         df_index_member = None
         #     df_eval = parser.evaluate(var_df_dic, ann_dts=df_ann, trade_dts=self.dates, index_member=df_index_member)
         # else:
-        df_eval = parser.evaluate(var_df_dic, ann_dts=None, trade_dts=self.dates)
+        df_eval = parser.evaluate(var_df_dic, ann_dts=None, trade_dts=self.dates, params=params)
         df_eval.index.name = self.TRADE_DATE_FIELD_NAME
 
         if add_data:
@@ -564,7 +601,12 @@ class HFDataView(object):
         if not end_date:
             end_date = self.end_date
 
-        res = self.data.loc[pd.IndexSlice[start_date: end_date], pd.IndexSlice[symbol, fields]]
+        if self._store is not None:
+            res = self._store.to_frame(fields=None if isinstance(fields, slice) else fields,
+                                       symbols=None if isinstance(symbol, slice) else symbol,
+                                       start_date=start_date, end_date=end_date)
+        else:
+            res = self.data.loc[pd.IndexSlice[start_date: end_date], pd.IndexSlice[symbol, fields]]
         if date_type!="int":
             format = '%Y%m%d' if len(str(res.index[0])) == 8 else '%Y%m%d%H%M%S'
             res.index = pd.to_datetime(res.index, format=format)
@@ -630,6 +672,18 @@ class HFDataView(object):
             Index is int date, column is symbol.
 
         """
+        if self._store is not None:
+            if not start_date:
+                start_date = self.start_date
+            if not end_date:
+                end_date = self.end_date
+            res = self._store.get(field, symbols=symbol.split(',') if symbol else None,
+                                  start_date=start_date, end_date=end_date)
+            if date_type != "int":
+                format = '%Y%m%d' if len(str(res.index[0])) == 8 else '%Y%m%d%H%M%S'
+                res.index = pd.to_datetime(res.index, format=format)
+            return res
+
         res = self.get(symbol, start_date=start_date, end_date=end_date, fields=field, date_type=date_type)
         if res is None:
             print("No data. for start_date={}, end_date={}, field={}, symbol={}".format(start_date,
@@ -662,7 +716,7 @@ class HFDataView(object):
 
         return res
 
-    def save_dataview(self, folder_path):
+    def save_dataview(self, folder_path, data_format='hdf5'):
         """
         Save data and meta_data_to_store to a single hd5 file.
         Store at output/sub_folder
@@ -671,32 +725,52 @@ class HFDataView(object):
         ----------
         folder_path : str or unicode
             Path to store your data.
+        data_format : {'hdf5', 'memmap'}, optional
+            memmap: each field of data is stored as an uncompressed .npy file under folder_path/data,
+            which load_dataview maps into memory without copying. See DataView.save_dataview.
 
         """
+        if data_format not in ('hdf5', 'memmap'):
+            raise ValueError("不支持的data_format: %s, 可选 hdf5, memmap" % data_format)
         abs_folder = os.path.abspath(folder_path)
         meta_path = os.path.join(folder_path, 'meta_data.json')
         data_path = os.path.join(folder_path, 'data.hd5')
+        store_path = os.path.join(folder_path, 'data')
+        if FieldStore.exists(store_path):
+            shutil.rmtree(store_path)
 
-        data_to_store = {'data': self.data,
-                         'data_benchmark': self.data_benchmark, 'data_inst': self._data_inst}
+        data_to_store = {'data_benchmark': self.data_benchmark, 'data_inst': self._data_inst}
+        if data_format == 'hdf5':
+            data_to_store['data'] = self.data
         data_to_store = {k: v for k, v in data_to_store.items() if v is not None}
         meta_data_to_store = {key: self.__dict__[key] for key in self.meta_data_list}
 
         print("\nStore data...")
         jutil.save_json(meta_data_to_store, meta_path)
         self._save_h5(data_path, data_to_store)
+        if data_format == 'memmap':
+            store = self._store
+            if store is None and self._data is not None:
+                store = FieldStore.from_frame(self._data)
+            if store is not None:
+                store.save(store_path)
 
         print("Dataview has been successfully saved to:\n"
               + abs_folder + "\n\n"
               + "You can load it with load_dataview('{:s}')".format(abs_folder))
 
-    def load_dataview(self, folder_path='.'):
+    def load_dataview(self, folder_path='.', lazy=False, memory_limit=None):
         """
         Load data from local file.
         Parameters
         ----------
         folder_path : str or unicode, optional
             Folder path to store hd5 file and meta data.
+        lazy : bool, optional
+            Only read index and meta data when loading, each field is read from disk when it is first used.
+        memory_limit : int, optional
+            With lazy=True, max bytes of loaded fields kept in memory. No limit by default.
+            Dataviews saved with data_format='memmap' are always memory mapped, lazy and memory_limit are ignored.
         """
 
         path_meta_data = os.path.join(folder_path, 'meta_data.json')
@@ -705,8 +779,18 @@ class HFDataView(object):
             raise IOError("There is no data file under directory {}".format(folder_path))
 
         meta_data = jutil.read_json(path_meta_data)
-        dic = self._load_h5(path_data)
-        self.data = dic.get('/data', None)
+        if FieldStore.exists(os.path.join(folder_path, 'data')):
+            # save_dataview(data_format='memmap')保存的数据
+            dic = self._load_h5(path_data)
+            self.data = None
+            self._store = FieldStore.load(os.path.join(folder_path, 'data'))
+        elif lazy:
+            dic = load_h5_lazy(path_data, ['/data'], memory_limit=memory_limit)
+            self.data = None
+            self._store = dic.get('/data', None)
+        else:
+            dic = self._load_h5(path_data)
+            self.data = dic.get('/data', None)
         self._data_benchmark = dic.get('/data_benchmark', None)
         self._data_inst = dic.get('/data_inst', None)
         self.__dict__.update(meta_data)
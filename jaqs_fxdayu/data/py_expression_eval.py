@@ -1,9 +1,230 @@
+import threading
+from collections import OrderedDict
+
 from jaqs.data.py_expression_eval import *
 from jaqs.data.py_expression_eval import Parser as OriginParser
 
 from jaqs_fxdayu.patch_util import auto_register_patch
-from jaqs_fxdayu.util import fillinf
+from jaqs_fxdayu.util.rolling import rolling_skipna, rolling_dot, rolling_corr, rolling_cov
+from jaqs_fxdayu.util import cross_section
 from . import signal_function_mod as sfm
+from .expr_compiler import CompiledExpression, CompileError, FINITE_FUNCS, fillinf_frame
+
+# infer_lookback使用的函数分类, 函数名不区分大小写
+# f(x, n, ...): 使用最近n个值
+_WINDOW_FUNCS = {'ts_sum', 'ts_product', 'countnans', 'stddev', 'ts_mean', 'ts_min', 'ts_max', 'ts_skewness',
+                 'ts_kurtosis', 'decay_linear', 'ts_rank', 'ts_percentile', 'ts_quantile', 'ts_argmax', 'ts_argmin'}
+# f(x, y, n): 使用x, y最近n个值
+_PAIR_WINDOW_FUNCS = {'covariance', 'correlation', 'corr'}
+# f(x, n): 使用n期之前的值, Return的n默认为1
+_SHIFT_FUNCS = {'delay': None, 'delta': None, 'return': 1}
+# 结果依赖全部历史数据
+_UNBOUNDED_FUNCS = {'ewma', 'sma', 'ta', 'step'}
+# 只作用于当期值(截面或逐元素)的内置函数, 以及按报告期计算的财务函数(季度数据总是完整的)
+_POINTWISE_FUNCS = {'min', 'max', 'percentile', 'grouppercentile', 'quantile', 'groupquantile', 'rank', 'grouprank',
+                    'mask', 'conditionrank', 'conditionpercentile', 'conditionquantile', 'standardize', 'cutoff',
+                    'cumtosingle', 'ttm', 'ttm_jl', 'yoy', 'qoq', 'tail', 'pow', 'signedpower', 'isnan', 'if'}
+
+# 跳过NaN, 对每个symbol的最近n个有效值计算的函数
+_SKIPNA_FUNCS = {'stddev', 'ts_sum', 'ts_mean', 'ts_min', 'ts_max', 'ts_skewness', 'ts_kurtosis', 'ts_product',
+                 'decay_linear', 'decay_exp'}
+# 结果只在参数为NaN处为NaN的单目运算符及函数(infer_skipna)
+_NAN_KEEPING_OPS1 = {'-', 'abs', 'sign', 'ceil', 'floor', 'round'}
+_NAN_KEEPING_FUNCS = {'delay', 'delta'} | (_SKIPNA_FUNCS - {'ts_skewness', 'ts_kurtosis'})
+
+# Parser.parse缓存的表达式个数
+PARSE_CACHE_SIZE = 512
+# (表达式, 函数名, 单目运算符名) -> [tokens(tuple), CompiledExpression或None], 按使用顺序排列.
+# 各Parser实例共用, 可能在多个线程中使用, 读写时须持有_parse_lock
+_parse_cache = OrderedDict()
+_parse_lock = threading.Lock()
+
+
+def infer_lookback(expr, params=None):
+    """
+    根据解析后的表达式推断计算一个日期的值需要的数据行数(包括当天).
+
+    例如 Ts_Mean(Delay(close,5),20) 需要 20 + 5 = 25 行, close + 1 需要1行.
+    Ts_Mean等函数跳过NaN计算, 行数只在窗口内没有NaN时足够, 见infer_skipna.
+
+    Parameters
+    ----------
+    expr : Expression
+        Parser.parse的返回值
+    params : dict, optional
+        表达式中的数值参数, 见Parser.evaluate
+
+    Returns
+    -------
+    int or None
+        None表示结果依赖全部历史数据(如Ewma, Ta, 自定义函数或窗口参数不是常数)
+
+    """
+    # 栈中的元素: ('num', 值), ('data', 行数), ('func', 函数名), ('args', [参数])
+    stack = []
+    for item in expr.tokens:
+        type_ = item.type_
+        if type_ == TNUMBER:
+            stack.append(('num', item.number_))
+        elif type_ == TVAR:
+            if item.index_ in expr.functions:
+                stack.append(('func', item.index_))
+            elif params and item.index_ in params:
+                stack.append(('num', params[item.index_]))
+            else:
+                stack.append(('data', 1))
+        elif type_ == TOP1:
+            kind, value = stack.pop()
+            if kind == 'num':
+                try:
+                    value = expr.ops1[item.index_](value)
+                except Exception:
+                    kind, value = 'data', 1
+            stack.append((kind, value))
+        elif type_ == TOP2:
+            right = stack.pop()
+            left = stack.pop()
+            if item.index_ == ',':
+                stack.append(('args', (left[1] if left[0] == 'args' else [left]) + [right]))
+            elif left[0] == 'num' and right[0] == 'num':
+                try:
+                    stack.append(('num', expr.ops2[item.index_](left[1], right[1])))
+                except Exception:
+                    stack.append(('data', 1))
+            else:
+                stack.append(('data', _max_lookback([left, right])))
+        elif type_ == TFUNCALL:
+            args = stack.pop()
+            args = args[1] if args[0] == 'args' else [args]
+            func = stack.pop()[1]
+            stack.append(('data', _call_lookback(func.lower(), args)))
+        else:
+            raise Exception('invalid Expression')
+    kind, value = stack.pop()
+    return value if kind == 'data' else 1
+
+
+def infer_skipna(expr, params=None, opaque=()):
+    """
+    判断infer_lookback的行数对跳过NaN的函数(Ts_Mean, StdDev等)是否足够.
+
+    这些函数使用每个symbol最近n个有效值, 窗口内有NaN(如停牌)时需要更早的数据.
+    参数只在输入为NaN的位置为NaN时(如 Ts_Mean(Delay(close,5)*2, 20)), 可以通过检查输入数据确定;
+    参数可能由计算产生NaN时(如 Ts_Mean(close/volume, 5) 中除以0), 无法确定.
+
+    Parameters
+    ----------
+    expr : Expression
+        Parser.parse的返回值
+    params : dict, optional
+        表达式中的数值参数
+    opaque : iterable of str
+        可能在输入不为NaN的位置为NaN的变量, 如其他公式字段
+
+    Returns
+    -------
+    skips : bool or None
+        False: 没有跳过NaN的函数, infer_lookback的行数总是足够;
+        True: 输入在窗口内没有NaN, 或在窗口之前全为NaN时足够;
+        None: 无法确定
+    keeps : bool
+        结果是否只在输入为NaN的位置(及开头的不足窗口的行)为NaN
+
+    """
+    opaque = set(opaque)
+    skips = False
+    # 栈中的元素: ('num', 值), ('data', keeps), ('func', 函数名), ('args', [参数])
+    stack = []
+    for item in expr.tokens:
+        type_ = item.type_
+        if type_ == TNUMBER:
+            stack.append(('num', item.number_))
+        elif type_ == TVAR:
+            if item.index_ in expr.functions:
+                stack.append(('func', item.index_))
+            elif params and item.index_ in params:
+                stack.append(('num', params[item.index_]))
+            else:
+                stack.append(('data', item.index_ not in opaque))
+        elif type_ == TOP1:
+            kind, value = stack.pop()
+            if kind == 'num':
+                try:
+                    value = expr.ops1[item.index_](value)
+                except Exception:
+                    kind, value = 'data', False
+            else:
+                value = value and item.index_.lower() in _NAN_KEEPING_OPS1
+            stack.append((kind, value))
+        elif type_ == TOP2:
+            right = stack.pop()
+            left = stack.pop()
+            op = item.index_
+            if op == ',':
+                stack.append(('args', (left[1] if left[0] == 'args' else [left]) + [right]))
+            elif left[0] == 'num' and right[0] == 'num':
+                try:
+                    stack.append(('num', expr.ops2[op](left[1], right[1])))
+                except Exception:
+                    stack.append(('data', False))
+            else:
+                # 除以非0常数不产生NaN
+                keeps = op in ('+', '-', '*') or (op == '/' and right[0] == 'num' and right[1] != 0)
+                stack.append(('data', keeps and _all_keep([left, right])))
+        elif type_ == TFUNCALL:
+            args = stack.pop()
+            args = args[1] if args[0] == 'args' else [args]
+            name = stack.pop()[1].lower()
+            keeps = _all_keep(args)
+            if name in _SKIPNA_FUNCS:
+                if not keeps:
+                    return None, False
+                skips = True
+            stack.append(('data', keeps and name in _NAN_KEEPING_FUNCS))
+        else:
+            raise Exception('invalid Expression')
+    kind, value = stack.pop()
+    return skips, value if kind == 'data' else True
+
+
+def _all_keep(args):
+    return all(value for kind, value in args if kind == 'data')
+
+
+def _max_lookback(args):
+    res = 1
+    for kind, value in args:
+        if kind == 'data':
+            if value is None:
+                return None
+            res = max(res, value)
+    return res
+
+
+def _window_arg(args, pos, default=None):
+    if len(args) > pos:
+        kind, value = args[pos]
+        if kind != 'num':
+            return None
+        return int(value)
+    return default
+
+
+def _call_lookback(name, args):
+    base = _max_lookback(args)
+    if base is None:
+        return None
+    if name in _WINDOW_FUNCS or name in _PAIR_WINDOW_FUNCS or name == 'decay_exp':
+        pos = {'decay_exp': 2}.get(name, 2 if name in _PAIR_WINDOW_FUNCS else 1)
+        n = _window_arg(args, pos)
+        return None if n is None else base + max(n - 1, 0)
+    if name in _SHIFT_FUNCS:
+        n = _window_arg(args, 1, _SHIFT_FUNCS[name])
+        return None if n is None else base + abs(n)
+    if name in _POINTWISE_FUNCS:
+        return base
+    # Ewma等依赖全部历史, 自定义函数无法推断
+    return None
 
 
 @auto_register_patch(parent_level=1)
@@ -15,8 +236,45 @@ class Parser(OriginParser):
             'Ts_Argmax': self.ts_argmax,
             'Ts_Argmin': self.ts_argmin
         })
+        # 结果不需要检查inf的函数(见FINITE_FUNCS), 按函数对象识别, set_capital改变函数名后仍然有效
+        self.finite_funcs = [self.functions[name] for name in FINITE_FUNCS if name in self.functions]
 
-    def evaluate(self, values, ann_dts=None, trade_dts=None, index_member=None):
+    def parse(self, expr):
+        """
+        Parse a string expression. Results are cached (see PARSE_CACHE_SIZE), an expression parsed before with
+        the same function names is not tokenized again, and its compiled form is reused.
+
+        Parameters
+        ----------
+        expr : str
+
+        Returns
+        -------
+        Expression
+
+        """
+        # 函数名随set_capital及注册的自定义函数变化, 影响变量与函数的识别
+        key = (expr, frozenset(self.functions), frozenset(self.ops1))
+        with _parse_lock:
+            entry = _parse_cache.pop(key, None)
+            if entry is not None:
+                _parse_cache[key] = entry
+        if entry is None:
+            super(Parser, self).parse(expr)
+            # 共用的tokens不可修改
+            entry = [tuple(self.tokens), None]
+            with _parse_lock:
+                # 其他线程可能已解析了相同的表达式, 使用先缓存的结果
+                entry = _parse_cache.pop(key, entry)
+                while _parse_cache and len(_parse_cache) >= PARSE_CACHE_SIZE:
+                    _parse_cache.popitem(last=False)
+                _parse_cache[key] = entry
+        self.expression = expr
+        self.tokens = entry[0]
+        self._parse_entry = entry
+        return Expression(self.tokens, self.ops1, self.ops2, self.functions)
+
+    def evaluate(self, values, ann_dts=None, trade_dts=None, index_member=None, cache=None, params=None):
         """
         Evaluate the value of expression using. Data of different frequency will be automatically expanded.
 
@@ -29,6 +287,11 @@ class Parser(OriginParser):
         trade_dts : np.ndarray
             The date index of result.
         index_member : pd.DataFrame
+        cache : IntermediateCache, optional
+            Results of subexpressions shared by expressions evaluated with the same values.
+        params : dict, optional
+            Numeric parameters used in the expression as variables, like {'LEN': 5} for 'Ts_Mean(close, LEN)'.
+            An expression can be parsed once and evaluated with different parameters.
 
         Returns
         -------
@@ -36,18 +299,56 @@ class Parser(OriginParser):
 
         """
 
-        def _fillinf(df):
-            try:
-                df = fillinf(df)
-            except:
-                pass
-            return df
-
         self.ann_dts = ann_dts
         self.trade_dts = trade_dts
         self.index_member = index_member
 
         values = values or {}
+        if params:
+            values = dict(values)
+            values.update(params)
+        try:
+            compiled = self.compile()
+        except CompileError:
+            return self._interpret(values)
+        return compiled.run(self, values, cache=cache)
+
+    def compile(self):
+        """
+        把当前表达式编译为计算图, 结果与parse的结果一起缓存.
+
+        Returns
+        -------
+        CompiledExpression
+
+        Raises
+        ------
+        CompileError
+
+        """
+        entry = getattr(self, '_parse_entry', None)
+        if entry is None or entry[0] is not self.tokens:
+            # tokens不是parse得到的
+            entry = self._parse_entry = [self.tokens, None]
+        if entry[1] is None:
+            compiled = CompiledExpression.from_tokens(self.tokens)
+            with _parse_lock:
+                if entry[1] is None:
+                    entry[1] = compiled
+        return entry[1]
+
+    def _interpret(self, values):
+        """
+        逐个token解释执行, 无法编译的表达式使用.
+        每一步的结果中的inf原地替换为NaN, 输入数据只在含有inf或传给函数(函数可能原地修改参数)时拷贝.
+        """
+        inputs = set(id(df) for df in values.values() if isinstance(df, pd.DataFrame))
+
+        def _own(df):
+            if id(df) in inputs:
+                return df.copy()
+            return df
+
         nstack = []
         L = len(self.tokens)
         for i in range(0, L):
@@ -59,10 +360,14 @@ class Parser(OriginParser):
                 n2 = nstack.pop()
                 n1 = nstack.pop()
                 f = self.ops2[item.index_]
-                nstack.append(_fillinf(f(n1, n2)))
+                res = f(n1, n2)
+                # 比较及逻辑运算的结果为0, 1或NaN
+                if item.index_ not in ('==', '!=', '>', '<', '>=', '<=', '&&', '||'):
+                    res = fillinf_frame(res, owned=True)
+                nstack.append(res)
             elif type_ == TVAR:
                 if item.index_ in values:
-                    nstack.append(_fillinf(values[item.index_]))
+                    nstack.append(fillinf_frame(values[item.index_], owned=False))
                 elif item.index_ in self.functions:
                     nstack.append(self.functions[item.index_])
                 else:
@@ -70,22 +375,25 @@ class Parser(OriginParser):
             elif type_ == TOP1:
                 n1 = nstack.pop()
                 f = self.ops1[item.index_]
-                nstack.append(_fillinf(f(n1)))
+                nstack.append(fillinf_frame(f(n1), owned=True))
             elif type_ == TFUNCALL:
                 n1 = nstack.pop()
                 f = nstack.pop()
                 if callable(f):
                     if type(n1) is list:
-                        nstack.append(_fillinf(f(*n1)))
+                        res = f(*[_own(arg) for arg in n1])
                     else:
-                        nstack.append(_fillinf(f(n1)))  # call(f, n1)
+                        res = f(_own(n1))  # call(f, n1)
+                    if f not in self.finite_funcs:
+                        res = fillinf_frame(res, owned=True)
+                    nstack.append(res)
                 else:
                     raise Exception(f + ' is not a function')
             else:
                 raise Exception('invalid Expression')
         if len(nstack) > 1:
             raise Exception('invalid Expression (parity)')
-        return _fillinf(nstack[0])
+        return _own(fillinf_frame(nstack[0], owned=True))
 
     # -----------------------------------------------------
     def reindex_df(self, df):
@@ -157,43 +465,110 @@ class Parser(OriginParser):
                   **kwargs):
         return sfm.ts_argmin(*args, **kwargs)
 
+    # 以下ts_*函数跳过NaN(停牌), 每个symbol只使用自身的有效值,
+    # 与df.apply(lambda x: x.dropna().rolling(n).xxx()).reindex(df.index)相同
     def std_dev(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).std()).reindex(df.index)
+        return rolling_skipna(df, n, 'std')
 
     def ts_sum(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).sum()).reindex(df.index)
+        return rolling_skipna(df, n, 'sum')
 
     def count_nans(self, df, n):
         return n - df.rolling(n).count()
 
     def ts_mean(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).mean()).reindex(df.index)
+        return rolling_skipna(df, n, 'mean')
 
     def ts_min(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).min()).reindex(df.index)
+        return rolling_skipna(df, n, 'min')
 
     def ts_max(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).max()).reindex(df.index)
+        return rolling_skipna(df, n, 'max')
 
     def ts_kurt(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).kurt()).reindex(df.index)
+        return rolling_skipna(df, n, 'kurt')
 
     def ts_skew(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).skew()).reindex(df.index)
+        return rolling_skipna(df, n, 'skew')
 
     def ts_product(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).apply(np.product)).reindex(df.index)
+        return rolling_skipna(df, n, 'product')
 
     def corr(self, x, y, n):
         (x, y) = self._align_bivariate(x, y)
-        return x.rolling(n, min_periods=1).corr(y)
+        (x, y) = x.align(y, join='outer')
+        return pd.DataFrame(rolling_corr(x.values, y.values, n), index=x.index, columns=x.columns)
 
     def cov(self, x, y, n):
         (x, y) = self._align_bivariate(x, y)
-        return x.rolling(n, min_periods=1).cov(y)
+        (x, y) = x.align(y, join='outer')
+        return pd.DataFrame(rolling_cov(x.values, y.values, n), index=x.index, columns=x.columns)
 
     def decay_linear(self, df, n):
-        return df.apply(lambda x: x.dropna().rolling(n).apply(self.decay_linear_array)).reindex(df.index)
+        # 与decay_linear_array相同的权重
+        weights = np.arange(1, n + 1)
+        return rolling_skipna(df, n, lambda values, n: rolling_dot(values, weights) / np.sum(weights))
 
     def decay_exp(self, df, f, n):
-        return df.apply(lambda x: x.dropna().rolling(n).apply(self.decay_exp_array, args=[f])).reindex(df.index)
+        # 与decay_exp_array相同的权重
+        weights = np.power(f, np.arange(n)[::-1])
+        return rolling_skipna(df, n, lambda values, n: rolling_dot(values, weights) / np.sum(weights))
+
+    # -----------------------------------------------------
+    # 截面函数: 对整个数组计算, 非指数成分股及mask为False的位置不参与计算且结果为NaN, 不修改输入的DataFrame
+    @staticmethod
+    def _reindex_like(df, other):
+        if df.index.equals(other.index) and df.columns.equals(other.columns):
+            return df
+        return df.reindex(index=other.index, columns=other.columns)
+
+    def _cross_section_valid(self, df, mask=None):
+        # 与df[~index_member] = np.nan相同: index_member中缺少的位置及NaN视为成分股
+        valid = np.ones(df.shape, dtype=bool)
+        for m in (self.index_member, mask):
+            if m is not None:
+                valid &= self._reindex_like(m, df).values.astype(bool)
+        return valid
+
+    def _group_codes(self, df, group):
+        return cross_section.group_codes(self._reindex_like(group, df).values)
+
+    def rank(self, df, mask=None):
+        df = self._align_univariate(df)
+        res = cross_section.rank(df.values, self._cross_section_valid(df, mask))
+        return pd.DataFrame(res, index=df.index, columns=df.columns)
+
+    def percentile(self, df, mask=None):
+        """Return a DataFrame with values ranging from 0.0 to 1.0"""
+        df = self._align_univariate(df)
+        res = cross_section.rank(df.values, self._cross_section_valid(df, mask), normalize=True)
+        return pd.DataFrame(res, index=df.index, columns=df.columns)
+
+    def group_rank(self, df, group, mask=None):
+        df = self._align_univariate(df)
+        res = cross_section.rank(df.values, self._cross_section_valid(df, mask), self._group_codes(df, group))
+        return pd.DataFrame(res, index=df.index, columns=df.columns)
+
+    def group_percentile(self, df, group, mask=None):
+        df = self._align_univariate(df)
+        res = cross_section.rank(df.values, self._cross_section_valid(df, mask), self._group_codes(df, group),
+                                 normalize=True)
+        return pd.DataFrame(res, index=df.index, columns=df.columns)
+
+    def to_quantile(self, df, n_quantiles=5, axis=1, mask=None):
+        if axis != 1:
+            return super(Parser, self).to_quantile(df, n_quantiles=n_quantiles, axis=axis, mask=mask)
+        df = self._align_univariate(df)
+        res = cross_section.quantile(df.values, n_quantiles, self._cross_section_valid(df, mask))
+        return pd.DataFrame(res, index=df.index, columns=df.columns)
+
+    def group_quantile(self, df, group, n_quantiles=5, mask=None):
+        df = self._align_univariate(df)
+        res = cross_section.quantile(df.values, n_quantiles, self._cross_section_valid(df, mask),
+                                     self._group_codes(df, group))
+        return pd.DataFrame(res, index=df.index, columns=df.columns)
+
+    def standardize(self, df):
+        df = self._align_univariate(df)
+        res = cross_section.standardize(df.values, self._cross_section_valid(df))
+        return pd.DataFrame(res, index=df.index, columns=df.columns)
@@ -0,0 +1,334 @@
+# encoding: utf-8
+"""
+分钟线的多周期重采样.
+
+结果与 df.groupby('symbol').resample(freq).agg(rules) 一致, 但以int64的周期编号分组后用numpy完成聚合,
+且较粗的周期由已计算的较细周期逐级合成(如 1Min -> 5Min -> 15Min -> 60Min), 多个周期的开销接近单个周期.
+
+仅支持能整除一天的固定周期(Tick类型, 如5Min, 1H)及 max/min/sum/first/last 聚合规则,
+其他周期或规则回退到pandas的resample.
+
+"""
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+from pandas.tseries.offsets import Tick
+
+NANOS_PER_DAY = 24 * 60 * 60 * 10 ** 9
+
+NO_START = np.iinfo(np.int64).min
+
+# 可由细周期结果逐级合成的聚合规则
+COMPOSABLE_RULES = ('max', 'min', 'sum', 'first', 'last')
+
+
+def freq_to_nanos(freq):
+    """
+    固定周期的纳秒数, 非固定周期或不能整除一天时返回None.
+
+    Parameters
+    ----------
+    freq : str
+
+    Returns
+    -------
+    int or None
+
+    """
+    try:
+        offset = to_offset(freq)
+    except ValueError:
+        return None
+    if not isinstance(offset, Tick):
+        return None
+    nanos = int(offset.nanos)
+    if nanos <= 0 or NANOS_PER_DAY % nanos != 0:
+        return None
+    return nanos
+
+
+class _Bars(object):
+    """
+    按(symbol, 时间)排序的K线数据, 每行代表一个周期.
+
+    Attributes
+    ----------
+    symbols : np.ndarray
+        排序后的symbol
+    codes : np.ndarray
+        每行对应的symbol在symbols中的位置
+    ts : np.ndarray
+        每行的时间, int64纳秒
+    columns : dict
+        字段 -> np.ndarray
+    dtypes : dict
+        字段 -> 原始分钟线中的dtype
+
+    """
+
+    def __init__(self, symbols, codes, ts, columns, dtypes):
+        self.symbols = symbols
+        self.codes = codes
+        self.ts = ts
+        self.columns = columns
+        self.dtypes = dtypes
+
+    @classmethod
+    def from_frame(cls, df, fields):
+        ts = df.index.values.astype('datetime64[ns]').view(np.int64)
+        valid = ts != np.iinfo(np.int64).min
+        symbols, codes = np.unique(df['symbol'].values[valid].astype(str), return_inverse=True)
+        ts = ts[valid]
+        order = np.lexsort((ts, codes))
+        columns = {f: df[f].values[valid][order] for f in fields}
+        dtypes = {f: df[f].dtype for f in fields}
+        return cls(symbols, codes[order], ts[order], columns, dtypes)
+
+
+def _group_first(values, group, n_groups, last=False):
+    # 每组第一个(或最后一个)非空值, 没有非空值的组为NaN
+    out = np.full(n_groups, np.nan, dtype=object if values.dtype.kind not in 'biuf' else np.float64)
+    idx = np.flatnonzero(~pd.isnull(values))
+    if len(idx) == 0:
+        return out
+    g = group[idx]
+    if last:
+        mask = np.r_[g[1:] != g[:-1], True]
+    else:
+        mask = np.r_[True, g[1:] != g[:-1]]
+    out[g[mask]] = values[idx[mask]]
+    return out
+
+
+def _aggregate(bars, nanos, rules, start=None):
+    """
+    把bars按nanos周期聚合, 输出每个symbol从首个周期到末个周期的连续周期(空周期与pandas一致).
+
+    Parameters
+    ----------
+    bars : _Bars
+    nanos : int
+    rules : dict
+    start : np.ndarray, optional
+        每个symbol最早需要输出的周期编号, 用于分块重采样时补齐块之间的空周期, NO_START表示不限制
+
+    Returns
+    -------
+    _Bars
+
+    """
+    bucket = bars.ts // nanos
+    columns = bars.columns
+    codes = bars.codes
+    if start is not None:
+        # 已输出过的周期不再重复输出, 这些行只可能是细周期补齐的空周期
+        keep = bucket >= start[codes]
+        if not keep.all():
+            bucket = bucket[keep]
+            codes = codes[keep]
+            columns = {f: v[keep] for f, v in columns.items()}
+    n = len(bucket)
+    if n == 0:
+        return _Bars(bars.symbols, codes, bucket * nanos, dict(columns), bars.dtypes)
+
+    # 输入已按(code, ts)排序, (code, bucket)的变化点即为各组起点
+    change = np.r_[True, (codes[1:] != codes[:-1]) | (bucket[1:] != bucket[:-1])]
+    starts = np.flatnonzero(change)
+    group = np.cumsum(change) - 1
+    key_code = codes[starts]
+    key_bucket = bucket[starts]
+
+    # 每个symbol的周期区间, 区间内无数据的周期也要输出
+    code_first = np.r_[True, key_code[1:] != key_code[:-1]]
+    code_last = np.r_[key_code[1:] != key_code[:-1], True]
+    bmin = key_bucket[code_first]
+    bmax = key_bucket[code_last]
+    if start is not None:
+        first_bucket = start[key_code[code_first]]
+        bmin = np.where(first_bucket == NO_START, bmin, np.minimum(bmin, first_bucket))
+    lengths = bmax - bmin + 1
+    offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+    n_out = int(lengths.sum())
+    code_idx = np.cumsum(code_first) - 1
+    pos = offsets[code_idx] + key_bucket - bmin[code_idx]
+
+    out_codes = np.repeat(key_code[code_first], lengths)
+    out_bucket = np.arange(n_out) - np.repeat(offsets, lengths) + np.repeat(bmin, lengths)
+    has_empty = len(starts) < n_out
+
+    out_columns = {}
+    for field, rule in rules.items():
+        values = columns[field]
+        if rule == 'sum':
+            filled = np.where(pd.isnull(values), 0, values) if values.dtype.kind == 'f' else values
+            agg = np.add.reduceat(filled, starts)
+            out = np.zeros(n_out, dtype=agg.dtype)
+        elif rule in ('max', 'min'):
+            ufunc = np.fmax if rule == 'max' else np.fmin
+            agg = ufunc.reduceat(values, starts)
+            out = np.full(n_out, np.nan, dtype=np.float64) if has_empty else np.empty(n_out, dtype=agg.dtype)
+        else:
+            agg = _group_first(values, group, len(starts), last=(rule == 'last'))
+            out = np.full(n_out, np.nan, dtype=agg.dtype)
+        out[pos] = agg
+        # 整数字段没有缺失时保持原dtype, 与pandas一致
+        dtype = bars.dtypes[field]
+        if dtype.kind in 'biu' and out.dtype != dtype and not pd.isnull(out).any():
+            out = out.astype(dtype)
+        out_columns[field] = out
+
+    return _Bars(bars.symbols, out_codes, out_bucket * nanos, out_columns, bars.dtypes)
+
+
+def _pandas_resample(df, freq, rules):
+    return df.groupby('symbol').resample(freq).agg(rules).drop('symbol', axis=1).reset_index()
+
+
+def _to_frame(bars, df, rules):
+    res = pd.DataFrame({'symbol': bars.symbols[bars.codes],
+                        'datetime': bars.ts.view('datetime64[ns]')},
+                       columns=['symbol', 'datetime'])
+    for field in rules:
+        res[field] = bars.columns[field]
+    res.columns.name = df.columns.name
+    return res
+
+
+def resample_bars(df, freqs, rules):
+    """
+    把分钟线df按多个周期重采样.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        index为datetime, 包含symbol列
+    freqs : list of str
+    rules : dict
+        字段 -> 聚合规则, 包含symbol
+
+    Returns
+    -------
+    dict
+        freq -> pd.DataFrame, 列为 symbol, datetime 及rules中除symbol外的字段
+
+    """
+    fields = [f for f in rules if f != 'symbol']
+    field_rules = {f: rules[f] for f in fields}
+    fast = all(isinstance(r, str) and r in COMPOSABLE_RULES for r in field_rules.values())
+    fast = fast and all(df[f].dtype.kind in 'biuf' for f in fields if field_rules[f] in ('max', 'min', 'sum'))
+
+    res = {}
+    computed = {}
+    nanos = {f: freq_to_nanos(f) for f in freqs}
+    for freq in sorted(freqs, key=lambda f: nanos[f] or 0):
+        if freq in res:
+            continue
+        if not fast or nanos[freq] is None:
+            res[freq] = _pandas_resample(df, freq, rules)
+            continue
+        # 从能整除当前周期的最粗的已计算周期合成
+        sources = [n for n in computed if nanos[freq] % n == 0]
+        if sources:
+            source = computed[max(sources)]
+        else:
+            source = _Bars.from_frame(df, fields)
+        bars = _aggregate(source, nanos[freq], field_rules)
+        computed[nanos[freq]] = bars
+        res[freq] = _to_frame(bars, df, field_rules)
+    return {freq: res[freq] for freq in freqs}
+
+
+def _lcm(a, b):
+    x, y = a, b
+    while y:
+        x, y = y, x % y
+    return a // x * b
+
+
+class ChunkedResampler(object):
+    """
+    对按时间顺序分块到达的分钟线做重采样, 跨块的周期会等到完整后再输出.
+
+    每次push后只保留最后一个未完成周期的原始分钟线, 内存占用与总时长无关.
+    拼接所有块的输出结果与对全部数据调用resample_bars一致.
+
+    Parameters
+    ----------
+    freqs : list of str
+        只支持能整除一天的固定周期
+    rules : dict
+        字段 -> 聚合规则, 包含symbol
+
+    """
+
+    def __init__(self, freqs, rules):
+        self.freqs = list(freqs)
+        self.rules = rules
+        self.fields = [f for f in rules if f != 'symbol']
+        self.field_rules = {f: rules[f] for f in self.fields}
+        if not all(isinstance(r, str) and r in COMPOSABLE_RULES for r in self.field_rules.values()):
+            raise ValueError("分块重采样只支持%s聚合规则" % ','.join(COMPOSABLE_RULES))
+        self.nanos = {}
+        for freq in self.freqs:
+            nanos = freq_to_nanos(freq)
+            if nanos is None:
+                raise ValueError("分块重采样只支持能整除一天的固定周期: %s" % freq)
+            self.nanos[freq] = nanos
+        self._step = 1
+        for nanos in self.nanos.values():
+            self._step = _lcm(self._step, nanos)
+        self._carry = None
+        # freq -> {symbol: 已输出的最后一个周期编号}
+        self._last = {freq: {} for freq in self.freqs}
+
+    def push(self, df, cut=None):
+        """
+        加入一块分钟线, 输出cut之前已完整的周期.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            index为datetime, 包含symbol列, 时间上晚于之前push的数据
+        cut : pd.Timestamp, optional
+            下一块数据的起始时间, 为None时表示数据结束, 输出全部剩余周期
+
+        Returns
+        -------
+        dict
+            freq -> pd.DataFrame
+
+        """
+        if self._carry is not None and len(self._carry):
+            df = pd.concat([self._carry, df])
+        if cut is not None:
+            cut_ns = pd.Timestamp(cut).value // self._step * self._step
+            ts = df.index.values.astype('datetime64[ns]').view(np.int64)
+            # NaT会被重采样丢弃, 无需保留
+            done = ts < cut_ns
+            self._carry = df[~done & (ts != np.iinfo(np.int64).min)]
+            df = df[done]
+        else:
+            self._carry = None
+
+        res = {}
+        computed = {}
+        for freq in sorted(self.freqs, key=lambda f: self.nanos[f]):
+            nanos = self.nanos[freq]
+            if freq in res:
+                continue
+            sources = [n for n in computed if nanos % n == 0]
+            if sources:
+                source = computed[max(sources)]
+            else:
+                source = _Bars.from_frame(df, self.fields)
+            last = self._last[freq]
+            start = np.array([last[sym] + 1 if sym in last else NO_START for sym in source.symbols],
+                             dtype=np.int64)
+            bars = _aggregate(source, nanos, self.field_rules, start=start)
+            if len(bars.codes):
+                ends = np.r_[bars.codes[1:] != bars.codes[:-1], True]
+                for code, ts in zip(bars.codes[ends], bars.ts[ends]):
+                    last[bars.symbols[code]] = ts // nanos
+            computed[nanos] = bars
+            res[freq] = _to_frame(bars, df, self.field_rules)
+        return {freq: res[freq] for freq in self.freqs}
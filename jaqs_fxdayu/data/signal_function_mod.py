@@ -3,6 +3,13 @@
 import pandas as pd
 import numpy as np
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from jaqs_fxdayu.util.rolling import rolling_argmax, rolling_argmin
+
+# Ta()计算各symbol时使用的线程数. talib计算时释放GIL, 可以并行
+TA_MAX_WORKERS = 4
+
 
 # talib函数库,自动剔除为空的日期,用于计算signal
 def ta(ta_method='MA',
@@ -40,44 +47,82 @@ def ta(ta_method='MA',
     # 剔除K线数据中的None
     for i in waiting_for_pop:
         candle_dict.pop(i)
+    if len(candle_dict) == 0:
+        return None
+
+    output_names = list(abstract.Function(ta_method).output_names)
+    column = _ta_output_column(output_names, ta_column)
+
+    # 各K线数据对齐为 字段 x symbol x 日期 的数组, 每个symbol的数据连续存放
+    fields = sorted(candle_dict.keys())
+    index, columns = _union_axes([candle_dict[field] for field in fields])
+    candles = np.empty((len(fields), len(columns), len(index)))
+    for i, field in enumerate(fields):
+        candles[i] = candle_dict[field].reindex(index=index, columns=columns).values.T
+    # 任一字段为空的日期不参与计算
+    valid = ~np.isnan(candles).any(axis=0)
+
+    res = np.full((len(index), len(columns)), np.nan)
 
-    results = []
-    candle_pannel = pd.Panel.from_dict(candle_dict)
+    def calc(j):
+        mask = valid[j]
+        inputs = dict((field, candles[i, j, mask]) for i, field in enumerate(fields))
+        # abstract.Function保存输入数据, 不能在线程间共用
+        result = abstract.Function(ta_method)(inputs, *args, **kwargs)
+        if isinstance(result, list):
+            result = result[column]
+        res[mask, j] = result
 
-    for sec in candle_pannel.minor_axis:
-        df = candle_pannel.minor_xs(sec).dropna()
-        if len(df) == 0:
+    secs = []
+    for j, sec in enumerate(columns):
+        if not valid[j].any():
             warnings.warn("%s数据缺失严重,无法完成指标计算,请检查是否存在数据问题." % (sec,))
             continue
-        result = pd.DataFrame(getattr(abstract, ta_method)(df, *args, **kwargs))
-
-        if isinstance(ta_column, int):
-            if ta_column >= len(result.columns) or ta_column < 0:
-                raise ValueError("非法的ta_column,列号不能为负且不得超过%s,输入为%s" % (len(result.columns) - 1, ta_column))
-            result = pd.DataFrame(result.iloc[:, ta_column])
-        elif isinstance(ta_column, str):
-            if not (ta_column in result.columns):
-                raise ValueError("非法的ta_column,可选的列名有%s,输入为%s" % (str(result.columns), ta_column))
-            result = pd.DataFrame(result.loc[:, ta_column])
-        else:
-            raise ValueError("ta_column格式有误,错误的类型为%s,请指定合法的列号(int),或列名(str)" % (type(ta_column)))
-
-        result.columns = [sec, ]
-        results.append(result)
-
-    if len(results) == 0:
+        secs.append(j)
+    if len(secs) == 0:
         return None
+
+    workers = min(TA_MAX_WORKERS or 1, len(secs))
+    if workers <= 1:
+        for j in secs:
+            calc(j)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            for future in [ex.submit(calc, j) for j in secs]:
+                future.result()
+    return pd.DataFrame(res, index=index, columns=columns)
+
+
+def _ta_output_column(output_names, ta_column):
+    """ta_column对应的talib输出的序号."""
+    if isinstance(ta_column, int):
+        if ta_column >= len(output_names) or ta_column < 0:
+            raise ValueError("非法的ta_column,列号不能为负且不得超过%s,输入为%s" % (len(output_names) - 1, ta_column))
+        return ta_column
+    elif isinstance(ta_column, str):
+        if not (ta_column in output_names):
+            raise ValueError("非法的ta_column,可选的列名有%s,输入为%s" % (str(output_names), ta_column))
+        return output_names.index(ta_column)
     else:
-        tmp = pd.concat(results, axis=1)
-        tmp = tmp.reindex(columns=candle_pannel.minor_axis, index=candle_pannel.major_axis)
-        return tmp
+        raise ValueError("ta_column格式有误,错误的类型为%s,请指定合法的列号(int),或列名(str)" % (type(ta_column)))
+
+
+def _union_axes(dfs):
+    """与pd.Panel.from_dict相同, 日期及symbol取各DataFrame的并集."""
+    index, columns = dfs[0].index, dfs[0].columns
+    for df in dfs[1:]:
+        if not df.index.equals(index):
+            index = index.union(df.index)
+        if not df.columns.equals(columns):
+            columns = columns.union(df.columns)
+    return index, columns
 
 
 # 最大值的坐标
 def ts_argmax(df, window=10):
-    return df.rolling(window).apply(np.argmax) + 1
+    return pd.DataFrame(rolling_argmax(df.values, window) + 1, index=df.index, columns=df.columns)
 
 
 # 最小值的坐标
 def ts_argmin(df, window=10):
-    return df.rolling(window).apply(np.argmin) + 1
+    return pd.DataFrame(rolling_argmin(df.values, window) + 1, index=df.index, columns=df.columns)
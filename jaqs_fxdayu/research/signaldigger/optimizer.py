@@ -237,13 +237,12 @@ class Optimizer(object):
             keys = list(self.params.keys())
             for value in product(*self.params.values()):
                 para_dict = dict(zip(keys, value))
-                formula = self.formula
-                for vars in para_dict.keys():
-                    formula = formula.replace(vars, str(para_dict[vars]))
+                # 公式只解析一次, 参数在计算时代入
                 signal = self.dataview.add_formula(field_name=self.name,
-                                                   formula=formula,
+                                                   formula=self.formula,
                                                    is_quarterly=self.is_quarterly,
-                                                   register_funcs=self.register_funcs)
+                                                   register_funcs=self.register_funcs,
+                                                   params=para_dict)
                 if (not isinstance(signal,pd.DataFrame)) or (signal.size==0):
                     warnings.warn("待优化公式%s不能计算出有效结果,请检查数据和公式是否正确完备!")
                     continue
@@ -0,0 +1,180 @@
+# encoding: utf-8
+"""
+截面(每个日期的所有symbol)上的排序类计算: 排名, 分位数, 标准化, 可按分组(如行业)分别计算.
+
+对整个 日期 x symbol 数组, 每行只排序一次(有分组时再按分组代码做一次稳定排序), 不需要对每个日期或每个分组
+分别调用pandas的rank/groupby. 不参与计算的值(NaN, 非指数成分股, 分组为NaN等)用布尔数组valid表示.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+def group_codes(group):
+    """
+    把分组的值转换为整数代码, NaN为-1.
+
+    Parameters
+    ----------
+    group : np.ndarray or pd.DataFrame
+        二维, 值可以是数值或字符串
+
+    Returns
+    -------
+    np.ndarray
+        与group形状相同的int数组
+
+    """
+    group = np.asarray(group)
+    codes, _ = pd.factorize(group.ravel())
+    return codes.reshape(group.shape)
+
+
+def _sort_rows(values, valid, codes=None):
+    """
+    每行按(分组, 值)排序, 只排序有效值.
+
+    Returns
+    -------
+    order : np.ndarray
+        行数与values相同, 列数为各行有效值个数的最大值. 排序后的位置在values.ravel()中的序号,
+        每行有效值之后为无效值的位置
+    sorted_values : np.ndarray
+        与order形状相同, 每行有效值之后为NaN
+    start : np.ndarray
+        排序后每个位置所在的分组在该行中的第一个位置
+    count : np.ndarray
+        所在分组的有效值个数
+
+    """
+    n_rows, n_cols = values.shape
+    # 用一维序号取值比二维的花式索引快
+    row = np.arange(n_rows)[:, np.newaxis]
+    offset = row * n_cols
+    # 先把每行的有效值移到左侧(布尔值的稳定排序很快), 非指数成分股等较多时只需排序少量的值
+    n_valid = valid.sum(axis=1)
+    width = int(n_valid.max()) if n_valid.size else 0
+    order = np.argsort(~valid, axis=1, kind='mergesort')[:, :width]
+    order += offset
+    padding = np.arange(width) >= n_valid[:, np.newaxis]
+    compacted = values.ravel().take(order)
+    compacted[padding] = np.nan
+    # NaN排在最后, 相同的值按列的顺序
+    inner = np.argsort(compacted, axis=1, kind='mergesort')
+    inner += row * width
+    order = order.ravel().take(inner)
+    if codes is None:
+        count = np.broadcast_to(n_valid[:, np.newaxis], order.shape)
+        start = np.zeros(order.shape, dtype=int)
+    else:
+        # 无效值为最后一组
+        n_groups = int(codes.max()) + 2 if codes.size else 1
+        # 代码范围小时用较小的整数类型, 稳定排序较快
+        dtype = np.int16 if n_groups < np.iinfo(np.int16).max else np.int64
+        sorted_codes = codes.ravel().take(order).astype(dtype)
+        sorted_codes[padding] = n_groups - 1
+        # 按分组代码稳定排序, 组内仍按值排序
+        inner = np.argsort(sorted_codes, axis=1, kind='mergesort')
+        inner += row * width
+        order = order.ravel().take(inner)
+        sorted_codes = sorted_codes.ravel().take(inner)
+        # 每行各分组的个数及第一个位置
+        keys = (row * n_groups + sorted_codes).ravel()
+        counts = np.bincount(keys, minlength=n_rows * n_groups).reshape(n_rows, n_groups)
+        starts = np.cumsum(counts, axis=1) - counts
+        count = counts.ravel().take(keys).reshape(order.shape)
+        start = starts.ravel().take(keys).reshape(order.shape)
+    sorted_values = values.ravel().take(order)
+    sorted_values[padding] = np.nan
+    return order, sorted_values, start, count
+
+
+def _unsort(sorted_res, order, valid):
+    res = np.full(valid.shape, np.nan)
+    res.ravel()[order.ravel()] = sorted_res.ravel()
+    res[~valid] = np.nan
+    return res
+
+
+def _valid(values, valid):
+    res = ~np.isnan(values)
+    if valid is not None:
+        res &= valid
+    return res
+
+
+def rank(values, valid=None, codes=None, normalize=False):
+    """
+    每行(及每个分组内)的排名, 相同的值取最小的排名, 与pd.DataFrame.rank(axis=1, method='min')相同.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        二维, 行为日期, 列为symbol
+    valid : np.ndarray of bool, optional
+        参与计算的位置, 其余位置的结果为NaN. NaN总是不参与计算.
+    codes : np.ndarray of int, optional
+        分组代码(见group_codes), -1不参与计算. 为None时每行为一组.
+    normalize : bool
+        为True时把排名转换到[0, 1]: (rank - 1) / (max_rank - 1), 组内最大排名为1时除数为1.
+
+    Returns
+    -------
+    np.ndarray
+
+    """
+    values = np.asarray(values, dtype=float)
+    valid = _valid(values, valid)
+    if codes is not None:
+        valid &= codes >= 0
+    order, sorted_values, start, count = _sort_rows(values, valid, codes)
+    position = np.arange(order.shape[1])
+    # 相同的值取第一个的位置
+    new_tie = np.ones(order.shape, dtype=bool)
+    new_tie[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    new_tie |= position == start
+    tie = np.maximum.accumulate(np.where(new_tie, position, 0), axis=1)
+    res = (tie - start + 1).astype(float)
+    if normalize:
+        # 分组内最后一个值的排名最大
+        last = np.clip(start + count - 1, 0, order.shape[1] - 1)
+        last += (np.arange(order.shape[0]) * order.shape[1])[:, np.newaxis]
+        max_rank = res.ravel().take(last)
+        max_rank[max_rank > 1] -= 1
+        res -= 1
+        res /= max_rank
+    return _unsort(res, order, valid)
+
+
+def quantile(values, n_quantiles, valid=None, codes=None):
+    """
+    每行(及每个分组内)按值从小到大分为n_quantiles组, 返回所在组的序号(从1开始).
+    与jaqs.util.numeric.quantilize_without_nan相同, 相同的值按列的顺序排列.
+
+    参数见rank.
+    """
+    values = np.asarray(values, dtype=float)
+    valid = _valid(values, valid)
+    if codes is not None:
+        valid &= codes >= 0
+    order, _, start, count = _sort_rows(values, valid, codes)
+    position = np.arange(order.shape[1])
+    divisor = count * 1. / n_quantiles
+    res = np.floor((position - start) / divisor) + 1.0
+    return _unsort(res, order, valid)
+
+
+def standardize(values, valid=None):
+    """每行减去均值后除以标准差(ddof=1), 有效值少于2个时为NaN."""
+    # 按行连续存放, 求和的顺序(及结果)不随输入的内存布局变化
+    values = np.ascontiguousarray(values, dtype=float)
+    valid = _valid(values, valid)
+    count = valid.sum(axis=1)[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = np.where(valid, values, 0.0)
+        res -= res.sum(axis=1)[:, np.newaxis] / count
+        res[~valid] = 0.0
+        std = np.sqrt((res * res).sum(axis=1)[:, np.newaxis] / (count - 1))
+        res /= std
+    res[~valid] = np.nan
+    return res
@@ -1,5 +1,5 @@
+import numpy as np
 import pandas as pd
-from collections import defaultdict
 
 
 English_classify = {'480000': 'Bank',
@@ -130,11 +130,100 @@ def expand(data, index, default=False, prefix=True, key="symbol", start="in_date
 
     """
     if isinstance(data, pd.DataFrame) and isinstance(index, pd.Index):
-        dct = defaultdict(lambda: pd.Series(default, index))
-        for name, row in data.iterrows():
-            s = dct[row[key]]
-            s.loc[row[start]:row[end]] = prefix if value is None else row[value]
-        return pd.DataFrame(dct)
+        columns, codes = _factorize(data[key].values)
+        lo, hi = _interval_positions(index, data[start].values, data[end].values)
+        if value is None:
+            fill = np.array([prefix] * len(data), dtype=object)
+        else:
+            fill = data[value].values
+        dtype = _expand_dtype(default, fill)
+
+        # 每个格子被覆盖的次数及覆盖它的行号之和, 只被一行覆盖时行号之和即为该行
+        count = _interval_cover(len(index), len(columns), codes, lo, hi)
+        rows = _interval_cover(len(index), len(columns), codes, lo, hi, weights=np.arange(len(data)))
+        out = np.full(count.shape, default, dtype=dtype)
+        single = count == 1
+        out[single] = fill[rows[single]]
+        # 同一key的区间有重叠时, 按原先逐行赋值的顺序由后面的行覆盖前面的行
+        for col in np.flatnonzero((count > 1).any(axis=0)):
+            for row in np.flatnonzero(codes == col):
+                out[lo[row]:hi[row], col] = fill[row]
+        return pd.DataFrame(out, index=index, columns=columns)
+
+
+def _factorize(keys):
+    # 按首次出现的顺序编号
+    uniques, first, codes = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='mergesort')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return uniques[order], rank[codes]
+
+
+def _interval_positions(index, starts, ends):
+    # 闭区间[start, end]在有序index中对应的位置区间[lo, hi)
+    index = np.asarray(index)
+    lo = index.searchsorted(np.asarray(starts), side='left')
+    hi = index.searchsorted(np.asarray(ends), side='right')
+    return lo, np.maximum(hi, lo)
+
+
+def _interval_cover(n_rows, n_cols, codes, lo, hi, weights=None):
+    """
+    用差分数组累加各区间的权重, 一次cumsum得到 n_rows x n_cols 的覆盖矩阵.
+
+    Parameters
+    ----------
+    n_rows : int
+    n_cols : int
+    codes : np.ndarray
+        每个区间所在的列
+    lo, hi : np.ndarray
+        每个区间的位置范围[lo, hi)
+    weights : np.ndarray, optional
+        每个区间的权重, 默认为1
+
+    Returns
+    -------
+    np.ndarray
+
+    """
+    if weights is None:
+        weights = np.ones(len(codes), dtype=np.int64)
+    diff = np.zeros((n_rows + 1, n_cols), dtype=np.int64)
+    np.add.at(diff, (lo, codes), weights)
+    np.add.at(diff, (hi, codes), -weights)
+    return diff[:-1].cumsum(axis=0)
+
+
+def _expand_dtype(default, fill):
+    # 与pandas一致, 默认值None在数值列中视为NaN
+    values = np.array([np.nan if default is None else default] + list(pd.unique(fill)))
+    if values.dtype.kind in 'biuf':
+        return values.dtype
+    return object
+
+
+def interval_mask(index, keys, starts, ends, columns=None):
+    """
+    把(key, 开始日期, 结束日期)区间展开为逐日的0/1矩阵, 日期落在任一区间(含首尾)时为1.
+
+    :param index: 有序的日期序列, 作为输出表的index
+    :param keys: 每个区间所属的key, 作为输出表的columns
+    :param starts: 区间开始日期
+    :param ends: 区间结束日期
+    :param columns: 输出的columns, 默认为排序后的keys
+    :return: pd.DataFrame, 值为int64
+    """
+    keys = np.asarray(keys)
+    if columns is None:
+        columns = np.unique(keys)
+    columns = pd.Index(columns)
+    codes = columns.get_indexer(keys)
+    valid = codes >= 0
+    lo, hi = _interval_positions(index, np.asarray(starts)[valid], np.asarray(ends)[valid])
+    count = _interval_cover(len(index), len(columns), codes[valid], lo, hi)
+    return pd.DataFrame((count > 0).astype(np.int64), index=index, columns=columns)
 
 
 # 日线级指数表
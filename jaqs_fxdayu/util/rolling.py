@@ -0,0 +1,233 @@
+# encoding: utf-8
+"""
+跳过NaN(如停牌)的滚动计算: 每个symbol只使用自身的有效值, 结果与
+df.apply(lambda x: x.dropna().rolling(n).xxx()).reindex(df.index)
+相同, 但对整个 日期 x symbol 数组一次完成, 不需要对每个symbol分别构造rolling对象.
+
+做法: 按每列有效值的序号把有效值移到该列顶部(compact), 对压缩后的数组整体做滚动计算, 再放回原来的位置(expand).
+
+rolling_product, rolling_dot, rolling_argmax等对整个数组按窗口内的偏移逐次计算, 代替对每个窗口调用python函数的rolling.apply.
+
+rolling_corr, rolling_cov用分块的累计和计算窗口内的各阶矩, 代替DataFrame.rolling().corr/cov.
+
+"""
+import numpy as np
+import pandas as pd
+
+
+def compact(values):
+    """
+    把每列的有效值按原顺序移到该列顶部.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        二维数组
+
+    Returns
+    -------
+    compacted : np.ndarray
+        行数为各列有效值个数的最大值, 每列有效值之后为NaN
+    positions : tuple of np.ndarray
+        有效值在原数组及compacted中的位置, 用于expand
+
+    """
+    # 按symbol连续存放, 每个symbol的有效值依次复制
+    values = np.ascontiguousarray(np.asarray(values, dtype=float).T)
+    mask = ~np.isnan(values)
+    counts = mask.sum(axis=1)
+    n_rows = int(counts.max()) if counts.size else 0
+    slots = np.arange(n_rows) < counts[:, np.newaxis]
+    compacted = np.full((len(values), n_rows), np.nan)
+    compacted[slots] = values[mask]
+    return compacted.T, (mask, slots)
+
+
+def expand(compacted, positions):
+    """compact的逆操作, 原数组中无效值的位置为NaN."""
+    mask, slots = positions
+    res = np.full(mask.shape, np.nan)
+    res[mask] = compacted.T[slots]
+    return res.T
+
+
+def rolling_product(values, n):
+    """
+    按列计算最近n行的乘积, 前n-1行为NaN. 窗口内依次相乘, 与np.product的结果相同.
+    """
+    res = np.full(values.shape, np.nan)
+    m = len(values) - n + 1
+    if m > 0:
+        prod = values[:m].copy()
+        for i in range(1, n):
+            prod *= values[i:i + m]
+        res[n - 1:] = prod
+    return res
+
+
+def rolling_skipna(df, n, how):
+    """
+    对每列的有效值做窗口为n的滚动计算, 窗口内不足n个有效值时为NaN.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        index为日期, columns为symbol
+    n : int
+    how : str or callable
+        pandas Rolling的方法名, 如'mean', 'sum', 'std', 'min', 'max', 'kurt', 'skew';
+        'product'; 或func(values, n), 返回与values形状相同的数组, 第i行为以第i行结尾的窗口的结果.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    compacted, positions = compact(df.values)
+    if how == 'product':
+        res = rolling_product(compacted, n)
+    elif callable(how):
+        res = how(compacted, n)
+    else:
+        res = getattr(pd.DataFrame(compacted).rolling(n), how)().values
+    return pd.DataFrame(expand(res, positions), index=df.index, columns=df.columns)
+
+
+def rolling_dot(values, weights):
+    """
+    按列计算最近len(weights)行与weights的加权和, 窗口内最早的值对应weights[0], 前len(weights)-1行为NaN.
+    窗口内有NaN时结果为NaN.
+    """
+    n = len(weights)
+    res = np.full(values.shape, np.nan)
+    m = len(values) - n + 1
+    if m > 0:
+        total = values[:m] * weights[0]
+        buf = np.empty_like(total)
+        for i in range(1, n):
+            np.multiply(values[i:i + m], weights[i], out=buf)
+            total += buf
+        res[n - 1:] = total
+    return res
+
+
+def _rolling_arg(values, n, better, pick):
+    values = np.asarray(values, dtype=float)
+    res = np.full(values.shape, np.nan)
+    m = len(values) - n + 1
+    if m > 0:
+        best = values[:m].copy()
+        pos = np.zeros_like(best)
+        # 与pandas rolling一致, inf视为NaN
+        has_nan = ~np.isfinite(best)
+        # 预先分配的临时数组
+        flag = np.empty_like(best, dtype=bool)
+        step = np.empty_like(best)
+        for i in range(1, n):
+            current = values[i:i + m]
+            # 相同的值取最早的位置. 不使用布尔索引赋值, 避免逐元素的分支
+            better(current, best, out=flag)
+            np.subtract(i, pos, out=step)
+            step *= flag
+            pos += step
+            pick(best, current, out=best)
+            np.isfinite(current, out=flag)
+            np.logical_not(flag, out=flag)
+            has_nan |= flag
+        pos[has_nan] = np.nan
+        res[n - 1:] = pos
+    return res
+
+
+def rolling_argmax(values, n):
+    """
+    按列计算最近n行中最大值的位置(0为窗口内最早的一行), 前n-1行及窗口内有NaN或inf时为NaN.
+    与rolling(n).apply(np.argmax)相同.
+    """
+    return _rolling_arg(values, n, np.greater, np.maximum)
+
+
+def rolling_argmin(values, n):
+    """最近n行中最小值的位置, 见rolling_argmax."""
+    return _rolling_arg(values, n, np.less, np.minimum)
+
+
+# 分块计算累计和时每块的最少行数
+_CUMSUM_BLOCK = 256
+# 累计和之差相对于累计和的量级小于该值时视为0
+_ROUNDING = 1e-12
+
+
+def _window_sums(values, n, scale=False):
+    """
+    按列计算以每行结尾的最近n行(不足n行时为已有的行)之和.
+
+    用累计和之差计算, 累计和每块重新开始, 误差只与块长度有关, 不随数据长度累积.
+    scale为True时同时返回相减的两个累计和的绝对值之和, 即结果的舍入误差的量级(相对于机器精度).
+    """
+    res = np.empty(values.shape)
+    magnitude = np.empty(values.shape) if scale else None
+    block = max(n, _CUMSUM_BLOCK)
+    zero = np.zeros((1,) + values.shape[1:])
+    for start in range(0, len(values), block):
+        stop = min(start + block, len(values))
+        # 块内第一行的窗口从lo开始
+        lo = max(start - n + 1, 0)
+        cumsum = np.concatenate([zero, np.cumsum(values[lo:stop], axis=0)])
+        rows = np.arange(start, stop)
+        high = cumsum[rows - lo + 1]
+        low = cumsum[np.maximum(rows - n + 1, lo) - lo]
+        res[start:stop] = high - low
+        if scale:
+            magnitude[start:stop] = np.abs(high) + np.abs(low)
+    if scale:
+        return res, magnitude
+    return res
+
+
+def _pair_moments(x, y, n):
+    """
+    窗口内x, y同时有效的值的个数, 及离差的乘积和, x的平方和, y的平方和.
+    平方和中舍入误差范围内的值(窗口内的值不变)为NaN.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    count = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # 协方差与平移无关, 减去各列的均值以减小累计和的量级
+        x = np.where(valid, x, 0.0)
+        y = np.where(valid, y, 0.0)
+        x -= np.where(valid, np.nan_to_num(x.sum(axis=0) / count), 0.0)
+        y -= np.where(valid, np.nan_to_num(y.sum(axis=0) / count), 0.0)
+        c = _window_sums(valid.astype(float), n)
+        sx = _window_sums(x, n)
+        sy = _window_sums(y, n)
+        sxy = _window_sums(x * y, n) - sx * sy / c
+        sxx, scale_x = _window_sums(x * x, n, scale=True)
+        syy, scale_y = _window_sums(y * y, n, scale=True)
+        sxx -= sx * sx / c
+        syy -= sy * sy / c
+    sxx[sxx <= _ROUNDING * scale_x] = np.nan
+    syy[syy <= _ROUNDING * scale_y] = np.nan
+    # 少于2个有效值时无法计算
+    c[c < 2] = np.nan
+    return c, sxy, sxx, syy
+
+
+def rolling_cov(x, y, n):
+    """
+    按列计算最近n行的样本协方差, 只使用x, y同时有效的值, 至少需要2个.
+    与pd.DataFrame.rolling(n, min_periods=1).cov相同.
+    """
+    c, sxy, _, _ = _pair_moments(x, y, n)
+    return sxy / (c - 1)
+
+
+def rolling_corr(x, y, n):
+    """
+    按列计算最近n行的相关系数, 只使用x, y同时有效的值. 有效值少于2个或窗口内x或y不变时为NaN.
+    与pd.DataFrame.rolling(n, min_periods=1).corr相同.
+    """
+    c, sxy, sxx, syy = _pair_moments(x, y, n)
+    return sxy / np.sqrt(sxx * syy)
@@ -0,0 +1,51 @@
+# encoding: utf-8
+import numpy as np
+import pandas as pd
+
+from jaqs.util.numeric import quantilize_without_nan
+from jaqs_fxdayu.util import cross_section
+
+
+def _make_frame():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(np.round(rng.randn(30, 20), 1))
+    df[rng.rand(*df.shape) < 0.2] = np.nan
+    df.iloc[3] = np.nan
+    df.iloc[4] = 1.0
+    group = pd.DataFrame(rng.choice(['a', 'b', 'c', None], size=df.shape))
+    return df, group
+
+
+def test_rank():
+    df, group = _make_frame()
+    valid = np.random.RandomState(1).rand(*df.shape) > 0.2
+    masked = df.where(valid)
+    res = cross_section.rank(df.values, valid)
+    assert np.allclose(res, masked.rank(axis=1, method='min').values, equal_nan=True)
+
+    res = cross_section.rank(df.values, valid, cross_section.group_codes(group), normalize=True)
+    for i in range(len(df)):
+        row = masked.iloc[i].groupby(group.iloc[i]).rank(method='min')
+        max_rank = row.groupby(group.iloc[i]).transform('max')
+        expected = (row - 1) / np.where(max_rank > 1, max_rank - 1, 1)
+        assert np.allclose(res[i], expected.reindex(df.columns).values, equal_nan=True)
+
+
+def test_quantile():
+    df, group = _make_frame()
+    values = df.rank(axis=1, method='first').values + df.values * 0
+    res = cross_section.quantile(values, 3)
+    assert np.allclose(res, quantilize_without_nan(values, n_quantiles=3, axis=1), equal_nan=True)
+
+    res = cross_section.quantile(values, 3, codes=cross_section.group_codes(group))
+    for key in ['a', 'b', 'c']:
+        in_group = np.where(group.values == key, values, np.nan)
+        expected = quantilize_without_nan(in_group, n_quantiles=3, axis=1)
+        assert np.allclose(res[group.values == key], expected[group.values == key], equal_nan=True)
+    assert np.isnan(res[group.isnull().values]).all()
+
+
+def test_standardize():
+    df, _ = _make_frame()
+    expected = df.sub(df.mean(axis=1), axis=0).div(df.std(axis=1), axis=0)
+    assert np.allclose(cross_section.standardize(df.values), expected.values, equal_nan=True)
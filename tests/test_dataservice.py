@@ -0,0 +1,273 @@
+# encoding: utf-8
+import os
+import sqlite3
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from jaqs_fxdayu.data.dataservice import LocalDataService, SQL_MAX_PARAMS
+from jaqs_fxdayu.data.hdf5_pool import H5Pool
+
+
+TRADE_DATES = [int(d) for d in pd.bdate_range('2017-01-02', periods=30).strftime('%Y%m%d')]
+DAILY_SYMBOLS = ['000001.SZ', '000002.SZ', '600000.SH', '600004.SH']
+BAR_SYMBOLS = ['A.X', 'B.X', 'C.X']
+
+
+def _write_h5(path, data, dates, symbols, chunks=None):
+    """按本地数据的格式写入单个字段文件: data为 dates × symbols, 另有symbol_flag/date_flag."""
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('data', data=data, chunks=chunks)
+        f.create_dataset('symbol_flag', data=np.array(symbols, dtype='S')[:, None])
+        f.create_dataset('date_flag', data=np.array(dates, dtype=np.int64)[:, None])
+
+
+def _make_local_data(folder):
+    """
+    在folder下生成离线数据:
+    data.sqlite中有交易日历及lb.income; Stock_D下为日线字段, 其中volume的symbol与其他字段不同;
+    Bar下为分钟线, chunk为16行, 部分symbol在部分时间没有数据.
+
+    """
+    folder = str(folder)
+    rng = np.random.RandomState(0)
+
+    conn = sqlite3.connect(os.path.join(folder, 'data.sqlite'))
+    conn.execute('CREATE TABLE "jz.secTradeCal" (trade_date INTEGER)')
+    conn.executemany('INSERT INTO "jz.secTradeCal" VALUES (?)', [(d, ) for d in TRADE_DATES])
+    conn.execute('CREATE TABLE "lb.income" (symbol TEXT, ann_date TEXT, report_date TEXT, '
+                 'report_type TEXT, net_profit REAL, oper_rev REAL)')
+    rows = []
+    for k in range(1200):
+        for report_date, ann_date in [('20161231', '20170320'), ('20170331', '20170425')]:
+            rows.append(('%06d.SZ' % k, ann_date, report_date, '408001000', rng.randn(), rng.rand()))
+    conn.executemany('INSERT INTO "lb.income" VALUES (?,?,?,?,?,?)', rows)
+    conn.commit()
+    conn.close()
+
+    daily = os.path.join(folder, 'Stock_D')
+    os.makedirs(daily)
+    shape = (len(TRADE_DATES), len(DAILY_SYMBOLS))
+    for field in ['open', 'high', 'low', 'close', 'vwap']:
+        data = rng.rand(*shape) + 10
+        data[rng.rand(*shape) < 0.1] = np.nan
+        _write_h5(os.path.join(daily, field + '.hd5'), data, TRADE_DATES, DAILY_SYMBOLS)
+    adj = np.cumprod(1 + (rng.rand(*shape) < 0.05) * 0.1, axis=0)
+    _write_h5(os.path.join(daily, 'adjust_factor.hd5'), adj, TRADE_DATES, DAILY_SYMBOLS)
+    # volume文件少一个symbol, 多一个其他字段没有的symbol
+    volume_symbols = DAILY_SYMBOLS[1:] + ['600005.SH']
+    _write_h5(os.path.join(daily, 'volume.hd5'), rng.rand(len(TRADE_DATES), len(volume_symbols)) * 1e4,
+              TRADE_DATES, volume_symbols)
+
+    bar = os.path.join(folder, 'Bar')
+    os.makedirs(bar)
+    times = pd.date_range('2018-01-02 09:31', periods=150, freq='1min')
+    dates = [int(t) for t in times.strftime('%Y%m%d%H%M%S')]
+    shape = (len(times), len(BAR_SYMBOLS))
+    missing = rng.rand(*shape) < 0.2
+    missing[:40, 2] = True
+    text = np.array([[t] * shape[1] for t in times.strftime('%Y-%m-%d %H:%M:%S.000')], dtype='S')
+    text[missing] = b'None'
+    _write_h5(os.path.join(bar, 'datetime.hd5'), text, dates, BAR_SYMBOLS, chunks=(16, shape[1]))
+    for field in ['close', 'volume']:
+        data = rng.rand(*shape) + 10
+        data[missing] = np.nan
+        _write_h5(os.path.join(bar, field + '.hd5'), data, dates, BAR_SYMBOLS, chunks=(16, shape[1]))
+    return folder
+
+
+def _sort_bars(df):
+    return df.sort_values(by=['symbol', 'trade_date']).reset_index(drop=True)
+
+
+def test_h5_pool(tmpdir):
+    folder = _make_local_data(tmpdir)
+    paths = [os.path.join(folder, 'Stock_D', f + '.hd5') for f in ['open', 'close', 'volume']]
+    pool = H5Pool(max_size=2)
+    with pool.open(paths[0]) as h5:
+        first = h5
+        assert list(h5.symbols) == DAILY_SYMBOLS
+        assert list(h5.dates) == TRADE_DATES
+    # 文件未修改时复用句柄及索引
+    with pool.open(paths[0]) as h5:
+        assert h5 is first
+
+    # 文件被更新后重新打开
+    _write_h5(paths[0] + '.new', np.zeros((3, 2)), TRADE_DATES[:3], DAILY_SYMBOLS[:2])
+    os.rename(paths[0] + '.new', paths[0])
+    mtime = os.path.getmtime(paths[0]) + 10
+    os.utime(paths[0], (mtime, mtime))
+    with pool.open(paths[0]) as h5:
+        assert h5 is not first
+        assert list(h5.dates) == TRADE_DATES[:3]
+        reopened = h5
+
+    # 超出max_size时关闭最久未使用的空闲句柄, 使用中的句柄不会被关闭
+    with pool.open(paths[1]):
+        with pool.open(paths[2]):
+            assert len(pool) == 2
+            assert not reopened.file
+    pool.clear()
+    assert len(pool) == 0
+
+
+def test_query_one_pool(tmpdir):
+    folder = _make_local_data(tmpdir)
+    path = os.path.join(folder, 'Stock_D')
+    pool = H5Pool()
+    for symbol in [None, ['600000.SH', '000001.SZ', 'XX'], ['600005.SH']]:
+        expected = LocalDataService.query_one('volume', path, symbol=symbol, start_date=TRADE_DATES[2],
+                                              end_date=TRADE_DATES[20], pool=H5Pool())
+        for _ in range(2):
+            res = LocalDataService.query_one('volume', path, symbol=symbol, start_date=TRADE_DATES[2],
+                                             end_date=TRADE_DATES[20], pool=pool)
+            pd.testing.assert_frame_equal(res, expected)
+    assert len(pool) == 1
+
+
+def test_locate_symbols_and_read(tmpdir):
+    path = os.path.join(str(tmpdir), 'field.hd5')
+    symbols = ['%06d.SZ' % k for k in range(20)][::-1]
+    data = np.arange(30 * 20, dtype=float).reshape(30, 20)
+    _write_h5(path, data, TRADE_DATES, symbols)
+    pool = H5Pool()
+    with pool.open(path) as h5:
+        # 结果为升序去重的列号, 不存在的symbol被忽略
+        cols = h5.locate_symbols(['000003.SZ', 'XX', '000019.SZ', '000003.SZ'])
+        assert list(cols) == [0, 16]
+        assert len(h5.locate_symbols([])) == 0
+        for cols in [[3, 4, 5, 6],                # 连续区间
+                     [2, 3, 5, 6, 7],             # 稠密, 读取外接区间
+                     [0, 9, 19],                  # 稀疏, fancy indexing
+                     [7]]:
+            np.testing.assert_array_equal(h5.read(5, 17, np.array(cols)), data[5:17][:, cols])
+        assert h5.read(5, 17, np.array([], dtype=np.int64)).shape == (12, 0)
+
+
+def test_parallel_fields(tmpdir):
+    folder = _make_local_data(tmpdir)
+    bar = os.path.join(folder, 'Bar')
+    symbol = ','.join(DAILY_SYMBOLS)
+    serial = LocalDataService(folder)
+    expected_daily, _ = serial.daily(symbol, TRADE_DATES[2], TRADE_DATES[20], 'open,close,volume', adjust_mode='post')
+    expected_bars = serial.bar_reader(bar, {'fields': 'close,volume'})
+    for executor in ('thread', 'process'):
+        ds = LocalDataService(folder, max_workers=3, executor=executor)
+        df, _ = ds.daily(symbol, TRADE_DATES[2], TRADE_DATES[20], 'open,close,volume', adjust_mode='post')
+        pd.testing.assert_frame_equal(df[expected_daily.columns], expected_daily)
+        bars = ds.bar_reader(bar, {'fields': 'close,volume'})
+        pd.testing.assert_frame_equal(bars[expected_bars.columns], expected_bars)
+    with pytest.raises(ValueError):
+        LocalDataService(folder, executor='gevent')
+
+
+def test_daily_blocks_match_daily(tmpdir):
+    folder = _make_local_data(tmpdir)
+    ds = LocalDataService(folder)
+    symbol = ','.join(DAILY_SYMBOLS + ['600005.SH', 'XX'])
+    fields = ['open', 'close', 'volume', 'adjust_factor']
+    for adjust_mode in (None, 'post', 'pre'):
+        df, _ = ds.daily(symbol, TRADE_DATES[3], TRADE_DATES[20], ','.join(fields), adjust_mode=adjust_mode)
+        blocks = ds.daily_blocks(symbol, TRADE_DATES[3], TRADE_DATES[20], ','.join(fields),
+                                 adjust_mode=adjust_mode)
+        assert sorted(b[0] for b in blocks) == sorted(fields)
+        for field, data, dates, symbols in blocks:
+            # volume文件的symbol与其他字段不同, 数据块对齐到并集
+            assert list(dates) == TRADE_DATES[3:21]
+            assert list(symbols) == DAILY_SYMBOLS + ['600005.SH']
+            expected = df.pivot(index='trade_date', columns='symbol', values=field).reindex(index=dates,
+                                                                                           columns=symbols)
+            np.testing.assert_allclose(data.astype(float), expected.values.astype(float))
+
+
+def test_bar_epoch(tmpdir):
+    folder = _make_local_data(tmpdir)
+    bar = os.path.join(folder, 'Bar')
+    ds = LocalDataService(folder)
+    props = {'symbol': 'A.X,C.X', 'start_date': 20180102093500, 'end_date': 20180102110000}
+    expected = ds.bar_reader(bar, props)
+    assert expected['datetime'].dtype.kind == 'M'
+    assert not expected['datetime'].isnull().any()
+    assert (expected['trade_date'].values ==
+            expected['datetime'].dt.strftime('%Y%m%d%H%M%S').astype(np.int64).values).all()
+
+    # 重复生成时覆盖已有的epoch数据集
+    for _ in range(2):
+        ds.build_bar_epoch(bar)
+        with h5py.File(os.path.join(bar, 'datetime.hd5'), 'r') as f:
+            epoch = f['epoch'][:]
+        assert (epoch[:40, 2] == np.iinfo(np.int64).min).all()
+        raw = LocalDataService.query_one('datetime', bar, epoch=True)
+        assert raw.values.dtype.kind == 'i'
+        res = ds.bar_reader(bar, props)
+        pd.testing.assert_frame_equal(res[expected.columns], expected)
+
+
+def test_iter_bars_match_bar_reader(tmpdir):
+    folder = _make_local_data(tmpdir)
+    bar = os.path.join(folder, 'Bar')
+    ds = LocalDataService(folder)
+    for props in [{}, {'symbol': 'B.X,C.X', 'start_date': 20180102094000, 'end_date': 20180102113300}]:
+        expected = _sort_bars(ds.bar_reader(bar, dict(props)))
+        for chunk_rows in (None, 1, 16, 20, 40, 1000):
+            chunks = list(ds.iter_bars(bar, dict(props), chunk_rows=chunk_rows))
+            # 块的边界对齐到hdf5 chunk(16行)
+            step = 16 if not chunk_rows else int(np.ceil(chunk_rows / 16.0)) * 16
+            assert all(df['trade_date'].nunique() <= step for df in chunks)
+            res = _sort_bars(pd.concat(chunks))
+            pd.testing.assert_frame_equal(res, expected)
+
+        props = dict(props, freq='1Min,5Min,15Min')
+        expected = ds.bar_reader(bar, dict(props))
+        for chunk_rows in (16, 40):
+            chunks = list(ds.iter_bars(bar, dict(props), chunk_rows=chunk_rows))
+            for freq in ['5Min', '15Min']:
+                res = pd.concat([c[freq] for c in chunks])
+                res = res.sort_values(by=['symbol', 'datetime']).reset_index(drop=True)
+                exp = expected[freq].sort_values(by=['symbol', 'datetime']).reset_index(drop=True)
+                pd.testing.assert_frame_equal(res[exp.columns], exp)
+
+
+def test_sql_symbol_batches(tmpdir):
+    folder = _make_local_data(tmpdir)
+    ds = LocalDataService(folder)
+    conn = sqlite3.connect(os.path.join(folder, 'data.sqlite'))
+    table = pd.read_sql('SELECT * FROM "lb.income"', conn)
+    conn.close()
+
+    # symbol数超过SQL_MAX_PARAMS时分批查询后合并
+    symbols = ['%06d.SZ' % k for k in range(1200)] + ['XX']
+    assert len(symbols) > 2 * SQL_MAX_PARAMS
+    df, msg = ds.query_lb_fin_stat('income', ','.join(symbols), 20170101, 20170401, 'net_profit')
+    expected = table[table['ann_date'] <= '20170401']
+    assert msg == '0,'
+    assert len(df) == len(expected) == 1200
+    assert (df['symbol'].values == expected['symbol'].values).all()
+    np.testing.assert_allclose(df['net_profit'].values, expected['net_profit'].values)
+
+    df, _ = ds.query('lb.income', 'symbol=%s&start_date=20170401' % ','.join(symbols[::2]), 'symbol,ann_date')
+    assert list(df['symbol']) == symbols[:-1:2]
+    assert df['ann_date'].dtype == np.float64 and (df['ann_date'] == 20170425).all()
+
+    res = ds._read_sql('SELECT symbol FROM "lb.income" WHERE report_date = ? AND symbol IN {symbols}',
+                       ['20161231'], symbols=symbols, data_format='list')
+    assert res == symbols[:-1]
+    assert ds._read_sql('SELECT symbol FROM "lb.income" WHERE symbol IN {symbols}', symbols=[]).empty
+
+
+def test_build_indexes(tmpdir):
+    folder = _make_local_data(tmpdir)
+    ds = LocalDataService(folder)
+    names = ds.build_indexes()
+    assert sorted(names) == ['idx_lb_income_ann_date', 'idx_lb_income_symbol_ann_date']
+    # 重复执行不会报错, 也不会建立新的索引
+    assert ds.build_indexes() == names
+    conn = sqlite3.connect(os.path.join(folder, 'data.sqlite'))
+    exist = [i[0] for i in conn.execute('SELECT name FROM sqlite_master WHERE type="index"')]
+    conn.close()
+    assert sorted(exist) == sorted(names)
+
+    df, _ = ds.query_lb_fin_stat('income', '000001.SZ,000002.SZ', 20170101, 20171231, 'net_profit')
+    assert len(df) == 4
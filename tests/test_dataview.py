@@ -1,6 +1,12 @@
 # encoding: utf-8
 from __future__ import print_function
 
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
 # import jaqs_fxdayu
 # jaqs_fxdayu.patch_all()
 from jaqs_fxdayu.data import RemoteDataService
@@ -99,6 +105,23 @@ def test_add_formula():
     assert dv.data_d.shape == (nrows, ncols + 2 * n_securities)
 
 
+def test_add_formulas():
+    dv = DataView()
+    dv.load_dataview(folder_path=daily_path)
+    nrows, ncols = dv.data_d.shape
+    n_securities = len(dv.data_d.columns.levels[0])
+
+    formulas = {'myvar2': 'myvar1 - close',
+                'myvar1': 'Delta(high - close, 1)',
+                'myvar3': 'Rank(high - close) + Delta(high - close, 1)'}
+    added = dv.add_formulas(formulas)
+    # myvar2依赖myvar1, 在其后计算
+    assert set(added[:2]) == {'myvar1', 'myvar3'} and added[2] == 'myvar2'
+    assert dv.data_d.shape == (nrows, ncols + 3 * n_securities)
+    expected = dv.add_formula('check', 'Delta(high - close, 1) - close', is_quarterly=False)
+    assert np.allclose(dv.get_ts('myvar2').values, expected.values, equal_nan=True)
+
+
 def test_dataview_universe():
     ds = RemoteDataService()
     ds.init_from_config(data_config)
@@ -185,16 +208,157 @@ def test_q_add_formula():
     assert not df2.empty
 
 
+
+class _SuspendedDataService(object):
+    """离线数据: 第一个symbol在中间停牌, 第二个symbol在中间上市, 另有季度数据net_profit."""
+    def __init__(self):
+        self.dates = np.array(pd.bdate_range('2017-01-02', periods=120).strftime('%Y%m%d').astype(int))
+        self.symbols = ['000001.SZ', '000002.SZ', '600000.SH']
+        rng = np.random.RandomState(0)
+        index = pd.MultiIndex.from_product([self.dates, self.symbols], names=['trade_date', 'symbol'])
+        df = pd.DataFrame({'close': rng.rand(len(index)) + 10, 'volume': rng.rand(len(index)) * 1e4,
+                           'trade_status': 1.0}, index=index)
+        df.loc[(self.dates[70:95], '000001.SZ'), ['close', 'volume']] = np.nan
+        df = df.drop(list(zip(self.dates[:75], ['000002.SZ'] * 75)))
+        for field in ['open', 'high', 'low', 'close', 'vwap']:
+            df[field] = df['close']
+            df[field + '_adj'] = df['close']
+        self.df = df.reset_index()
+
+        rows = []
+        for symbol in self.symbols:
+            for report_date, ann_date in [(20160930, 20161030), (20161231, 20170320), (20170331, 20170425),
+                                          (20170630, 20170620)]:
+                rows.append((symbol, ann_date, report_date, rng.randn(), '408001000'))
+        self.df_q = pd.DataFrame(rows, columns=['symbol', 'ann_date', 'report_date', 'net_profit', 'report_type'])
+
+    def query_trade_dates(self, start_date, end_date):
+        return self.dates[(self.dates >= int(start_date)) & (self.dates <= int(end_date))]
+
+    def daily(self, symbol, start_date, end_date, fields="", adjust_mode=None, **kwargs):
+        df = self.df
+        df = df[df['symbol'].isin(symbol.split(',')) & (df['trade_date'] >= int(start_date))
+                & (df['trade_date'] <= int(end_date))]
+        return df.copy(), '0,'
+
+    def query_lb_fin_stat(self, type_, symbol, start_date, end_date, fields="", drop_dup_cols=None, **kwargs):
+        df = self.df_q
+        df = df[df['symbol'].isin(symbol.split(',')) & (df['report_date'] >= int(start_date))
+                & (df['ann_date'] <= int(end_date))]
+        return df.copy(), '0,'
+
+    def query_inst_info(self, symbol, fields="", inst_type=""):
+        return pd.DataFrame({'symbol': symbol.split(','), 'inst_type': 1, 'name': 'x'}).set_index('symbol')
+
+    def query_adj_factor_daily(self, symbol_str, start_date, end_date, div=False):
+        return pd.DataFrame(1.0, index=self.query_trade_dates(start_date, end_date), columns=symbol_str.split(','))
+
+
+SUSPENDED_FIELDS = ['close', 'net_profit', 'm', 'm2', 'r', 'q1', 'mq']
+
+
+def _suspended_dv(ds, end_date, backend='frame'):
+    dv = DataView()
+    dv.init_from_config({'start_date': int(ds.dates[10]), 'end_date': int(end_date), 'symbol': ','.join(ds.symbols),
+                         'fields': 'close,volume,net_profit', 'all_price': False, 'backend': backend}, data_api=ds)
+    dv.prepare_data()
+    dv.add_formula('m', 'Ts_Mean(close, 5)', False, add_data=True)
+    dv.add_formula('m2', 'Delay(m, 3) * 2 + Ts_Max(volume, 7)', False, add_data=True)
+    dv.add_formula('r', 'Rank(m2)', False, add_data=True)
+    dv.add_formula('q1', 'net_profit * 2', True, add_data=True)
+    dv.add_formula('mq', 'Ts_Mean(close, 3) + q1', False, add_data=True)
+    return dv
+
+
+def _assert_same_fields(dv, expected, fields, start_date=0):
+    for field in fields:
+        assert np.allclose(dv.get_ts(field, start_date=start_date).values.astype(float),
+                           expected.get_ts(field, start_date=start_date).values.astype(float), equal_nan=True)
+
+
+def test_recompute_suspended():
+    ds = _SuspendedDataService()
+    full = _suspended_dv(ds, ds.dates[-1])
+    names = ['m', 'm2', 'r', 'mq']
+    for backend in ('frame', 'field_store'):
+        dv = _suspended_dv(ds, ds.dates[-1], backend)
+        for since in (ds.dates[97], ds.dates[-10]):
+            for field in names:
+                dv._write_field(field, dv.get_ts(field) * 0 + 1)
+            assert set(dv.recompute(fields='close,volume', since=int(since))) == set(names)
+            _assert_same_fields(dv, full, names, start_date=since)
+
+
+def test_refresh_data_suspended():
+    ds = _SuspendedDataService()
+    full = _suspended_dv(ds, ds.dates[-1])
+    end = int(ds.dates[-1])
+    for end_date in (ds.dates[90], ds.dates[100]):
+        for backend in ('frame', 'field_store'):
+            dv = _suspended_dv(ds, end_date, backend)
+            assert dv.refresh_data(end)
+            assert dv.end_date == end
+            _assert_same_fields(dv, full, SUSPENDED_FIELDS)
+            assert np.allclose(dv.get_ts_quarter('q1').values, full.get_ts_quarter('q1').values, equal_nan=True)
+
+        for data_format in ('hdf5', 'memmap'):
+            folder = tempfile.mkdtemp()
+            try:
+                _suspended_dv(ds, end_date).save_dataview(folder, data_format=data_format)
+                saved = DataView()
+                assert saved.update_dataview(folder, end, ds)
+                _assert_same_fields(saved, full, SUSPENDED_FIELDS)
+                loaded = DataView()
+                loaded.load_dataview(folder)
+                assert loaded.end_date == end
+                _assert_same_fields(loaded, full, SUSPENDED_FIELDS)
+            finally:
+                shutil.rmtree(folder)
+
+
+
+def test_formula_params_save():
+    ds = _SuspendedDataService()
+    dv = _suspended_dv(ds, ds.dates[90])
+    params = {'LEN': np.int64(5), 'K': np.float32(2)}
+    dv.add_formula('mp', 'Ts_Mean(close, LEN) * K', False, add_data=True, params=params)
+    assert dv.formulas['mp']['params'] == {'LEN': 5, 'K': 2.0}
+    assert type(dv.formulas['mp']['params']['LEN']) is int
+    try:
+        dv.add_formula('bad', 'close * K', False, add_data=True, params={'K': 'a'})
+        assert False
+    except ValueError:
+        pass
+
+    end = int(ds.dates[-1])
+    full = _suspended_dv(ds, end)
+    full.add_formula('mp', 'Ts_Mean(close, LEN) * K', False, add_data=True, params=params)
+    for data_format in ('hdf5', 'memmap'):
+        folder = tempfile.mkdtemp()
+        try:
+            dv.save_dataview(folder, data_format=data_format)
+            loaded = DataView()
+            loaded.load_dataview(folder)
+            assert loaded.formulas['mp']['params'] == {'LEN': 5, 'K': 2.0}
+            _assert_same_fields(loaded, dv, ['mp'])
+            assert loaded.update_dataview(folder, end, ds)
+            _assert_same_fields(loaded, full, ['mp'])
+        finally:
+            shutil.rmtree(folder)
+
+
 if __name__ == "__main__":
     g = globals()
     g = {k: v for k, v in g.items() if k.startswith('test_') and callable(v)}
 
     # for test_name, test_func in g.items():
     for test_name in ['test_write', 'test_load', 'test_add_field', 'test_add_formula_directly',
-                      'test_add_formula', 'test_dataview_universe',
+                      'test_add_formula', 'test_add_formulas', 'test_dataview_universe',
                       'test_q', 'test_q_get', 'test_q_add_field', 'test_q_add_formula',
+                      'test_recompute_suspended', 'test_refresh_data_suspended', 'test_formula_params_save',
                       ]:
         test_func = g[test_name]
         print("\n==========\nTesting {:s}...".format(test_name))
         test_func()
     print("Test Complete.")
+
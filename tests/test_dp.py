@@ -0,0 +1,24 @@
+# encoding: utf-8
+import numpy as np
+import pandas as pd
+
+from jaqs_fxdayu.util.dp import expand, interval_mask
+
+
+def test_expand_intervals():
+    dates = pd.Index([20170626, 20170627, 20170628, 20170629, 20170630, 20170703], name='trade_date')
+    industry = pd.DataFrame({'symbol': ['000001.SZ', '000006.SZ', '000006.SZ', '000006.SZ'],
+                             'in_date': [20140101, 20140101, 20151001, 20170629],
+                             'out_date': [99999999, 20151001, 20170629, 99999999],
+                             'name': ['bank', 'estate', 'mining', 'estate']})
+    res = expand(industry, dates, None, value='name')
+    assert list(res.columns) == ['000001.SZ', '000006.SZ']
+    assert (res['000001.SZ'] == 'bank').all()
+    # 20170629 同时落在两个区间内, 以后面的行为准
+    assert list(res['000006.SZ']) == ['mining'] * 3 + ['estate'] * 3
+
+    mask = interval_mask(dates.values, industry['symbol'].values,
+                         industry['in_date'].values, [20170101, 20170101, 20170627, 20170630])
+    assert mask.dtypes.unique().tolist() == [np.int64]
+    assert list(mask['000001.SZ']) == [0] * 6
+    assert list(mask['000006.SZ']) == [1, 1, 0, 1, 1, 0]
@@ -0,0 +1,195 @@
+# encoding: utf-8
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from jaqs_fxdayu.data import expr_compiler, py_expression_eval
+from jaqs_fxdayu.data.py_expression_eval import Parser, infer_lookback
+from jaqs_fxdayu.data.expr_compiler import CompiledExpression, IntermediateCache
+
+
+def _make_values():
+    rng = np.random.RandomState(0)
+    dates = pd.Index([20180102, 20180103, 20180104, 20180105, 20180108, 20180109], name='trade_date')
+    symbols = ['000001.SZ', '000002.SZ', '600000.SH']
+
+    def make(offset):
+        return pd.DataFrame(rng.rand(len(dates), len(symbols)) + offset, index=dates, columns=symbols)
+
+    close, open_, zero = make(10), make(10), make(0)
+    close.iloc[1, 0] = np.nan
+    zero.iloc[::2, :] = 0.0
+    return {'close': close, 'open': open_, 'z': zero}
+
+
+def test_compile_common_subexpression():
+    parser = Parser()
+    parser.parse('(close - open) / (close - open) + Rank(close - open)')
+    compiled = parser.compile()
+    assert isinstance(compiled, CompiledExpression)
+    # close, open, close - open, /, Rank, +
+    assert len(compiled.nodes) == 6
+    assert parser.compile() is compiled
+
+
+# 改动表达式求值及滚动计算之前(基线版本)的Parser.evaluate在_make_values上的结果
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'expr_baseline.json')
+# 累计和计算的滚动相关系数/协方差与pandas的结果有舍入误差
+BASELINE_INEXACT = {'Correlation(close, open, 3) + Covariance(close, open, 4)'}
+
+
+def test_matches_baseline():
+    values = _make_values()
+    snapshot = {k: v.copy() for k, v in values.items()}
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    parser = Parser()
+    for formula, rows in baseline.items():
+        expected = pd.DataFrame(np.array(rows, dtype=float), index=values['close'].index,
+                                columns=values['close'].columns)
+        parser.parse(formula)
+        for res in (parser.evaluate(values), parser._interpret(values)):
+            pd.testing.assert_frame_equal(res, expected, check_exact=formula not in BASELINE_INEXACT)
+            assert not np.isinf(res.values).any()
+        # 原地计算不修改输入数据
+        for name, df in values.items():
+            pd.testing.assert_frame_equal(df, snapshot[name])
+
+
+def test_intermediate_cache():
+    values = _make_values()
+    calls = []
+
+    def count(df):
+        calls.append(1)
+        return df * 2
+
+    parser = Parser()
+    parser.functions['count'] = count
+    formulas = ['count(close) + 1', 'Rank(count(close)) - count(close)', 'open * 2']
+    expected = []
+    for formula in formulas:
+        parser.parse(formula)
+        expected.append(parser.evaluate(values))
+    assert len(calls) == 2
+
+    for memory_limit, n_calls in [(None, 1), (0, 2)]:
+        del calls[:]
+        compiled = []
+        for formula in formulas:
+            parser.parse(formula)
+            compiled.append(parser.compile())
+        cache = IntermediateCache.from_expressions(compiled, memory_limit=memory_limit)
+        for formula, exp in zip(formulas, expected):
+            parser.parse(formula)
+            pd.testing.assert_frame_equal(parser.evaluate(values, cache=cache), exp)
+        assert len(calls) == n_calls
+        # 所有表达式计算完成后释放
+        assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_evaluate_peak_memory():
+    tracemalloc = pytest.importorskip('tracemalloc')
+    rng = np.random.RandomState(0)
+    values = {name: pd.DataFrame(rng.rand(400, 500) + 1) for name in ['close', 'open', 'high', 'low']}
+    nbytes = values['close'].values.nbytes
+    parser = Parser()
+    parser.parse('(close - open) / (high - low) * (close + open) - (high / low) * 2 + close * open')
+
+    def peak(func):
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    compiled = peak(lambda: parser.evaluate(values))
+    interpreted = peak(lambda: parser._interpret(values))
+    # 中间结果原地计算, 不为替换inf拷贝
+    assert compiled < 3 * nbytes
+    assert compiled < interpreted / 2
+
+
+def test_finite_funcs_name_style(monkeypatch):
+    checks = []
+    fillinf = expr_compiler._fillinf
+
+    def record(res, check=True):
+        checks.append(check)
+        return fillinf(res, check)
+
+    monkeypatch.setattr(expr_compiler, '_fillinf', record)
+    values = _make_values()
+    for style, formula in [('camel', 'Rank(close) + Delay(open, 1)'), ('lower', 'rank(close) + delay(open, 1)')]:
+        del checks[:]
+        parser = Parser()
+        parser.set_capital(style)
+        parser.parse(formula)
+        parser.evaluate(values)
+        # 排名及移动的结果不检查inf
+        assert checks == [False, False]
+    # 同名的自定义函数需要检查
+    del checks[:]
+    parser = Parser()
+    parser.set_capital('lower')
+    parser.functions['rank'] = lambda df: 1 / (df - df)
+    parser.parse('rank(close)')
+    assert not np.isinf(parser.evaluate(values).values).any()
+    assert checks == [True]
+
+
+def test_parse_cache_and_params():
+    values = _make_values()
+    formula = 'Ts_Mean(close, LEN) / Delay(open, LAG) * FAC'
+    parser = Parser()
+    expr = parser.parse(formula)
+    compiled = parser.compile()
+    assert sorted(expr.variables()) == ['FAC', 'LAG', 'LEN', 'close', 'open']
+    assert infer_lookback(expr, {'LEN': 3, 'LAG': 2, 'FAC': 0.5}) == 3
+
+    # 相同的表达式不再解析, 共用编译结果
+    other = Parser()
+    other.parse(formula)
+    assert other.tokens is parser.tokens and other.compile() is compiled
+    custom = Parser()
+    custom.functions['LEN'] = np.abs
+    custom.parse(formula)
+    assert custom.tokens is not parser.tokens
+
+    for n, lag, fac in [(2, 1, 0.5), (3, 2, -2)]:
+        res = other.evaluate(values, params={'LEN': n, 'LAG': lag, 'FAC': fac})
+        parser.parse('Ts_Mean(close, %d) / Delay(open, %d) * (%r)' % (n, lag, fac))
+        pd.testing.assert_frame_equal(res, parser.evaluate(values))
+
+
+def test_parse_cache_threads(monkeypatch):
+    # 缓存很小, 解析时不断淘汰
+    monkeypatch.setattr(py_expression_eval, 'PARSE_CACHE_SIZE', 4)
+    values = _make_values()
+    formulas = ['close * %d + open' % i for i in range(10)]
+    expected = [values['close'] * i + values['open'] for i in range(10)]
+    errors = []
+
+    def work():
+        parser = Parser()
+        try:
+            for _ in range(20):
+                for formula, exp in zip(formulas, expected):
+                    parser.parse(formula)
+                    assert isinstance(parser.tokens, tuple)
+                    pd.testing.assert_frame_equal(parser.evaluate(values), exp)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(py_expression_eval._parse_cache) <= 4
@@ -0,0 +1,104 @@
+# encoding: utf-8
+import numpy as np
+import pandas as pd
+import pytest
+
+from jaqs_fxdayu.data.field_store import FieldStore
+
+
+def _make_frame():
+    rng = np.random.RandomState(0)
+    dates = pd.Index([20180102, 20180103, 20180104, 20180105], name='trade_date')
+    cols = pd.MultiIndex.from_product([['000001.SZ', '000002.SZ', '600000.SH'], ['close', 'open']],
+                                      names=['symbol', 'field'])
+    return pd.DataFrame(rng.rand(len(dates), len(cols)), index=dates, columns=cols)
+
+
+def test_field_store_roundtrip():
+    df = _make_frame()
+    store = FieldStore.from_frame(df)
+    assert store.fields == ['close', 'open']
+    pd.testing.assert_frame_equal(store.to_frame(), df)
+
+    close = store.get('close', start_date=20180103, end_date=20180104)
+    expected = df.loc[20180103:20180104, pd.IndexSlice[:, 'close']]
+    expected.columns = expected.columns.droplevel('field')
+    pd.testing.assert_frame_equal(close, expected)
+    # 不指定symbol时返回只读的视图
+    assert np.shares_memory(close.values, store.values('close'))
+    with pytest.raises(ValueError):
+        close.values[0, 0] = 0.0
+    try:
+        close.iloc[0, 0] = 0.0
+    except ValueError:
+        pass
+    pd.testing.assert_frame_equal(store.to_frame(), df)
+    # 内部数组仍可写入
+    store.update('close', close.iloc[:1] * 2)
+    assert store.get('close').iloc[1, 0] == df.iloc[1, 0] * 2
+
+    sub = store.get('open', symbols=['600000.SH', '000001.SZ'])
+    assert list(sub.columns) == ['600000.SH', '000001.SZ']
+
+
+def test_field_store_set_remove():
+    df = _make_frame()
+    store = FieldStore.from_frame(df)
+    new = pd.DataFrame({'000002.SZ': [1.0, 2.0]}, index=[20180102, 20180105])
+    store.set('signal', new)
+    res = store.get('signal')
+    assert res.shape == (4, 3)
+    assert res.loc[20180105, '000002.SZ'] == 2.0
+    assert res['000001.SZ'].isnull().all()
+
+    store.remove('signal')
+    assert 'signal' not in store
+    assert store.get('signal').shape == (4, 0)
+
+
+def test_field_store_lazy_lru():
+    df = _make_frame()
+    base = FieldStore.from_frame(df)
+    calls = []
+
+    def loader(field):
+        calls.append(field)
+        return base.values(field).copy()
+
+    nbytes = base.values('close').nbytes
+    store = FieldStore(base.dates, base.symbols, memory_limit=nbytes)
+    store.add_lazy('close', lambda: loader('close'))
+    store.add_lazy('open', lambda: loader('open'))
+    assert store.fields == ['close', 'open']
+    assert store.loaded_fields == []
+
+    pd.testing.assert_frame_equal(store.to_frame(), df)
+    # 只能保留一个字段, 最久未使用的close被释放
+    assert store.loaded_fields == ['open']
+    store.get('close')
+    assert calls == ['close', 'open', 'close']
+    assert store.loaded_fields == ['close']
+
+    # set覆盖后的字段不再延迟加载, 也不会被释放
+    store.set('open', store.get('close') * 2)
+    store.get('close')
+    assert 'open' in store.loaded_fields
+
+
+def test_field_store_append_rows(tmpdir):
+    df = _make_frame()
+    store = FieldStore.from_frame(df.loc[:20180103])
+    new = FieldStore.from_frame(df.loc[20180104:])
+    new.remove('open')
+
+    folder = str(tmpdir.join('store'))
+    store.save(folder)
+    FieldStore.append_saved(folder, new)
+    store.append_rows(new)
+
+    expected = df.copy()
+    expected.loc[20180104:, pd.IndexSlice[:, 'open']] = np.nan
+    pd.testing.assert_frame_equal(store.to_frame(), expected)
+    loaded = FieldStore.load(folder)
+    assert isinstance(loaded.values('close'), np.memmap)
+    pd.testing.assert_frame_equal(loaded.to_frame(), expected)
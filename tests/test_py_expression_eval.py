@@ -17,6 +17,7 @@ except ImportError as e:
         raise e
 from jaqs.data import RemoteDataService
 from jaqs.data import Parser
+from jaqs_fxdayu.data.py_expression_eval import infer_lookback, infer_skipna
 from tests.data_config import data_config
 
 
@@ -152,6 +153,21 @@ def test_variables():
     res = set(expression.variables()) == {'open', 'close', 'what'}
 
 
+def test_infer_lookback():
+    assert infer_lookback(parser.parse('close / open')) == 1
+    assert infer_lookback(parser.parse('Ts_Mean(Delay(close,5),20)')) == 25
+    assert infer_lookback(parser.parse('Rank(Correlation(close, Delta(open, 2), 3*2))')) == 8
+    assert infer_lookback(parser.parse('Ewma(close, 5)')) is None
+
+
+def test_infer_skipna():
+    assert infer_skipna(parser.parse('Delay(close, 5) + Correlation(close, open, 5)')) == (False, False)
+    assert infer_skipna(parser.parse('Ts_Mean(-Delay(close, 5) * 2, 20)')) == (True, True)
+    assert infer_skipna(parser.parse('Ts_Mean(close / volume, 5)')) == (None, False)
+    assert infer_skipna(parser.parse('StdDev(Rank(close), 5)')) == (None, False)
+    assert infer_skipna(parser.parse('Ts_Sum(m, 5)'), opaque=['m']) == (None, False)
+
+
 def test_product():
     # parser.set_capital('lower')
     expression = parser.parse('Ts_Product(open,2)')
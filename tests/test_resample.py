@@ -0,0 +1,66 @@
+# encoding: utf-8
+import numpy as np
+import pandas as pd
+
+from jaqs_fxdayu.data.resample import resample_bars, freq_to_nanos, ChunkedResampler
+
+
+def _make_bars():
+    rng = np.random.RandomState(0)
+    index = pd.date_range('2018-01-02 09:31', periods=600, freq='1min')
+    dfs = []
+    for symbol in ['A', 'B']:
+        keep = rng.rand(len(index)) > 0.3
+        n = keep.sum()
+        df = pd.DataFrame({'symbol': symbol,
+                           'open': rng.randn(n),
+                           'close': rng.randn(n),
+                           'high': rng.randn(n),
+                           'low': rng.randn(n),
+                           'volume': rng.randint(0, 100, n)},
+                          index=index[keep])
+        df.loc[rng.rand(n) < 0.2, 'close'] = np.nan
+        dfs.append(df)
+    df = pd.concat(dfs)
+    df.index.name = 'datetime'
+    return df
+
+
+def test_freq_to_nanos():
+    assert freq_to_nanos('5Min') == 5 * 60 * 10 ** 9
+    assert freq_to_nanos('1H') == 3600 * 10 ** 9
+    assert freq_to_nanos('7Min') is None
+    assert freq_to_nanos('M') is None
+
+
+def test_resample_bars():
+    df = _make_bars()
+    rules = {'symbol': 'last', 'open': 'first', 'close': 'last',
+             'high': 'max', 'low': 'min', 'volume': 'sum'}
+    freqs = ['5Min', '15Min', '1H', '7Min']
+    res = resample_bars(df, freqs, rules)
+    assert list(res.keys()) == freqs
+    for freq in freqs:
+        expected = df.groupby('symbol').resample(freq).agg(rules).drop('symbol', axis=1).reset_index()
+        result = res[freq]
+        assert list(result.columns) == list(expected.columns)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_chunked_resampler():
+    df = _make_bars().sort_index(kind='mergesort')
+    rules = {'symbol': 'last', 'open': 'first', 'close': 'last',
+             'high': 'max', 'low': 'min', 'volume': 'sum'}
+    freqs = ['5Min', '15Min', '1H']
+    expected = resample_bars(df, freqs, rules)
+
+    resampler = ChunkedResampler(freqs, rules)
+    bounds = [df.index[0], pd.Timestamp('2018-01-02 10:07'), pd.Timestamp('2018-01-02 12:13'), None]
+    chunks = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        part = df[df.index >= lo] if hi is None else df[(df.index >= lo) & (df.index < hi)]
+        chunks.append(resampler.push(part, cut=hi))
+
+    for freq in freqs:
+        result = pd.concat([c[freq] for c in chunks]).sort_values(['symbol', 'datetime']).reset_index(drop=True)
+        pd.testing.assert_frame_equal(result, expected[freq], check_dtype=False)
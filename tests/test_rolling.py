@@ -0,0 +1,68 @@
+# encoding: utf-8
+import numpy as np
+import pandas as pd
+
+from jaqs_fxdayu.util.rolling import (rolling_skipna, rolling_dot, rolling_argmax, rolling_argmin,
+                                     rolling_corr, rolling_cov)
+
+
+def _make_frame():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(rng.randn(60, 5) * 0.02 + 1, index=np.arange(20180101, 20180161),
+                      columns=['000001.SZ', '000002.SZ', '600000.SH', '600001.SH', '600002.SH'])
+    df[rng.rand(*df.shape) < 0.1] = np.nan
+    # 长期停牌, 未上市及从未上市
+    df.iloc[20:40, 1] = np.nan
+    df.iloc[:10, 2] = np.nan
+    df.iloc[:, 3] = np.nan
+    return df
+
+
+def test_rolling_skipna():
+    df = _make_frame()
+    for how in ['mean', 'sum', 'std', 'min', 'max', 'kurt', 'skew']:
+        for n in [1, 5]:
+            expected = df.apply(lambda x: getattr(x.dropna().rolling(n), how)()).reindex(df.index)
+            pd.testing.assert_frame_equal(rolling_skipna(df, n, how), expected)
+
+    expected = df.apply(lambda x: x.dropna().rolling(3).apply(np.prod)).reindex(df.index)
+    pd.testing.assert_frame_equal(rolling_skipna(df, 3, 'product'), expected)
+    # 窗口大于有效值个数
+    assert rolling_skipna(df, 100, 'mean').isnull().all().all()
+
+
+def test_rolling_dot():
+    df = _make_frame()
+    weights = np.arange(1, 4)
+    expected = df.apply(lambda x: x.dropna().rolling(3).apply(lambda w: np.dot(w, weights))).reindex(df.index)
+    res = rolling_skipna(df, 3, lambda values, n: rolling_dot(values, weights))
+    assert np.allclose(res.values, expected.values, equal_nan=True)
+
+
+def test_rolling_argmax():
+    df = _make_frame()
+    # 相同的值取最早的位置
+    df.iloc[40:50, 4] = 1.0
+    # pandas rolling把inf视为NaN
+    df.iloc[30, 0] = np.inf
+    df.iloc[35, 2] = -np.inf
+    for func, expected_func in [(rolling_argmax, np.argmax), (rolling_argmin, np.argmin)]:
+        expected = df.rolling(4).apply(expected_func)
+        assert np.allclose(func(df.values, 4), expected.values, equal_nan=True)
+
+
+def test_rolling_corr():
+    x = _make_frame()
+    y = x.shift(1) * 0.5 + _make_frame()
+    # 窗口内不变的值
+    x.iloc[45:55, 3] = 1.0
+    for n in [2, 5, 30]:
+        expected = x.rolling(n, min_periods=1).cov(y)
+        assert np.allclose(rolling_cov(x.values, y.values, n), expected.values, equal_nan=True)
+        expected = x.rolling(n, min_periods=1).corr(y)
+        expected = expected.where(np.isfinite(expected))
+        res = rolling_corr(x.values, y.values, n)
+        assert np.isnan(res[50:55, 3]).all()
+        mask = np.isfinite(res)
+        assert np.allclose(res[mask], expected.values[mask])
+        assert (np.isnan(expected.values) <= np.isnan(res)).all()
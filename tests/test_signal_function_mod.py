@@ -0,0 +1,85 @@
+# encoding: utf-8
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from jaqs_fxdayu.data import signal_function_mod as sfm
+
+
+def _reference_ta(ta_method, ta_column, candles, *args, **kwargs):
+    """原实现: 对齐为并集后逐个symbol去掉含NaN的日期, 调用talib.abstract."""
+    from talib import abstract
+    index = candles[0][1].index
+    columns = candles[0][1].columns
+    for _, df in candles[1:]:
+        index = index.union(df.index)
+        columns = columns.union(df.columns)
+    results = []
+    for sec in columns:
+        df = pd.DataFrame(dict((name, frame.reindex(index=index, columns=columns)[sec])
+                               for name, frame in candles)).dropna()
+        if len(df) == 0:
+            continue
+        result = pd.DataFrame(getattr(abstract, ta_method)(df, *args, **kwargs))
+        if isinstance(ta_column, int):
+            result = pd.DataFrame(result.iloc[:, ta_column])
+        else:
+            result = pd.DataFrame(result.loc[:, ta_column])
+        result.columns = [sec]
+        results.append(result)
+    return pd.concat(results, axis=1).reindex(index=index, columns=columns)
+
+
+def _make_candles():
+    rng = np.random.RandomState(0)
+    index = pd.Index(np.arange(20170101, 20170161))
+    columns = ['000001.SZ', '000002.SZ', '600000.SH', '600001.SH']
+
+    def make(offset, dates, symbols):
+        df = pd.DataFrame(rng.rand(len(dates), len(symbols)) + offset, index=dates, columns=symbols)
+        df[rng.rand(*df.shape) < 0.1] = np.nan
+        return df
+
+    close = make(10, index, columns)
+    # 全部缺失的symbol
+    close['600001.SH'] = np.nan
+    # 日期及symbol与close不同, 取并集
+    high = make(11, index[5:], columns[:3] + ['600002.SH'])
+    low = make(9, index[:-3], columns)
+    return close, high, low
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_ta_matches_per_symbol_loop(workers, monkeypatch):
+    pytest.importorskip('talib')
+    monkeypatch.setattr(sfm, 'TA_MAX_WORKERS', workers)
+    close, high, low = _make_candles()
+    cases = [('MACD', 0, (), {}),
+             ('MACD', 'macdhist', (3, 6, 2), {}),
+             ('BBANDS', 'lowerband', (), {'timeperiod': 5}),
+             ('ATR', 0, (), {'timeperiod': 4})]
+    for ta_method, ta_column, args, kwargs in cases:
+        if ta_method == 'ATR':
+            candles = [('close', close), ('high', high), ('low', low)]
+        else:
+            candles = [('close', close)]
+        frames = dict(candles)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            res = sfm.ta(ta_method, ta_column, None, frames.get('high'), frames.get('low'), frames['close'], None,
+                         *args, **kwargs)
+        expected = _reference_ta(ta_method, ta_column, candles, *args, **kwargs)
+        pd.testing.assert_frame_equal(res, expected)
+        assert res['600001.SH'].isnull().all()
+
+
+def test_ta_invalid_column():
+    pytest.importorskip('talib')
+    close, _, _ = _make_candles()
+    with pytest.raises(ValueError):
+        sfm.ta('MACD', 3, None, None, None, close, None)
+    with pytest.raises(ValueError):
+        sfm.ta('MACD', 'wrong', None, None, None, close, None)
+    assert sfm.ta('MACD', 0, None, None, None, close[['600001.SH']], None) is None